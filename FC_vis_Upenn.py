@@ -1,11 +1,10 @@
 from PyQt5.QtWidgets import (
     QMainWindow, QApplication, QDoubleSpinBox, QWidget, QPushButton, QLabel, QComboBox, 
-    QHBoxLayout, QVBoxLayout, QGroupBox, QLineEdit, QFormLayout, QFileDialog
+    QHBoxLayout, QVBoxLayout, QGroupBox, QLineEdit, QFormLayout, QFileDialog, QSpinBox
 )
 
-from PyQt5.QtCore import Qt, QEvent
+from PyQt5.QtCore import Qt, QEvent, QThread, pyqtSignal
 import numpy as np
-import h5py as h5
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_qt5agg import FigureCanvas, NavigationToolbar2QT as NavigationToolbar
 from skimage.exposure import equalize_adapthist
@@ -13,9 +12,10 @@ import time
 import csv
 import datetime
 import os
-from tqdm import tqdm
 
 import UI_function as fun
+import UI_volume as vol
+import UI_export as exp
 
 """
 
@@ -23,6 +23,43 @@ Sarah, Sept 2023
 """
 
 
+class FCExportThread(QThread):
+    """
+    Runs an FCExportPipeline off the GUI thread, into `writer` (closed when the export ends).
+    `progress` is emitted after every slab written, with the z-planes done out of nz.
+    """
+
+    progress = pyqtSignal(int, int)
+    failed = pyqtSignal(str)
+
+    def __init__(self, pipeline, slabs, writer, nz, stats=None):
+        super().__init__()
+        self.pipeline = pipeline
+        self.slabs = slabs
+        self.writer = writer
+        self.nz = nz
+        self.stats = stats
+        self.done = 0
+
+    def cancel(self):
+        self.pipeline.cancel()
+
+    def cancelled(self):
+        return self.pipeline.cancelled()
+
+    def run(self):
+        try:
+            with self.writer:
+                self.pipeline.run(self.slabs, progress=self.written)
+        except Exception as e:
+            if not self.cancelled():
+                self.failed.emit("%s: %s" % (type(e).__name__, e))
+
+    def written(self, n):
+        self.done += n
+        self.progress.emit(self.done, self.nz)
+
+
 class MainWindow(QMainWindow):
 
     def __init__(self):
@@ -60,6 +97,25 @@ You are viewing the 8x downsampled of the fused data. ")
         note_right_fc.addWidget(self.FC_res_label)
         note_right_fc.addWidget(self.FC_res)
         note_right.addLayout(note_right_fc)
+        self.FC_workers_label = QLabel("FC workers:")
+        self.FC_workers = QSpinBox()
+        self.FC_workers.setRange(0, os.cpu_count() or 1)
+        self.FC_workers.setValue(exp.defaultWorkers())
+        note_right_workers = QHBoxLayout()
+        note_right_workers.addWidget(self.FC_workers_label)
+        note_right_workers.addWidget(self.FC_workers)
+        note_right.addLayout(note_right_workers)
+        self.FC_format = QComboBox()
+        self.FC_format.addItem("TIFF per z-level")
+        self.FC_format.addItem("OME-TIFF")
+        self.FC_format.addItem("OME-TIFF tiled")
+        self.FC_codec = QComboBox()
+        for codec in ("zlib", "zstd", "lzw", "none"):
+            self.FC_codec.addItem(codec)
+        note_right_format = QHBoxLayout()
+        note_right_format.addWidget(self.FC_format)
+        note_right_format.addWidget(self.FC_codec)
+        note_right.addLayout(note_right_format)
         note_right.addWidget(self.FC_export_button)
         note_right.addWidget(self.loading_label, alignment=Qt.AlignBottom | Qt.AlignCenter)
         note_layout.addLayout(note_right, stretch=1)
@@ -236,8 +292,8 @@ You are viewing the 8x downsampled of the fused data. ")
         dropdown_container3.setLayout(dropdown_layout3)
 
         ############# Add Action buttons at bottom right corner ################
-        file_button = QPushButton("HDF5 File")
-        file_button.clicked.connect(self.select_file) 
+        self.file_button = QPushButton("HDF5 File")
+        self.file_button.clicked.connect(self.select_file) 
 
         # Override the behavior of the "Reset Original View" button
         home_button = self.toolbar.actions()[0] #String 0 = "Home" button
@@ -248,7 +304,7 @@ You are viewing the 8x downsampled of the fused data. ")
         save_button.clicked.connect(self.save_coords)
 
         button_layout = QHBoxLayout()
-        button_layout.addWidget(file_button)
+        button_layout.addWidget(self.file_button)
         button_layout.addSpacing(50)
         button_layout.addWidget(save_button)
         button_layout.addStretch()
@@ -280,6 +336,9 @@ You are viewing the 8x downsampled of the fused data. ")
         self.ROI_dim = 512
         self.normfactor_nuc = 10000
         self.normfactor_cyto = 10000
+        self.h5path = None
+        self.pool = vol.H5HandlePool()
+        self.export_thread = None
         self.select_file() # Including readHDF5() and plot_init_z()
 
         # Connect the mouse wheel event to the update_z_level method
@@ -294,10 +353,8 @@ You are viewing the 8x downsampled of the fused data. ")
     def readHDF5(self):
     
         start = time.time()
-        with h5.File(self.h5path, 'r') as f:
-            self.cyto = f['t00000']['s01']['3/cells'][:, :, :].astype(np.uint16)
-            self.nuc = f['t00000']['s00']['3/cells'][:, :, :].astype(np.uint16)
-        f.close()
+        self.cyto = self.pool.dataset(self.h5path, 's01', 3)[:, :, :].astype(np.uint16)
+        self.nuc = self.pool.dataset(self.h5path, 's00', 3)[:, :, :].astype(np.uint16)
 
         if self.cyto.shape[0] < self.cyto.shape[1]:
             self.orient = 0
@@ -499,35 +556,56 @@ You are viewing the 8x downsampled of the fused data. ")
 
     #################################### False-coloring ####################################
 
-    def readHDF5_FC(self, zlvl):
-        ystart   = int(self.x_limits[0]*4)
-        xstart   = int(self.y_limits[1]*4)
-        yend = int(self.x_limits[1]*4)
-        xend = int(self.y_limits[0]*4)
+    def FC_window(self):
+        """View and clip limits readHDF5_FC works with, as a copy that later changes do not affect."""
+        return {'x_limits': tuple(self.x_limits), 'y_limits': tuple(self.y_limits),
+                'cyto_clip': (self.ClipLowLim_cyto.value(), self.ClipHighLim_cyto.value()),
+                'nuc_clip': (self.ClipLowLim_nuc.value(), self.ClipHighLim_nuc.value())}
+
+    def readHDF5_FC(self, zlvl, window=None, stats=None):
+        """
+        Level-1 FC planes of the current view. Exports read from their own thread, with the
+        FC_window() taken when they started and their own vol.ReadStats.
+        """
+        if window is None:
+            window = self.FC_window()
+        x_limits, y_limits = window['x_limits'], window['y_limits']
+        ystart   = int(x_limits[0]*4)
+        xstart   = int(y_limits[1]*4)
+        yend = int(x_limits[1]*4)
+        xend = int(y_limits[0]*4)
         if zlvl == "":
             zstart = int(self.current_z_level*4)
             zend = zstart + 1
+        elif isinstance(zlvl, tuple):
+            zstart, zend = zlvl
         else: 
             zstart = zlvl
             zend = zlvl+1
 
+        # Full-volume exports (zlvl given) use the handle with the larger chunk cache
+        profile = 'preview' if zlvl == "" else 'export'
+        cyto_ds = self.pool.dataset(self.h5path, 's01', 1, profile)
+        nuc_ds = self.pool.dataset(self.h5path, 's00', 1, profile)
+
+        if self.orient == 1: 
+            box = np.s_[xstart:xend, zstart:zend, ystart:yend]
+        else:
+            box = np.s_[zstart:zend, xstart:xend, ystart:yend]
+        if stats is not None:
+            stats.record(cyto_ds, box)
+            stats.record(nuc_ds, box)
+
+        cyto_fc = cyto_ds[box].astype(np.uint16)
+        nuc_fc = nuc_ds[box].astype(np.uint16)
         if self.orient == 1: 
-            with h5.File(self.h5path, 'r') as f:
-                cyto_fc = f['t00000']['s01']['1/cells'][xstart:xend, zstart:zend, ystart:yend].astype(np.uint16)
-                nuc_fc = f['t00000']['s00']['1/cells'][xstart:xend, zstart:zend, ystart:yend].astype(np.uint16)
-            f.close()
             cyto_fc = np.moveaxis(cyto_fc, 0, 1)
             nuc_fc = np.moveaxis(nuc_fc, 0, 1)
-            print(cyto_fc.shape)
-        else:
-            with h5.File(self.h5path, 'r') as f:
-                cyto_fc = f['t00000']['s01']['1/cells'][zstart:zend, xstart:xend, ystart:yend].astype(np.uint16)
-                nuc_fc = f['t00000']['s00']['1/cells'][zstart:zend, xstart:xend, ystart:yend].astype(np.uint16)
-            f.close()
-
-        cyto_fc = fun.FC_rescale(cyto_fc, self.ClipLowLim_cyto.value(), self.ClipHighLim_cyto.value())
-        nuc_fc  = fun.FC_rescale(nuc_fc, self.ClipLowLim_nuc.value(), self.ClipHighLim_nuc.value())
-        self.FC_shape = cyto_fc.shape
+
+        # (codes, levels) pairs with one row of levels per z-slice, false coloring runs on lookup tables
+        cyto_fc = fun.FC_rescale_lut(cyto_fc, *window['cyto_clip'], per_slice=True)
+        nuc_fc  = fun.FC_rescale_lut(nuc_fc, *window['nuc_clip'], per_slice=True)
+        self.FC_shape = cyto_fc[0].shape
   
         return cyto_fc, nuc_fc
 
@@ -536,10 +614,14 @@ You are viewing the 8x downsampled of the fused data. ")
     def RunFC_HE(self):
         """Nested in self.Draw_FC() """
         HE_settings = {'nuclei': [0.17, 0.27, 0.105], 'cyto': [0.05, 1.0, 0.54]}
-        pseudoHE = fun.rapidFalseColor(self.nuc_fc[0], self.cyto_fc[0], 
+        nuc_fc, nuc_levels = self.nuc_fc
+        cyto_fc, cyto_levels = self.cyto_fc
+        pseudoHE = fun.rapidFalseColor(nuc_fc[0], cyto_fc[0], 
                                         HE_settings['nuclei'], HE_settings['cyto'],
                                         nuc_normfactor = self.normfactor_nuc, 
-                                        cyto_normfactor = self.normfactor_cyto)
+                                        cyto_normfactor = self.normfactor_cyto,
+                                        nuc_levels = nuc_levels[0],
+                                        cyto_levels = cyto_levels[0])
         return pseudoHE
 
     def Draw_FC(self):
@@ -558,7 +640,6 @@ You are viewing the 8x downsampled of the fused data. ")
 
 
     def SaveFC3D(self):
-        import tifffile
         
         HE_settings = {'nuclei': [0.17, 0.27, 0.105], 'cyto': [0.05, 1.0, 0.54]}
         file_dialog = QFileDialog()
@@ -576,19 +657,75 @@ You are viewing the 8x downsampled of the fused data. ")
             self.Nuc_normfactor.setEnabled(False)
             self.Cyto_normfactor.setEnabled(False)
 
-            for z in tqdm(range(self.shape[0]*4), desc="False coloring..."):
-                self.show_false_coloring()
-                cyto_fc, nuc_fc = self.readHDF5_FC(zlvl=z)
+            self.show_false_coloring()
+            name = self.h5path.split("-23_")[1].split("_well")[0]
 
-                pseudoHE = fun.rapidFalseColor(nuc_fc[0], cyto_fc[0], 
-                                                HE_settings['nuclei'], HE_settings['cyto'],
-                                                nuc_normfactor = self.normfactor_nuc, 
-                                                cyto_normfactor = self.normfactor_cyto)
-                path = folder + os.sep + self.h5path.split("-23_")[1].split("_well")[0] + "_" + str(z) + ".tiff"
-                tifffile.imwrite(path, pseudoHE)
+            # Runs in the export thread: the view and clip limits may change meanwhile
+            window = self.FC_window()
+            stats = vol.ReadStats()
+
+            def read(z0, z1):
+                (cyto_fc, cyto_levels), (nuc_fc, nuc_levels) = self.readHDF5_FC((z0, z1), window, stats)
+                return nuc_fc, cyto_fc, nuc_levels, cyto_levels
+
+            # One TIFF per z-level, or all planes streamed into a single BigTIFF/OME-TIFF. The
+            # z extent of level 1 is not always 4x that of the preview, take it from the data
+            level1 = self.pool.dataset(self.h5path, 's00', 1, 'export')
+            nz = level1.shape[1 if self.orient == 1 else 0]
+            export_format = self.FC_format.currentText()
+            if export_format == "TIFF per z-level":
+                writer = exp.TiffFilesWriter(folder, name)
+            else:
+                codec = self.FC_codec.currentText()
+                writer = exp.TiffStackWriter(folder + os.sep + name + ".ome.tif", nz,
+                                             compression = None if codec == "none" else codec,
+                                             tile = (256, 256) if export_format == "OME-TIFF tiled" else None)
+
+            pipeline = exp.FCExportPipeline(read, writer.write, HE_settings['nuclei'], HE_settings['cyto'],
+                                            workers = self.FC_workers.value(),
+                                            nuc_normfactor = self.normfactor_nuc, 
+                                            cyto_normfactor = self.normfactor_cyto)
+
+            # Slabs of whole HDF5 chunks along z, ~512 MB of both channels over all the slabs the
+            # pipeline holds at once, so that every chunk is decompressed once, then
+            # read -> false colored -> written in a pipeline
+            plane_bytes = 2*2*16*abs(self.x_limits[1] - self.x_limits[0])*abs(self.y_limits[0] - self.y_limits[1])
+            chunks = level1.chunks
+            self.pool.dataset(self.h5path, 's01', 1, 'export') # opened here, not from the export thread
+            chunk_depth = chunks[1 if self.orient == 1 else 0] if chunks else 1
+            slabs = vol.chunk_aligned_slabs(nz, chunk_depth, 512*1024**2 // max(pipeline.max_slabs*plane_bytes, 1))
+
+            self.export_thread = FCExportThread(pipeline, slabs, writer, nz, stats)
+            self.export_thread.progress.connect(self.on_export_progress)
+            self.export_thread.failed.connect(self.on_export_failed)
+            self.export_thread.finished.connect(self.on_export_finished)
+            self.FC_export_button.setEnabled(False)
+            self.file_button.setEnabled(False)
+            self.export_thread.start()
+            return
 
         self.hide_text()
 
+    def on_export_progress(self, done, nz):
+        self.loading_label.setText("False coloring... %d/%d" % (done, nz))
+
+    def on_export_failed(self, message):
+        print("FC export failed:", message)
+        self.loading_label.setText("FC export failed")
+        self.loading_label.setStyleSheet("color: red;")
+
+    def on_export_finished(self):
+        export = self.export_thread
+        self.export_thread = None
+        if export.stats is not None:
+            print(export.stats.report())
+        self.FC_export_button.setEnabled(True)
+        self.file_button.setEnabled(True)
+        if export.done == export.nz:
+            self.hide_text()
+        elif export.cancelled():
+            self.loading_label.setText("FC export cancelled")
+
     def normfactor_nuc_change(self):
         self.normfactor_nuc = self.Nuc_normfactor.value()
         self.Draw_FC()
@@ -757,6 +894,8 @@ You are viewing the 8x downsampled of the fused data. ")
         # file_dialog.setDirectory("W:/Trilabel_Data")
         file_path, _ = file_dialog.getOpenFileName(self, "Select fused HDF5 File")
         if file_path:
+            if self.h5path is not None:
+                self.pool.close(self.h5path)
             self.h5path = file_path
             print(self.h5path)
             self.show_loading_data()
@@ -829,6 +968,14 @@ You are viewing the 8x downsampled of the fused data. ")
         print("saved")
 
 
+    def closeEvent(self, event):
+        if self.export_thread is not None:
+            self.export_thread.cancel()
+            self.export_thread.wait()
+        self.pool.close()
+        super().closeEvent(event)
+
+
     #################################
     ######## Shortcut Key############
     #################################
@@ -853,7 +1000,9 @@ You are viewing the 8x downsampled of the fused data. ")
 
 
 
-app = QApplication([])
-w = MainWindow()
-w.show()
-app.exec()
+# Guarded, FC export worker processes re-import this module on spawn-based platforms
+if __name__ == "__main__":
+    app = QApplication([])
+    w = MainWindow()
+    w.show()
+    app.exec()
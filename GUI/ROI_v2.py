@@ -5,9 +5,8 @@ from PyQt5.QtWidgets import (
 )
 
 from PyQt5.QtGui import QIcon, QIntValidator
-from PyQt5.QtCore import Qt, QEvent
+from PyQt5.QtCore import Qt, QEvent, QTimer, QThread, pyqtSignal
 import numpy as np
-import h5py as h5
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_qt5agg import FigureCanvas, NavigationToolbar2QT as NavigationToolbar
 from skimage.exposure import equalize_adapthist, rescale_intensity
@@ -15,8 +14,14 @@ import time
 import csv
 import datetime
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import UI_function as fun
+import UI_volume as vol
+import UI_prefetch as pre
+import UI_render as rnd
+import UI_trace as trace
 
 """
 For cropping ROIs and false coloring
@@ -24,8 +29,73 @@ Sarah, Jul 2023
 """
 
 
+class SampleLoader(QThread):
+    """
+    Opens a sample off the GUI thread.
+
+    1) opens the preview volumes (vol.open_preview) and reads the first cyto plane,
+       then emits `opened`: the GUI can show the sample and navigate in it,
+    2) if the sample is not in the preview cache yet, streams the level-3 data of every
+       channel, chunk slab by chunk slab, into its sidecar (`progress` after every slab)
+       and emits `cached` with the memory-mapped copies.
+
+    cancel() stops either step, nothing is emitted after it.
+    """
+
+    opened = pyqtSignal(object)
+    progress = pyqtSignal(str, int, int) # setup, z-planes done, z-planes
+    cached = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+    def __init__(self, h5path, preview_cache=None):
+        super().__init__()
+        self.h5path = h5path
+        self.preview_cache = preview_cache
+        self.pool = vol.H5HandlePool()
+        self._cancel = threading.Event()
+
+    def cancel(self):
+        self._cancel.set()
+
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def run(self):
+        opened = False
+        try:
+            with trace.span('readHDF5', cat='gui'):
+                sample = vol.open_preview(self.pool, self.h5path, self.preview_cache)
+                sample['volumes']['s00'][0]
+            if self.cancelled():
+                self.pool.close()
+                return
+            self.opened.emit(sample)
+            opened = True
+
+            if sample['cached'] or self.preview_cache is None:
+                return
+            with trace.span('store_preview', cat='gui'):
+                entry = self.preview_cache.store(self.h5path, progress=self.emit_progress, cancel=self.cancelled)
+            if entry is not None and not self.cancelled():
+                cached = self.preview_cache.load(self.h5path)
+                if cached is not None:
+                    self.cached.emit(cached)
+        except Exception as e:
+            if not opened:
+                self.pool.close()
+            if not self.cancelled():
+                self.failed.emit("%s: %s" % (type(e).__name__, e))
+
+    def emit_progress(self, setup, z_done, nz):
+        if not self.cancelled():
+            self.progress.emit(setup, z_done, nz)
+
+
 class MainWindow(QMainWindow):
 
+    # Emitted from the block cache thread when a CLAHE block is ready, delivered on the GUI thread
+    clahe_ready = pyqtSignal(object)
+
     def __init__(self):
         super().__init__()
 
@@ -45,14 +115,22 @@ class MainWindow(QMainWindow):
         2. Zoom(key Z) to desired ROI, input ROI dimension, press 'Crop'(Key C), drag(Key E) to fine tune ROI. \n\
         3. Find manually or press 'Auto Rescale'(key R) for optimal contrast clipping values for all 3 channels. \n\
         4. Press 'Save!' to save to .csv file, 'home'(key F) to go back or 'Select File' for another data. \n \
-You are viewing the 8x downsampled of fused.h5 file. ")
+You are viewing the 8x downsampled of fused.h5 file (finer levels are loaded when zoomed in). ")
         note_label.setFixedWidth(600)
 
-        # Loading data label
+        # Loading data label, background loading progress and its cancel button
         self.loading_label = QLabel()
+        self.load_label = QLabel()
+        self.cancel_button = QPushButton("Cancel")
+        self.cancel_button.clicked.connect(self.on_cancel_clicked)
+        self.cancel_button.hide()
+        load_layout = QHBoxLayout()
+        load_layout.addWidget(self.load_label)
+        load_layout.addWidget(self.cancel_button)
         startup_layout = QHBoxLayout()
         h5_msg_layout = QVBoxLayout()
         h5_msg_layout.addWidget(self.loading_label, alignment=Qt.AlignBottom | Qt.AlignRight)
+        h5_msg_layout.addLayout(load_layout)
         startup_layout.addWidget(note_label, alignment=Qt.AlignTop | Qt.AlignLeft)
         startup_layout.addLayout(h5_msg_layout)
 
@@ -60,6 +138,7 @@ You are viewing the 8x downsampled of fused.h5 file. ")
         self.figure = plt.figure()
         self.canvas = FigureCanvas(self.figure)
         self.canvas.mpl_connect('button_release_event', self.on_zoom_completed)
+        self.renderer = rnd.SliceRenderer(self.figure, self.canvas)
 
         # Bottom pannel of the canvas
         Canvasbottom = QHBoxLayout()
@@ -217,6 +296,7 @@ You are viewing the 8x downsampled of fused.h5 file. ")
         self.dropdown3 = QComboBox()
         self.dropdown3.addItem("Rescale")
         self.dropdown3.addItem("CLAHE")
+        self.dropdown3.addItem("CLAHE (fast 2D)")
         dropdown_layout3.addWidget(self.dropdown3)
         clip_high_layout3 = QHBoxLayout()
         clip_high_layout3.addWidget(QLabel("Clip High:"))
@@ -299,7 +379,7 @@ You are viewing the 8x downsampled of fused.h5 file. ")
         # Save button
         save_button = QPushButton(" SAVE ")
         save_button.setStyleSheet("QPushButton { background-color: green; color: white; padding: 5px; font-weight: bold; }")
-        save_button.clicked.connect(self.save_coords)
+        save_button.clicked.connect(lambda: self.save_coords()) # no `checked` argument
 
         # Configure action button layout
         action_button_layout = QHBoxLayout()
@@ -337,7 +417,15 @@ You are viewing the 8x downsampled of fused.h5 file. ")
         self.no_of_layer = 12
         self.normfactor_nuc = 8000
         self.normfactor_cyto = 5000
-        self.select_file() # Including readHDF5() and plot_init_z()
+        self.h5path = None
+        self.pool = vol.H5HandlePool()
+        self.preview_cache = vol.PreviewCache()
+        self.loader = None
+        self.prefetcher = pre.SlicePrefetcher()
+        self.clahe_cache = pre.BlockCache(on_ready=self.clahe_ready.emit)
+        self.clahe_ready.connect(self.on_clahe_ready)
+        self.plot_pending = False
+        self.select_file() # Including load_sample(), which calls plot_init_z() once the sample is open
 
         # Connect the mouse wheel event to the update_z_level method
         self.canvas.mpl_connect('scroll_event', self.update_z_level)
@@ -349,24 +437,107 @@ You are viewing the 8x downsampled of fused.h5 file. ")
         """
 
     def readHDF5(self):
-    
+        """
+        Open self.h5path on the GUI thread, see vol.open_preview. select_file opens
+        samples with a SampleLoader instead.
+        """
         start = time.time()
-        with h5.File(self.h5path, 'r') as f:
-            self.cyto = f['t00000']['s00']['3/cells'][:, :, :].astype(np.uint16)
-            self.nuc = f['t00000']['s01']['3/cells'][:, :, :].astype(np.uint16)
-            self.pgp = f['t00000']['s02']['3/cells'][:, :, :].astype(np.uint16)
-        f.close()
-
-        if self.cyto.shape[0] < self.cyto.shape[1]:
-            self.orient = 0
-        else: 
-            self.orient = 1
-            self.cyto = np.moveaxis(self.cyto, 0, 1)
-            self.nuc = np.moveaxis(self.nuc, 0, 1)
-            self.pgp = np.moveaxis(self.pgp, 0, 1)
-
+        self.set_sample(vol.open_preview(self.pool, self.h5path, self.preview_cache))
         print(time.time() - start, "s")
 
+    def set_sample(self, sample):
+        self.orient = sample['orient']
+        volumes = sample['volumes']
+        self.cyto, self.nuc, self.pgp = volumes['s00'], volumes['s01'], volumes['s02']
+        self.volumes = {}
+        self.window_views = {}
+
+        # Per-axis [z, y, x] downsampling of each pyramid level, and level 3 -> level 1 factor for FC/ROI coords
+        self.scales = sample['scales']
+        self.fc_scale = self.scales[3] / self.scales[1]
+
+    ##################### Background loading ##################################################
+
+    def load_sample(self, h5path):
+        """
+        Open h5path in a SampleLoader thread. The current sample stays on screen (and usable)
+        until the new one is open; its first cyto plane is then drawn right away, while the
+        preview volumes of the channels are still being cached.
+        """
+        self.cancel_loading(wait=True)
+        self.show_loading_data()
+        self.loader = SampleLoader(h5path, self.preview_cache)
+        self.loader.opened.connect(self.on_sample_opened)
+        self.loader.progress.connect(self.on_load_progress)
+        self.loader.cached.connect(self.on_preview_cached)
+        self.loader.failed.connect(self.on_load_failed)
+        self.loader.finished.connect(self.on_load_finished)
+        self.cancel_button.show()
+        self.loader.start()
+
+    def cancel_loading(self, wait=False):
+        if self.loader is not None and self.loader.isRunning():
+            self.loader.cancel()
+            if wait:
+                self.loader.wait()
+
+    def on_cancel_clicked(self):
+        if self.loader is None or not self.loader.isRunning():
+            return
+        self.cancel_loading()
+        self.load_label.setText("Cancelling...")
+
+    def on_sample_opened(self, sample):
+        if self.sender() is not self.loader:
+            self.sender().pool.close() # superseded by another sample
+            return
+        if self.h5path is not None:
+            print(self.prefetcher.report())
+            print(self.clahe_cache.report())
+            self.prefetcher.clear()
+            self.clahe_cache.clear()
+        # The volumes read through the loader's handles, they replace those of the previous sample
+        self.pool.close()
+        self.pool = self.loader.pool
+        self.h5path = self.loader.h5path
+        print(self.h5path)
+        self.set_sample(sample)
+        self.plot_init_z()
+        self.hide_text()
+
+    def on_load_progress(self, setup, z_done, nz):
+        if self.sender() is not self.loader:
+            return
+        chan = {'s00': "cyto", 's01': "nuc", 's02': "Target"}[setup]
+        self.load_label.setText("Caching preview: %s %d/%d" % (chan, z_done, nz))
+
+    def on_preview_cached(self, cached):
+        """The preview sidecar is complete: show the memory-mapped copies from now on."""
+        if self.sender() is not self.loader:
+            return
+        meta, volumes = cached
+        self.cyto, self.nuc, self.pgp = volumes['s00'], volumes['s01'], volumes['s02']
+        self.img = {"cyto": self.cyto, "nuc": self.nuc, "Target": self.pgp}[self.current_chan]
+        print("Preview cached for", self.h5path)
+
+    def on_load_failed(self, message):
+        if self.sender() is not self.loader:
+            return
+        print("Failed to load", self.loader.h5path, ":", message)
+        self.loading_label.setText("Failed to load data")
+        self.loading_label.setStyleSheet("color: red;")
+
+    def on_load_finished(self):
+        if self.sender() is not self.loader:
+            return
+        self.cancel_button.hide()
+        if self.loader.cancelled():
+            self.load_label.setText("Loading cancelled")
+            if self.loader.h5path != self.h5path:
+                self.hide_text()
+        else:
+            self.load_label.clear()
+
     def plot_init_z(self):
 
         # Initial params
@@ -383,12 +554,8 @@ You are viewing the 8x downsampled of fused.h5 file. ")
         self.arrayshape_textbox.setText(str(self.shape))
 
         # Plot initial slice
-        ax = self.figure.add_subplot(111)
-        ax.imshow(self.img[self.current_z_level], cmap="gray", vmax=self.vmax)
-        ax.set_xlabel('X')
-        ax.set_ylabel('Y')
-        ax.set_title('Vol Preview')
-        self.canvas.draw()
+        self.renderer.reset()
+        self.renderer.show(self.current_chan, self.img[self.current_z_level], clim=(0, self.vmax))
         ax = self.figure.gca()
         self.x_limits = ax.get_xlim()
         self.y_limits = ax.get_ylim()
@@ -429,12 +596,16 @@ You are viewing the 8x downsampled of fused.h5 file. ")
             self.x_coordinate_textbox.update()
             self.y_coordinate_textbox.update()
 
-            if self.x_limits[0] + int(self.ROI_dim)/4 > self.shape[2] - 1 or \
-               self.y_limits[1] + int(self.ROI_dim)/4 > self.shape[1] - 1 :
+            if self.x_limits[0] + int(self.ROI_dim)/self.fc_scale[2] > self.shape[2] - 1 or \
+               self.y_limits[1] + int(self.ROI_dim)/self.fc_scale[1] > self.shape[1] - 1 :
                 self.show_OutofBound()
             else: 
                 self.hide_text()
 
+            # The zoom may call for another pyramid level
+            if not self.FC_button.isChecked():
+                self.request_plot()
+
 
     ########################## Update current Z-level ##########################################
 
@@ -462,7 +633,18 @@ You are viewing the 8x downsampled of fused.h5 file. ")
             else: 
                 self.hide_text()
 
-            self.plot_slice()
+            # Queue the slices ahead of the scroll, and coalesce wheel events into one redraw
+            self.prefetcher.notify(self.current_z_level)
+            self.request_plot()
+
+    def request_plot(self):
+        if not self.plot_pending:
+            self.plot_pending = True
+            QTimer.singleShot(0, self.flush_plot)
+
+    def flush_plot(self):
+        self.plot_pending = False
+        self.plot_slice()
 
     def update_z_level_textbox(self):
 
@@ -605,67 +787,75 @@ You are viewing the 8x downsampled of fused.h5 file. ")
 
     #################################### False-coloring ####################################
 
+    @trace.traced(cat='gui')
     def readHDF5_FC(self):
-        ystart   = int(self.x_limits[0]*4)
-        xstart   = int(self.y_limits[1]*4)
-        zstart = int(self.current_z_level*4)
+        ystart   = int(self.x_limits[0]*self.fc_scale[2])
+        xstart   = int(self.y_limits[1]*self.fc_scale[1])
+        zstart = int(self.current_z_level*self.fc_scale[0])
         ROI_dim = int(self.ROI_dim)
         xend = xstart + ROI_dim
         yend = ystart + ROI_dim
         zend = zstart + 1
 
+        cyto_ds = self.pool.dataset(self.h5path, 's00', 1)
+        nuc_ds = self.pool.dataset(self.h5path, 's01', 1)
+        pgp_ds = self.pool.dataset(self.h5path, 's02', 1)
+
         if self.orient == 1: 
-            with h5.File(self.h5path, 'r') as f:
-                cyto_fc = f['t00000']['s00']['1/cells'][xstart:xend, zstart:zend, ystart:yend].astype(np.uint16)
-                nuc_fc = f['t00000']['s01']['1/cells'][xstart:xend, zstart:zend, ystart:yend].astype(np.uint16)
-                pgp_fc = f['t00000']['s02']['1/cells'][xstart:xend, zstart:zend, ystart:yend].astype(np.uint16)
-            f.close()
+            cyto_fc = cyto_ds[xstart:xend, zstart:zend, ystart:yend].astype(np.uint16)
+            nuc_fc = nuc_ds[xstart:xend, zstart:zend, ystart:yend].astype(np.uint16)
+            pgp_fc = pgp_ds[xstart:xend, zstart:zend, ystart:yend].astype(np.uint16)
             cyto_fc = np.moveaxis(cyto_fc, 0, 1)
             nuc_fc = np.moveaxis(nuc_fc, 0, 1)
             pgp_fc = np.moveaxis(pgp_fc, 0, 1)
         else:
-            with h5.File(self.h5path, 'r') as f:
-                cyto_fc = f['t00000']['s00']['1/cells'][zstart:zend, xstart:xend, ystart:yend].astype(np.uint16)
-                nuc_fc = f['t00000']['s01']['1/cells'][zstart:zend, xstart:xend, ystart:yend].astype(np.uint16)
-                pgp_fc = f['t00000']['s02']['1/cells'][zstart:zend, xstart:xend, ystart:yend].astype(np.uint16)
-            f.close()
+            cyto_fc = cyto_ds[zstart:zend, xstart:xend, ystart:yend].astype(np.uint16)
+            nuc_fc = nuc_ds[zstart:zend, xstart:xend, ystart:yend].astype(np.uint16)
+            pgp_fc = pgp_ds[zstart:zend, xstart:xend, ystart:yend].astype(np.uint16)
 
-        cyto_fc = fun.FC_rescale(cyto_fc, self.ClipLowLim_cyto.value(), self.ClipHighLim_cyto.value())
-        nuc_fc  = fun.FC_rescale(nuc_fc, self.ClipLowLim_nuc.value(), self.ClipHighLim_nuc.value())
-        pgp_fc  = fun.FC_rescale(pgp_fc, self.ClipLowLim_pgp.value(), self.ClipHighLim_pgp.value())
+        # (codes, levels) pairs, false coloring runs on lookup tables over the levels
+        cyto_fc = fun.FC_rescale_lut(cyto_fc, self.ClipLowLim_cyto.value(), self.ClipHighLim_cyto.value())
+        nuc_fc  = fun.FC_rescale_lut(nuc_fc, self.ClipLowLim_nuc.value(), self.ClipHighLim_nuc.value())
+        pgp_fc  = fun.FC_rescale_lut(pgp_fc, self.ClipLowLim_pgp.value(), self.ClipHighLim_pgp.value())
 
         return cyto_fc, nuc_fc, pgp_fc
 
     def RunFC_HE(self):
 
         HE_settings = {'nuclei': [0.17, 0.27, 0.105], 'cyto': [0.05, 1.0, 0.54]}
-        pseudoHE = fun.rapidFalseColor(self.nuc_fc[0], self.cyto_fc[0], 
+        nuc_fc, nuc_levels = self.nuc_fc
+        cyto_fc, cyto_levels = self.cyto_fc
+        pseudoHE = fun.rapidFalseColor(nuc_fc[0], cyto_fc[0], 
                                         HE_settings['nuclei'], HE_settings['cyto'],
                                         nuc_normfactor = self.normfactor_nuc, 
-                                        cyto_normfactor = self.normfactor_cyto)
+                                        cyto_normfactor = self.normfactor_cyto,
+                                        nuc_levels = nuc_levels,
+                                        cyto_levels = cyto_levels)
         return pseudoHE
 
     def RunFC_IHC(self):
 
         IHC_settings = {'nuclei': [0.65, 0.45, 0.15], 'anti': [0.4, 0.7, 0.9]}
-        pseudoIHC = fun.rapidFalseColor(self.nuc_fc[0], self.pgp_fc[0], 
+        nuc_fc, nuc_levels = self.nuc_fc
+        pgp_fc, pgp_levels = self.pgp_fc
+        pseudoIHC = fun.rapidFalseColor(nuc_fc[0], pgp_fc[0], 
                                          IHC_settings['nuclei'], IHC_settings['anti'],
                                          nuc_normfactor = self.normfactor_nuc, 
-                                         cyto_normfactor = self.normfactor_cyto) #ihc
+                                         cyto_normfactor = self.normfactor_cyto,
+                                         nuc_levels = nuc_levels,
+                                         cyto_levels = pgp_levels) #ihc
         return pseudoIHC
 
+    @trace.traced(cat='gui')
     def Draw_FC(self):
-        self.figure.clear()
-        if self.dropdown4.currentText() == "H&E":
-            pseudoFC = self.RunFC_HE()
-        else:
-            pseudoFC = self.RunFC_IHC()
-        vmax = np.percentile(pseudoFC,99)
-        ax = self.figure.add_subplot(111)
-        ax.imshow(pseudoFC, cmap='viridis', vmax=vmax)
-        ax.axis('off')
-
-        self.canvas.draw()
+        with trace.span('rapidFalseColor', cat='gui', style=self.dropdown4.currentText()):
+            if self.dropdown4.currentText() == "H&E":
+                pseudoFC = self.RunFC_HE()
+            else:
+                pseudoFC = self.RunFC_IHC()
+        h, w = pseudoFC.shape[:2]
+        with trace.span('draw', cat='gui'):
+            self.renderer.show("FC", pseudoFC, xlim=(-0.5, w - 0.5), ylim=(h - 0.5, -0.5), axis_on=False)
 
     def normfactor_nuc_change(self):
         self.normfactor_nuc = self.Nuc_normfactor.value()
@@ -692,8 +882,8 @@ You are viewing the 8x downsampled of fused.h5 file. ")
         ROI_dim = float(self.ROI_dim)
         xstart = self.x_limits[0]
         ystart = self.y_limits[1]
-        xend = xstart + ROI_dim/4
-        yend = ystart + ROI_dim/4
+        xend = xstart + ROI_dim/self.fc_scale[2]
+        yend = ystart + ROI_dim/self.fc_scale[1]
         self.x_limits = [xstart, xend]
         self.y_limits = [yend, ystart]
         self.crop_button.setChecked(True)
@@ -701,30 +891,44 @@ You are viewing the 8x downsampled of fused.h5 file. ")
 
     def Auto_Rescale(self):
         """
-        This function calculate the p2 and p98 and update them.
-        Plot will automatically update when values of the properties are changed
+        This function calculates the clip limits of cyto, nuc and target and updates them.
+        - high: 99th percentile of the current ROI * 1.35
+        - low : 95th percentile of its foreground / 5 (cyto) or / 3 (nuc, target)
+        The three channels are read and histogrammed in parallel, the spinboxes are
+        updated together and the plot is redrawn once.
         """
-        current_slice = self.img[self.current_z_level, :, :]
         xstart = int(self.x_limits[0])
         xend = int(self.x_limits[1])
         ystart = int(self.y_limits[1])
         yend = int(self.y_limits[0])
-        current_ROI = current_slice[ystart:yend,xstart:xend]
-        p98 = np.percentile(current_ROI, 99)
-        p98 = p98*1.35
-        hi_val = fun.getBackgroundLevels(current_ROI)[0]
-        if self.current_chan == "cyto":
-            p2 = hi_val/5
-            self.ClipHighLim_cyto.setValue(int(p98)) 
-            self.ClipLowLim_cyto.setValue(int(p2))
-        elif self.current_chan == "nuc":
-            p2 = hi_val/3
-            self.ClipHighLim_nuc.setValue(int(p98)) 
-            self.ClipLowLim_nuc.setValue(int(p2))
+        z = self.current_z_level
+
+        channels = [(self.cyto, 5, self.ClipLowLim_cyto, self.ClipHighLim_cyto),
+                    (self.nuc, 3, self.ClipLowLim_nuc, self.ClipHighLim_nuc),
+                    (self.pgp, 3, self.ClipLowLim_pgp, self.ClipHighLim_pgp)]
+
+        def clip_limits(volume, low_divisor):
+            current_ROI = volume[z, ystart:yend, xstart:xend]
+            return fun.autoClipLimits(current_ROI, low_divisor)
+
+        with ThreadPoolExecutor(len(channels)) as pool:
+            limits = list(pool.map(clip_limits, *zip(*[c[:2] for c in channels])))
+
+        # No redraw per setValue, the valueChanged handlers are skipped
+        for (_, _, low_box, high_box), (p2, p98) in zip(channels, limits):
+            for box, value in ((high_box, p98), (low_box, p2)):
+                box.blockSignals(True)
+                box.setValue(int(value))
+                box.blockSignals(False)
+
+        if self.FC_button.isChecked():
+            self.cyto_fc, self.nuc_fc, self.pgp_fc = self.readHDF5_FC()
+            self.Draw_FC()
         else:
-            p2 = hi_val/3
-            self.ClipHighLim_pgp.setValue(int(p98)) 
-            self.ClipLowLim_pgp.setValue(int(p2))
+            active = {"cyto": 0, "nuc": 1}.get(self.current_chan, 2)
+            self.ClipLowLim = channels[active][2].value()
+            self.ClipHighLim = channels[active][3].value()
+            self.plot_slice()
 
 
     ############################## Update Clip limits ######################################
@@ -755,13 +959,13 @@ You are viewing the 8x downsampled of fused.h5 file. ")
 
     ######################### Contrast Enhancement Method ##################################
 
-    def CLAHE(self, block):
+    def CLAHE(self, block, clip_low, clip_high, kernel):
 
-        block = np.clip(block, int(self.ClipLowLim), int(self.ClipHighLim))
+        block = np.clip(block, int(clip_low), int(clip_high))
         # set clahe kernel size to be 1/4 image size
-        kernel_size = np.asarray([int(self.ROI_dim)//16, #1/4 kernel size
-                                  int(self.ROI_dim)//16,
-                                  int(self.ROI_dim)//16])
+        kernel_size = np.asarray([kernel, #1/4 kernel size
+                                  kernel,
+                                  kernel])
         # equalize histogram and convert to 8 bit
         block = equalize_adapthist(block,
                                    kernel_size=kernel_size,
@@ -780,9 +984,21 @@ You are viewing the 8x downsampled of fused.h5 file. ")
 
         self.plot_slice()
 
+    @trace.traced('CLAHE', cat='gui')
+    def clahe_block(self, volume, box, clip_low, clip_high, kernel):
+        """CLAHE of the ROI z-column box = (ystart, yend, xstart, xend), run by the block cache thread."""
+        ystart, yend, xstart, xend = box
+        return self.CLAHE(volume[:, ystart:yend, xstart:xend], clip_low, clip_high, kernel)
+
+    def on_clahe_ready(self, key):
+        if self.current_chan == "Target" and self.dropdown3.currentText() == "CLAHE" \
+           and not self.FC_button.isChecked():
+            self.request_plot()
+
 
     ################################## Update Plot #######################################
 
+    @trace.traced(cat='gui')
     def plot_slice(self):
         """
         This function..
@@ -791,38 +1007,122 @@ You are viewing the 8x downsampled of fused.h5 file. ")
         - plot current slice (selected z-level)
 
         """
-        current_slice = self.img[self.current_z_level, :, :]
         if self.current_chan == "Target":
             selected_method = self.dropdown3.currentText()
         else:
             selected_method = "Rescale"
 
         if selected_method == "Rescale":
-            current_slice = self.Rescale(current_slice)
-        elif selected_method == "CLAHE":
+            # Zoomed in: the visible window of a finer level instead of the preview slice.
+            # Both go through the prefetcher, which reads the next z-levels ahead of the scroll.
+            level = self.display_level()
+            if level == 3:
+                name, volume, extent = self.current_chan, self.img, None
+                key = self.current_chan
+            else:
+                volume, extent = self.window_view(level)
+                name = (self.current_chan, level, volume.box)
+                key = "%s@%d" % (self.current_chan, level)
+
+            # Contrast only moves the color limits of the raw slice (or window), see fun.Rescale_clim
+            self.prefetcher.set_source(name, volume, fun.sliceRange)
+            with trace.span('read', cat='gui', channel=self.current_chan, z=self.current_z_level, level=level):
+                current_slice, slice_min, slice_max = self.prefetcher.get(self.current_z_level)
+            clim = fun.Rescale_clim(slice_min, slice_max, self.ClipLowLim, self.ClipHighLim)
+        elif selected_method in ("CLAHE", "CLAHE (fast 2D)"):
             xstart = int(self.x_limits[0])
-            xend = xstart + int(self.ROI_dim/4)
+            xend = xstart + int(float(self.ROI_dim)/self.fc_scale[2])
             ystart = int(self.y_limits[1])
-            yend = ystart + int(self.ROI_dim/4)
+            yend = ystart + int(float(self.ROI_dim)/self.fc_scale[1])
             self.x_limits = [xstart, xend]
             self.y_limits = [yend, ystart]
-            block = self.img[:,ystart:yend,xstart:xend]
-            block = self.CLAHE(block)
-            current_slice = np.zeros_like(current_slice)
-            current_slice[ystart:yend,xstart:xend] = block[self.current_z_level, :, :]
-
-        # Plot current slice
-        self.figure.clear()
-        self.vmax = 255
-        ax = self.figure.add_subplot(111)
-        ax.imshow(current_slice, cmap='gray', vmax=self.vmax)
-        ax.set_xlabel('X')
-        ax.set_ylabel('Y')
-        ax.set_title('Vol Preview')
-        ax.set_xlim(self.x_limits)  
-        ax.set_ylim(self.y_limits)  
-
-        self.canvas.draw()
+
+            box = (ystart, yend, xstart, xend)
+            clip_low, clip_high = int(self.ClipLowLim), int(self.ClipHighLim)
+            kernel = int(self.ROI_dim)//16
+            if selected_method == "CLAHE (fast 2D)":
+                # Only the shown plane, equalized on its own: fast enough to follow the clip limits.
+                # The exported ROIs still get the 3D CLAHE.
+                with trace.span('CLAHE2D', cat='gui'):
+                    plane = fun.CLAHE2D(self.img[self.current_z_level, ystart:yend, xstart:xend],
+                                        clip_low, clip_high, kernel)
+            else:
+                # The whole ROI column is equalized once per (ROI box, clip limits, kernel size),
+                # scrolling only indexes into it. Until it is ready, the plain rescaled slice is shown.
+                cache_key = (self.h5path, self.current_chan, box, clip_low, clip_high, kernel)
+                volume = self.img
+                block = self.clahe_cache.get(cache_key, lambda: self.clahe_block(volume, box, clip_low, clip_high, kernel))
+                plane = None if block is None else block[self.current_z_level, :, :]
+
+            current_slice = np.zeros(self.shape[1:], dtype=np.uint8)
+            if plane is None:
+                current_slice[ystart:yend,xstart:xend] = self.Rescale(self.img[self.current_z_level, ystart:yend, xstart:xend])
+                self.show_computing()
+            else:
+                current_slice[ystart:yend,xstart:xend] = plane
+                if self.loading_label.text() == "Computing CLAHE...":
+                    self.hide_text()
+            clim = (0, 255)
+            key = "CLAHE"
+            extent = None
+
+        # Plot current slice, only the image data and color limits are updated
+        with trace.span('draw', cat='gui', key=key):
+            self.renderer.show(key, current_slice, clim=clim, extent=extent,
+                               xlim=self.x_limits, ylim=self.y_limits)
+
+    ########################### Pyramid level for display ################################
+
+    def display_level(self):
+        """
+        Finest pyramid level whose pixels still map at least 1:1 to screen pixels
+        in the current view. Level 3 unless zoomed in.
+        """
+        ax = self.renderer.ax
+        if ax is None:
+            return 3
+        width = abs(self.x_limits[1] - self.x_limits[0])
+        height = abs(self.y_limits[0] - self.y_limits[1])
+        for level in sorted(self.scales):
+            if level >= 3:
+                break
+            ratio = self.scales[3] / self.scales[level]
+            if width*ratio[2] <= ax.bbox.width and height*ratio[1] <= ax.bbox.height:
+                return level
+        return 3
+
+    def level_volume(self, chan, level):
+        if level == 3:
+            return {"cyto": self.cyto, "nuc": self.nuc, "Target": self.pgp}[chan]
+        if (chan, level) not in self.volumes:
+            setup = {"cyto": 's00', "nuc": 's01', "Target": 's02'}[chan]
+            self.volumes[(chan, level)] = vol.LazyVolume(self.pool.dataset(self.h5path, setup, level),
+                                                         self.orient, cache_bytes=256*1024**2)
+        return self.volumes[(chan, level)]
+
+    def window_view(self, level):
+        """
+        Visible window of the current channel in pyramid `level`, as a vol.WindowView
+        (indexed by preview z-level), and its extent in (level 3) axis coordinates.
+        """
+        ratio = self.scales[3] / self.scales[level]
+        volume = self.level_volume(self.current_chan, level)
+
+        x0, x1 = sorted(self.x_limits)
+        y0, y1 = sorted(self.y_limits)
+        c0 = int(np.clip(np.floor((x0 + 0.5)*ratio[2]), 0, volume.shape[2] - 1))
+        c1 = int(np.clip(np.ceil((x1 + 0.5)*ratio[2]), c0 + 1, volume.shape[2]))
+        r0 = int(np.clip(np.floor((y0 + 0.5)*ratio[1]), 0, volume.shape[1] - 1))
+        r1 = int(np.clip(np.ceil((y1 + 0.5)*ratio[1]), r0 + 1, volume.shape[1]))
+
+        box = (r0, r1, c0, c1)
+        extent = (c0/ratio[2] - 0.5, c1/ratio[2] - 0.5, r1/ratio[1] - 0.5, r0/ratio[1] - 0.5)
+        # Same view object for the same window, the prefetcher keeps following it
+        view = self.window_views.get((self.current_chan, level))
+        if view is None or view.volume is not volume or view.box != box or view.nz != len(self.img):
+            view = vol.WindowView(volume, ratio[0], len(self.img), box)
+            self.window_views[(self.current_chan, level)] = view
+        return view, extent
 
     ############################## Print loading/saving ###################################
 
@@ -840,6 +1140,10 @@ You are viewing the 8x downsampled of fused.h5 file. ")
         self.loading_label.setStyleSheet("color: green;")
         QApplication.processEvents()
 
+    def show_computing(self):
+        self.loading_label.setText("Computing CLAHE...")
+        self.loading_label.setStyleSheet("color: blue;")
+
     def show_OutofBound(self):
         self.loading_label.setText("Out of bound! Don't save!")
         self.loading_label.setStyleSheet("color: red;")
@@ -858,18 +1162,13 @@ You are viewing the 8x downsampled of fused.h5 file. ")
         This function..
         - allows user select file to preview
         - record file path
-        - call the function: readHDF5 and plotinit
+        - call the function: load_sample (readHDF5 and plotinit, in a SampleLoader thread)
         """
         file_dialog = QFileDialog()
         # file_dialog.setDirectory("W:/Trilabel_Data")
         file_path, _ = file_dialog.getOpenFileName(self, "Select fused HDF5 File")
         if file_path:
-            self.h5path = file_path
-            print(self.h5path)
-            self.show_loading_data()
-            self.readHDF5()
-            self.plot_init_z()
-            self.hide_text()
+            self.load_sample(file_path)
         else: 
             #self.h5path = "W:\\Trilabel_Data\\PGP9.5\\OTLS4_NODO_6-7-23_16-043J_PGP9.5\\data-f0.h5"
             pass
@@ -897,6 +1196,7 @@ You are viewing the 8x downsampled of fused.h5 file. ")
         self.plot_slice()
 
 
+    @trace.traced(cat='gui')
     def save_coords(self):
         """
         This function..
@@ -905,11 +1205,11 @@ You are viewing the 8x downsampled of fused.h5 file. ")
         """
         self.show_saving()
 
-        xcoord   = int(self.x_limits[0]*4)
-        ycoord   = int(self.y_limits[1]*4)
-        currentZ = int(self.current_z_level*4)
+        xcoord   = int(self.x_limits[0]*self.fc_scale[2])
+        ycoord   = int(self.y_limits[1]*self.fc_scale[1])
+        currentZ = int(self.current_z_level*self.fc_scale[0])
         ROI_dim = int(self.ROI_dim)
-        no_of_layers = int(float(self.no_of_layer)*4)
+        no_of_layers = int(float(self.no_of_layer)*self.fc_scale[0])
         orient = int(self.orient)
         shape    = self.arrayshape_textbox.text()
         cyto_clipLow  = self.ClipLowLim_cyto.value()
@@ -919,6 +1219,8 @@ You are viewing the 8x downsampled of fused.h5 file. ")
         pgp_clipLow   = self.ClipLowLim_pgp.value()
         pgp_clipHigh  = self.ClipHighLim_pgp.value()
         pgp_ctehmt_method = self.dropdown3.currentText()
+        if pgp_ctehmt_method == "CLAHE (fast 2D)":
+            pgp_ctehmt_method = "CLAHE" # preview only, the training ROIs get the 3D CLAHE
         note = self.note_textbox.text()
         h5path = self.h5path
         Abhome = self.Ab_home
@@ -949,6 +1251,16 @@ You are viewing the 8x downsampled of fused.h5 file. ")
         print("saved")
 
 
+    def closeEvent(self, event):
+        self.cancel_loading(wait=True)
+        print(self.prefetcher.report())
+        print(self.clahe_cache.report())
+        self.prefetcher.stop()
+        self.clahe_cache.stop()
+        self.pool.close()
+        super().closeEvent(event)
+
+
     #################################
     ######## Shortcut Key############
     #################################
@@ -975,7 +1287,8 @@ You are viewing the 8x downsampled of fused.h5 file. ")
 
 
 
-app = QApplication([])
-w = MainWindow()
-w.show()
-app.exec()
+if __name__ == "__main__":
+    app = QApplication([])
+    w = MainWindow()
+    w.show()
+    app.exec()
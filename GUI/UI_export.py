@@ -0,0 +1,340 @@
+import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import tifffile
+
+import UI_function as fun
+
+
+######################### Pipelined false-color export ###################################
+
+def colorSlab(nuclei, cyto, nuc_levels, cyto_levels, nuc_settings, cyto_settings, kwargs):
+    """Worker: false color one [z, y, x] slab, runs in a pool process."""
+    return fun.rapidFalseColor3D(nuclei, cyto, nuc_settings, cyto_settings,
+                                 nuc_levels=nuc_levels, cyto_levels=cyto_levels, **kwargs)
+
+
+def defaultWorkers():
+    """All cores but one, which is left to the reader and writer threads (0, no pool, on a single core)."""
+    return max(0, (os.cpu_count() or 1) - 1)
+
+
+class FCExportPipeline:
+    """
+    Three-stage read -> false color -> write pipeline for full-volume FC exports.
+
+    - reader thread : read(z0, z1) returns (nuclei, cyto, nuc_levels, cyto_levels) for a slab
+    - worker pool   : `workers` processes run rapidFalseColor3D on the slabs
+    - writer thread : write(z0, rgb) gets every colored [z, y, x, 3] slab, in z order
+
+    The stages are connected by one-slab queues and at most one slab per worker is being
+    colored, so no more than `max_slabs` slabs (workers + 4) are in memory at any time,
+    whatever the size of the volume: size the slabs as memory budget / max_slabs. With
+    workers=0 the slabs are colored in the calling thread, without a process pool.
+
+    Parameters
+    ----------
+
+    read, write : callables
+        Slab reader and writer, called from their own threads.
+
+    nuc_settings, cyto_settings : list
+        False coloring settings, e.g. HE_settings['nuclei'], HE_settings['cyto'].
+
+    workers : int
+        Number of false coloring processes, defaults to defaultWorkers().
+
+    **kwargs :
+        Passed on to rapidFalseColor3D (nuc_normfactor, cyto_normfactor, ...).
+
+    """
+
+    def __init__(self, read, write, nuc_settings, cyto_settings, workers=None, **kwargs):
+        self.read = read
+        self.write = write
+        self.nuc_settings = nuc_settings
+        self.cyto_settings = cyto_settings
+        self.workers = defaultWorkers() if workers is None else int(workers)
+        self.max_pending = max(1, self.workers)
+        # Slab being read, read queue, slabs being colored, write queue, slab being written
+        self.max_slabs = self.max_pending + 4
+        self.kwargs = kwargs
+        self._cancel = threading.Event()
+        self._stop = threading.Event()
+
+    def run(self, slabs, progress=None):
+        """
+        Export every (z0, z1) slab of `slabs`. progress(n) is called from the writer
+        thread with the number of z-planes written. Errors of any stage are re-raised here.
+        """
+        read_q = queue.Queue(maxsize=1)
+        write_q = queue.Queue(maxsize=1)
+        stop = self._stop = threading.Event()
+        if self._cancel.is_set():
+            stop.set()
+        errors = []
+
+        reader = threading.Thread(target=self._read_all, args=(list(slabs), read_q, stop, errors),
+                                  name="FCExportReader", daemon=True)
+        writer = threading.Thread(target=self._write_all, args=(write_q, stop, errors, progress),
+                                  name="FCExportWriter", daemon=True)
+        reader.start()
+        writer.start()
+
+        pool = ProcessPoolExecutor(self.workers) if self.workers > 0 else None
+        pending = deque()
+        try:
+            while not stop.is_set():
+                item = self._get(read_q, stop)
+                if item is None:
+                    break
+                z0, data = item
+                args = data + (self.nuc_settings, self.cyto_settings, self.kwargs)
+                if pool is None:
+                    pending.append((z0, _Result(colorSlab(*args))))
+                else:
+                    pending.append((z0, pool.submit(colorSlab, *args)))
+                while len(pending) >= self.max_pending and not stop.is_set():
+                    z, result = pending.popleft()
+                    self._put(write_q, (z, result.result()), stop)
+            while pending and not stop.is_set():
+                z, result = pending.popleft()
+                self._put(write_q, (z, result.result()), stop)
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            self._put(write_q, None, stop)
+            writer.join()
+            stop.set()
+            reader.join()
+            if pool is not None:
+                for _, result in pending:
+                    result.cancel()
+                pool.shutdown(wait=True)
+
+        if errors:
+            raise errors[0]
+
+    def cancel(self):
+        """Stop a running export (from any thread): run() returns once its stages have stopped."""
+        self._cancel.set()
+        self._stop.set()
+
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    ######## Internals ########
+
+    def _read_all(self, slabs, read_q, stop, errors):
+        try:
+            for z0, z1 in slabs:
+                if stop.is_set():
+                    return
+                self._put(read_q, (z0, tuple(self.read(z0, z1))), stop)
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            self._put(read_q, None, stop)
+
+    def _write_all(self, write_q, stop, errors, progress):
+        try:
+            while True:
+                item = self._get(write_q, stop)
+                if item is None:
+                    return
+                z0, rgb = item
+                self.write(z0, rgb)
+                if progress is not None:
+                    progress(len(rgb))
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+
+    @staticmethod
+    def _put(q, item, stop):
+        # Blocking put that gives up once the pipeline is stopped (the None sentinel always goes through)
+        while True:
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                if stop.is_set():
+                    if item is None:
+                        try:
+                            q.get_nowait()
+                        except queue.Empty:
+                            pass
+                        continue
+                    return
+
+    @staticmethod
+    def _get(q, stop):
+        while True:
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                if stop.is_set():
+                    return None
+
+
+class _Result:
+    """Stand-in for a Future when the slab was colored in the calling thread."""
+
+    def __init__(self, value):
+        self.value = value
+
+    def result(self):
+        return self.value
+
+
+######################### Export writers #################################################
+
+class TiffFilesWriter:
+    """One uncompressed TIFF per z-level: <folder>/<name>_<z>.tiff."""
+
+    def __init__(self, folder, name):
+        self.folder = folder
+        self.name = name
+
+    def write(self, z0, rgb):
+        for z, frame in enumerate(rgb, z0):
+            tifffile.imwrite(self.folder + os.sep + self.name + "_" + str(z) + ".tiff", frame)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TiffStackWriter:
+    """
+    Streams the planes of an export into a single BigTIFF/OME-TIFF, as one [z, y, x, rgb] series.
+
+    write(z0, rgb) has the signature of an FCExportPipeline writer. The file is opened once,
+    on the first slab, and tifffile encodes the planes as they arrive: write() returns when
+    its slab is in the file, so no more than one slab is held here.
+
+    Parameters
+    ----------
+
+    path : str
+        Output file, e.g. '<folder>/<name>.ome.tif'.
+
+    nz : int
+        Number of z-planes that will be written.
+
+    compression : str or None
+        'zlib', 'zstd', 'lzw' or None. zstd and lzw need the imagecodecs package.
+
+    tile : (int, int) or None
+        Tile shape in pixels (multiples of 16), None for strips.
+
+    """
+
+    def __init__(self, path, nz, compression='zlib', tile=None, ome=True):
+        self.path = path
+        self.nz = int(nz)
+        self.compression = compression
+        self.tile = tuple(tile) if tile else None
+        self.ome = ome
+        self._queue = queue.Queue(maxsize=1)
+        self._thread = None
+        self._error = None
+        self._next = 0
+
+    def write(self, z0, rgb):
+        if z0 != self._next:
+            raise ValueError("Slabs must be written in z order, expected z = %d, got %d" % (self._next, z0))
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, args=((self.nz,) + rgb.shape[1:],),
+                                            name="TiffStackWriter", daemon=True)
+            self._thread.start()
+        self._put(rgb)
+        self._wait()
+        if self._error is not None:
+            raise self._error
+        self._next += len(rgb)
+
+    def close(self):
+        """Finish the file. Raises if fewer than nz planes were written (unless closing after an error)."""
+        if self._thread is not None:
+            self._put(None)
+            self._thread.join()
+            self._thread = None
+        if self._error is not None and self._next < self.nz:
+            raise ValueError("%s: only %d of %d z-planes were written" % (self.path, self._next, self.nz)) from self._error
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.close()
+        except Exception:
+            if exc_type is None:
+                raise
+
+    ######## Internals ########
+
+    def _wait(self):
+        # Until the slab is encoded and written (or the writing thread is gone)
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks and self._thread.is_alive():
+                self._queue.all_tasks_done.wait(0.1)
+
+    def _put(self, item):
+        while self._thread.is_alive():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+        if self._error is not None:
+            raise self._error
+
+    def _run(self, shape):
+        try:
+            with tifffile.TiffWriter(self.path, bigtiff=True, ome=self.ome) as tif:
+                tif.write(self._segments(shape), shape=shape, dtype=np.uint8,
+                          photometric='rgb', tile=self.tile, compression=self.compression,
+                          metadata={'axes': 'ZYXS'})
+        except Exception as e:
+            self._error = e
+        finally:
+            # Unblock a writer waiting on a slab that will never be consumed
+            while True:
+                try:
+                    self._queue.get_nowait()
+                    self._queue.task_done()
+                except queue.Empty:
+                    break
+
+    def _segments(self, shape):
+        # Planes, or tiles of every plane in row-major order, as tifffile expects them
+        while True:
+            rgb = self._queue.get()
+            if rgb is None:
+                self._queue.task_done()
+                return
+            try:
+                for plane in rgb:
+                    if self.tile is None:
+                        yield plane
+                    else:
+                        for y in range(0, shape[1], self.tile[0]):
+                            for x in range(0, shape[2], self.tile[1]):
+                                yield plane[y:y + self.tile[0], x:x + self.tile[1]]
+            finally:
+                self._queue.task_done()
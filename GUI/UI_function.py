@@ -1,5 +1,10 @@
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from skimage.exposure import equalize_adapthist, rescale_intensity
+try:
+    import cv2
+except ImportError: # fast CLAHE falls back on skimage
+    cv2 = None
 
 
 
@@ -11,15 +16,136 @@ from skimage.exposure import equalize_adapthist, rescale_intensity
 
 ######################### False coloring helper functions ###############################
 
-def getBackgroundLevels(image, threshold=50):
-    image_DS = np.sort(image, axis=None)
-    foreground_vals = image_DS[np.where(image_DS > threshold)]
-    hi_val = foreground_vals[int(np.round(len(foreground_vals)*0.95))]
+def getBackgroundLevels(image, threshold=50, per_slice=False, levels=None):
+    """
+    95th percentile of the foreground (pixels above threshold) and the background level (1/5 of it).
+
+    Gives the same values as indexing the fully sorted foreground, in O(n): a histogram
+    for uint8/uint16 images, a partial sort (np.partition) for anything else.
+    With per_slice=True, image is a [z, y, x] stack and both levels are returned as arrays
+    with one entry per z-slice.
+    With levels (e.g. from FC_rescale_lut), image holds integer codes and the levels of
+    levels[image] are returned, from a histogram of the codes. Per slice, levels may also
+    hold one row per z-slice, and all slices are counted in a single pass over the stack.
+    Float stacks are still partially sorted one slice at a time.
+    """
+    image = np.asarray(image)
+    if levels is None and (image.dtype == np.uint8 or image.dtype == np.uint16):
+        # Per slice the counts are [z, level], so only the levels up to the maximum are kept
+        top = int(image.max()) if per_slice and image.size else np.iinfo(image.dtype).max
+        levels = np.arange(top + 1, dtype=image.dtype)
+
+    if per_slice:
+        if levels is None:
+            hi_vals = np.array([getBackgroundLevels(frame, threshold)[0] for frame in image])
+        else:
+            hi_vals = _sliceBackgroundLevels(image, threshold, levels)
+        return hi_vals, hi_vals / 5
+
+    if levels is not None:
+        levels = np.asarray(levels)
+        counts = _codeCounts(image, len(levels))
+        if np.any(levels[1:] < levels[:-1]):
+            order = np.argsort(levels, kind='stable')
+            levels, counts = levels[order], counts[order]
+        foreground = levels > threshold
+        cumulative = np.cumsum(counts[foreground])
+        n = int(cumulative[-1]) if len(cumulative) else 0
+        k = int(np.round(n*0.95))
+        if k >= n:
+            raise IndexError("index %d is out of bounds for axis 0 with size %d" % (k, n))
+        hi_val = levels[foreground][np.searchsorted(cumulative, k, side='right')]
+    else:
+        foreground_vals = image[image > threshold]
+        n = len(foreground_vals)
+        k = int(np.round(n*0.95))
+        if k >= n:
+            raise IndexError("index %d is out of bounds for axis 0 with size %d" % (k, n))
+        hi_val = np.partition(foreground_vals, k)[k]
     background = hi_val / 5
 
     return hi_val, background
 
 
+def _sliceBackgroundLevels(codes, threshold, levels):
+    """95th percentile level of every z-slice of a code stack, levels: one table or one row per slice."""
+    counts = _codeCounts(codes, np.shape(levels)[-1], per_slice=True)
+    levels = np.broadcast_to(levels, counts.shape)
+    if np.any(levels[:, 1:] < levels[:, :-1]):
+        order = np.argsort(levels, axis=1, kind='stable')
+        levels = np.take_along_axis(levels, order, axis=1)
+        counts = np.take_along_axis(counts, order, axis=1)
+
+    # Background levels count as 0, so the first level past k is a foreground one
+    cumulative = np.cumsum(np.where(levels > threshold, counts, 0), axis=1)
+    n = cumulative[:, -1]
+    k = np.round(n*0.95).astype(np.int64)
+    if np.any(k >= n):
+        z = int(np.argmax(k >= n))
+        raise IndexError("index %d is out of bounds for axis 0 with size %d" % (k[z], n[z]))
+    # Row-wise searchsorted(cumulative[z], k[z], side='right')
+    index = np.count_nonzero(cumulative <= k[:, None], axis=1)
+    return levels[np.arange(len(levels)), index]
+
+
+def _codeCounts(codes, nlevels, per_slice=False):
+    # Histogram in blocks of 1M pixels, bincount's int64 copy of the input stays small.
+    # Per slice, a code of slice z goes to bin z*nlevels + code and the [z, nlevels] counts are returned
+    values = codes.ravel()
+    if not per_slice:
+        counts = np.zeros(nlevels, dtype=np.int64)
+        for i in range(0, values.size, 1 << 20):
+            counts += np.bincount(values[i:i + (1 << 20)], minlength=nlevels)[:nlevels]
+        return counts
+
+    # Blocks of whole slices (or of 1M-pixel pieces of one slice), offset by a [slices, 1] column
+    planes = values.reshape(len(codes), -1)
+    nslices = max(1, (1 << 20) // max(planes.shape[1], 1))
+    counts = np.zeros((len(codes), nlevels), dtype=np.int64)
+    for z in range(0, len(planes), nslices):
+        offsets = (np.arange(len(planes[z:z + nslices]), dtype=np.intp) * nlevels)[:, None]
+        for i in range(0, planes.shape[1], 1 << 20):
+            block = np.add(planes[z:z + nslices, i:i + (1 << 20)], offsets, dtype=np.intp)
+            counts[z:z + nslices] += np.bincount(block.ravel(), minlength=offsets.size * nlevels
+                                                 )[:offsets.size * nlevels].reshape(-1, nlevels)
+    return counts
+
+
+def autoClipLimits(image, low_divisor, threshold=50, percentile=99, gain=1.35):
+    """
+    Auto Rescale clip limits of a slice: (getBackgroundLevels(image)[0]/low_divisor,
+    np.percentile(image, percentile)*gain).
+
+    Both come from a single histogram of the slice for uint8/uint16 images, instead of
+    a sort for the percentile and another pass for the background level.
+    """
+    image = np.asarray(image)
+    if not (image.dtype == np.uint8 or image.dtype == np.uint16):
+        hi_val = getBackgroundLevels(image, threshold)[0]
+        return hi_val/low_divisor, np.percentile(image, percentile)*gain
+
+    counts = _codeCounts(image, np.iinfo(image.dtype).max + 1)
+    cumulative = np.cumsum(counts)
+
+    # np.percentile (linear interpolation) from the sorted values at two ranks
+    pos = (percentile/100)*(cumulative[-1] - 1)
+    below = int(np.floor(pos))
+    lo, hi = np.searchsorted(cumulative, [below, below + 1], side='right')
+    if below + 1 >= cumulative[-1]:
+        hi = lo
+    p_val = lo + (pos - below)*(int(hi) - int(lo))
+
+    # getBackgroundLevels: 95th percentile of the pixels above threshold
+    foreground = cumulative[threshold + 1:] - cumulative[threshold]
+    n = int(foreground[-1]) if len(foreground) else 0
+    k = int(np.round(n*0.95))
+    if k >= n:
+        raise IndexError("index %d is out of bounds for axis 0 with size %d" % (k, n))
+    hi_val = threshold + 1 + np.searchsorted(foreground, k, side='right')
+
+    return hi_val/low_divisor, p_val*gain
+
+
 def FC_rescale(image, ClipLow, ClipHigh):
     
     Img_rescale = rescale_intensity(np.clip(image, ClipLow, ClipHigh)
@@ -29,6 +155,37 @@ def FC_rescale(image, ClipLow, ClipHigh):
     return Img_rescale
 
 
+def FC_rescale_lut(image, ClipLow, ClipHigh, per_slice=False):
+    """
+    FC_rescale for integer images, in quantized form.
+
+    Returns (codes, levels): a uint16 code image and the rescaled value of every code,
+    with levels[codes] == FC_rescale(image, ClipLow, ClipHigh). rapidFalseColor takes
+    both and works on per-level lookup tables instead of per-pixel floats.
+    With per_slice=True, image is a [z, y, x] stack, levels has one row per z-slice and
+    levels[z][codes[z]] == FC_rescale(image[z], ClipLow, ClipHigh).
+    """
+    # Codes cover the whole integers around the clipped range, values are the clipped
+    # integers themselves: fractional clip limits end up in the first and last values
+    base = int(np.floor(np.clip(image.min(), ClipLow, ClipHigh)))
+    top = int(np.ceil(np.clip(image.max(), ClipLow, ClipHigh)))
+    codes = (np.clip(image, base, top) - base).astype(np.uint16)
+    values = np.clip(np.arange(base, top + 1).astype(image.dtype), ClipLow, ClipHigh)
+    if per_slice:
+        # Every slice is stretched from its own min to its own max, over the codes of the whole stack
+        levels = np.stack([rescale_intensity(values,
+                                             in_range=(values[frame.min()], values[frame.max()]),
+                                             out_range=(0,10000)
+                                             ) for frame in codes])
+    else:
+        levels = rescale_intensity(values,
+                                   in_range=(values[0], values[-1]),
+                                   out_range=(0,10000)
+                                   )
+
+    return codes, levels
+
+
 def rapidFieldDivision(image, flat_field):
     """Used for rapidFalseColoring() when flat field has been calculated."""
     output = np.divide(image, flat_field, where=(flat_field != 0))
@@ -54,7 +211,28 @@ def rapidFalseColor(nuclei, cyto, nuc_settings, cyto_settings,
                     run_FlatField_nuc=False, 
                     run_FlatField_cyto=False,
                     nuc_bg_threshold=50, 
-                    cyto_bg_threshold=50):
+                    cyto_bg_threshold=50,
+                    nuc_levels=None,
+                    cyto_levels=None,
+                    out=None):
+    """
+    Exponential false coloring of a nuclei/cyto pair, returns an RGB uint8 image.
+
+    Quantized inputs (codes with nuc_levels/cyto_levels from FC_rescale_lut, or raw
+    unsigned integer images) use the factorization 255*exp(-a*nuc)*exp(-b*cyto): the
+    background subtraction and both exponentials are 1D lookup tables over the levels,
+    so each RGB channel costs two lookups and a product. Float inputs are colored per pixel.
+    Both write straight into the uint8 output (out, if given), within 1 LSB of each other.
+    Stacks are colored as one image, with a single background level; see rapidFalseColor3D.
+    """
+    out = _checkOutput(out, np.shape(nuclei))
+    if (nuc_levels is not None or np.asarray(nuclei).dtype.kind == 'u') and \
+       (cyto_levels is not None or np.asarray(cyto).dtype.kind == 'u'):
+        return _lutFalseColor(nuclei, cyto, nuc_settings, cyto_settings,
+                              nuc_normfactor, cyto_normfactor,
+                              run_FlatField_nuc, run_FlatField_cyto,
+                              nuc_bg_threshold, cyto_bg_threshold,
+                              nuc_levels, cyto_levels, out)
 
     nuclei = np.ascontiguousarray(nuclei, dtype=float)
     cyto = np.ascontiguousarray(cyto, dtype=float)
@@ -74,14 +252,163 @@ def rapidFalseColor(nuclei, cyto, nuc_settings, cyto_settings,
         cyto_background = getBackgroundLevels(cyto, threshold=cyto_bg_threshold)[1]
         cyto = rapidPreProcess(cyto, cyto_background, cyto_normfactor)
 
-    output_global = np.zeros((3, nuclei.shape[0], nuclei.shape[1]), dtype=np.uint8)
+    RGB_image = out
     for i in range(3):
-        output_global[i] = rapidGetRGBframe(nuclei, cyto, nuc_settings[i], cyto_settings[i], k_nuclei, k_cyto)
+        RGB_image[..., i] = rapidGetRGBframe(nuclei, cyto, nuc_settings[i], cyto_settings[i], k_nuclei, k_cyto)
 
-    RGB_image = np.moveaxis(output_global, 0, -1).astype(np.uint8)
     return RGB_image
 
 
+def rapidFalseColor3D(nuclei, cyto, nuc_settings, cyto_settings,
+                      nuc_normfactor=3000, cyto_normfactor=8000,
+                      run_FlatField_nuc=False, 
+                      run_FlatField_cyto=False,
+                      nuc_bg_threshold=50, 
+                      cyto_bg_threshold=50,
+                      nuc_levels=None,
+                      cyto_levels=None,
+                      per_slice=True,
+                      out=None):
+    """
+    rapidFalseColor for [z, y, x] nuclei/cyto stacks, returns a [z, y, x, 3] uint8 volume.
+
+    per_slice : bool
+        True estimates the background of every z-slice on its own (same output as
+        rapidFalseColor slice by slice), False once for the whole stack. Quantized stacks
+        are colored in one pass through a [z, level, RGB] table; float stacks slice by slice.
+    nuc_levels, cyto_levels : array, optional
+        Levels from FC_rescale_lut, one table for the stack or one row per z-slice
+        (FC_rescale_lut(..., per_slice=True)).
+    out : uint8 array, optional
+        C-contiguous [z, y, x, 3] buffer to write into, e.g. reused from slab to slab.
+    """
+    nuclei = np.asarray(nuclei)
+    cyto = np.asarray(cyto)
+    out = _checkOutput(out, nuclei.shape)
+    kwargs = dict(nuc_normfactor=nuc_normfactor, cyto_normfactor=cyto_normfactor,
+                  run_FlatField_nuc=run_FlatField_nuc, run_FlatField_cyto=run_FlatField_cyto,
+                  nuc_bg_threshold=nuc_bg_threshold, cyto_bg_threshold=cyto_bg_threshold)
+
+    if not per_slice:
+        if np.ndim(nuc_levels) == 2 or np.ndim(cyto_levels) == 2:
+            raise ValueError("Per-stack background needs one levels table for the whole stack")
+        return rapidFalseColor(nuclei, cyto, nuc_settings, cyto_settings,
+                               nuc_levels=nuc_levels, cyto_levels=cyto_levels, out=out, **kwargs)
+
+    if (nuc_levels is not None or nuclei.dtype.kind == 'u') and \
+       (cyto_levels is not None or cyto.dtype.kind == 'u'):
+        return _lutFalseColor(nuclei, cyto, nuc_settings, cyto_settings,
+                              nuc_normfactor, cyto_normfactor,
+                              run_FlatField_nuc, run_FlatField_cyto,
+                              nuc_bg_threshold, cyto_bg_threshold,
+                              nuc_levels, cyto_levels, out, per_slice=True)
+
+    for z in range(len(nuclei)):
+        rapidFalseColor(nuclei[z], cyto[z], nuc_settings, cyto_settings,
+                        nuc_levels=_sliceLevels(nuc_levels, z),
+                        cyto_levels=_sliceLevels(cyto_levels, z),
+                        out=out[z], **kwargs)
+    return out
+
+
+def _sliceLevels(levels, z):
+    if levels is not None and np.ndim(levels) == 2:
+        return levels[z]
+    return levels
+
+
+def _checkOutput(out, shape):
+    """uint8 RGB buffer for an image of `shape`: out itself if it fits, a new array if out is None."""
+    shape = tuple(shape) + (3,)
+    if out is None:
+        return np.empty(shape, dtype=np.uint8)
+    if out.shape != shape or out.dtype != np.uint8 or not out.flags['C_CONTIGUOUS']:
+        raise ValueError("out must be a C-contiguous uint8 array of shape %s" % (shape,))
+    return out
+
+
+def _lutFalseColor(nuclei, cyto, nuc_settings, cyto_settings,
+                   nuc_normfactor, cyto_normfactor,
+                   run_FlatField_nuc, run_FlatField_cyto,
+                   nuc_bg_threshold, cyto_bg_threshold,
+                   nuc_levels, cyto_levels, out, per_slice=False):
+    """
+    rapidFalseColor on quantized inputs, through per-level lookup tables.
+
+    With per_slice=True, nuclei/cyto are [z, y, x] code stacks and every slice gets its own
+    background: the tables become [z, level, RGB] and slice z looks up rows z*nlevels + code.
+    """
+    nuclei = np.asarray(nuclei)
+    cyto = np.asarray(cyto)
+    if nuc_levels is None:
+        nuc_levels = np.arange(int(nuclei.max()) + 1)
+    if cyto_levels is None:
+        cyto_levels = np.arange(int(cyto.max()) + 1)
+    nuc_table = np.asarray(nuc_levels, dtype=float)
+    cyto_table = np.asarray(cyto_levels, dtype=float)
+    if per_slice:
+        nuc_table = np.broadcast_to(nuc_table, (len(nuclei), nuc_table.shape[-1]))
+        cyto_table = np.broadcast_to(cyto_table, (len(cyto), cyto_table.shape[-1]))
+
+    # Same constants and background subtraction as the per-pixel path, applied to the levels
+    k_nuclei = 1.0
+    k_cyto = 1.0
+    if not run_FlatField_nuc:
+        k_nuclei = 0.08
+        nuc_background = getBackgroundLevels(nuclei, threshold=nuc_bg_threshold, per_slice=per_slice, levels=nuc_table)[1]
+        if per_slice:
+            nuc_background = nuc_background[:, None]
+        nuc_table = rapidPreProcess(nuc_table, nuc_background, nuc_normfactor)
+
+    if not run_FlatField_cyto:
+        k_cyto = 0.012
+        cyto_background = getBackgroundLevels(cyto, threshold=cyto_bg_threshold, per_slice=per_slice, levels=cyto_table)[1]
+        if per_slice:
+            cyto_background = cyto_background[:, None]
+        cyto_table = rapidPreProcess(cyto_table, cyto_background, cyto_normfactor)
+
+    # [level, RGB] tables (per slice [z, level, RGB], flattened): 255*exp(-a*nuc) and exp(-b*cyto)
+    # (in place, the per-slice tables can be as large as the stack itself)
+    nuc_lut = np.multiply.outer(nuc_table, nuc_settings).reshape(-1, 3)
+    cyto_lut = np.multiply.outer(cyto_table, cyto_settings).reshape(-1, 3)
+    for lut, k in ((nuc_lut, k_nuclei), (cyto_lut, k_cyto)):
+        lut *= k
+        np.negative(lut, out=lut)
+        np.exp(lut, out=lut)
+    nuc_lut *= 255
+    plane = max(nuclei[0].size, 1) if per_slice and len(nuclei) else 1
+
+    # Look up all three channels at once, in blocks of 64k pixels to keep the float temporaries small
+    RGB_image = out
+    nuc_flat, cyto_flat, RGB_flat = nuclei.reshape(-1), cyto.reshape(-1), RGB_image.reshape(-1, 3)
+    for i in range(0, nuc_flat.size, 1 << 16):
+        nuc_rows, nuc_codes = nuc_lut, nuc_flat[i:i + (1 << 16)]
+        cyto_rows, cyto_codes = cyto_lut, cyto_flat[i:i + (1 << 16)]
+        if per_slice:
+            nuc_rows, nuc_codes = _sliceRows(nuc_lut, nuc_codes, i, plane, nuc_table.shape[-1])
+            cyto_rows, cyto_codes = _sliceRows(cyto_lut, cyto_codes, i, plane, cyto_table.shape[-1])
+        block = np.take(nuc_rows, nuc_codes, axis=0)
+        block *= np.take(cyto_rows, cyto_codes, axis=0)
+        RGB_flat[i:i + (1 << 16)] = block
+
+    return RGB_image
+
+
+def _sliceRows(lut, codes, start, plane, nlevels):
+    """
+    Table and indices for flat pixels start:start+len(codes) of a stack of `plane`-pixel slices,
+    lut holding the nlevels rows of every slice one after the other.
+    """
+    stop = start + len(codes)
+    z0, z1 = start // plane, (stop - 1) // plane
+    if z0 == z1:
+        # Within one slice: its own rows, the codes as they are
+        return lut[z0*nlevels:(z0 + 1)*nlevels], codes
+    bounds = np.clip(np.arange(z0, z1 + 2) * plane, start, stop)
+    offsets = np.repeat(np.arange(z0, z1 + 1, dtype=np.intp) * nlevels, np.diff(bounds))
+    return lut, np.add(codes, offsets, dtype=np.intp)
+
+
 ############################ Plot helper function ########################################
 
 def Rescale(current_slice, 
@@ -92,4 +419,58 @@ def Rescale(current_slice,
                                               ClipLowLim,
                                               ClipHighLim),
                                               out_range='uint8')
-    return current_slice
\ No newline at end of file
+    return current_slice
+
+
+def sliceRange(current_slice):
+    """Slice with its min and max, everything Rescale_clim needs to know about it."""
+    return current_slice, current_slice.min(), current_slice.max()
+
+
+def Rescale_clim(slice_min, slice_max, ClipLowLim, ClipHighLim):
+    """
+    Color limits for showing the raw slice so that it looks like Rescale(slice, ClipLowLim, ClipHighLim),
+    i.e. the clipped slice stretched from its own min to its own max.
+    """
+    vmin = max(ClipLowLim, slice_min)
+    vmax = min(ClipHighLim, slice_max)
+    if vmax <= vmin:
+        vmax = vmin + 1
+    return vmin, vmax
+
+
+############################ Fast 2D CLAHE preview #######################################
+
+def CLAHE2D(image, ClipLowLim, ClipHighLim, kernel, clip_limit=0.01, workers=None):
+    """
+    Per-slice 2D CLAHE of a [y, x] slice or a [z, y, x] stack, as uint8.
+
+    Preview stand-in for equalize_adapthist(np.clip(image, ClipLowLim, ClipHighLim),
+    kernel_size=kernel, clip_limit=clip_limit)*255: every slice is equalized on its own,
+    with kernel x kernel pixel tiles and the same 256-bin clip limit. Uses OpenCV
+    (cv2.createCLAHE) when it is installed and skimage otherwise; the slices of a stack
+    are spread over `workers` threads (OpenCV releases the GIL).
+    """
+    image = np.clip(image, int(ClipLowLim), int(ClipHighLim))
+    if image.ndim == 2:
+        return _CLAHE2D(image, kernel, clip_limit)
+
+    out = np.empty(image.shape, dtype=np.uint8)
+    def run(z):
+        out[z] = _CLAHE2D(image[z], kernel, clip_limit)
+    with ThreadPoolExecutor(workers) as pool:
+        list(pool.map(run, range(len(image))))
+    return out
+
+
+def _CLAHE2D(frame, kernel, clip_limit):
+    if cv2 is None:
+        return (equalize_adapthist(frame, kernel_size=kernel, clip_limit=clip_limit)*255).astype(np.uint8)
+
+    # Same input scaling as equalize_adapthist: min-max stretch, then 256 histogram bins
+    frame = rescale_intensity(frame, out_range='uint8')
+    h, w = frame.shape
+    tiles = (max(1, int(round(w / kernel))), max(1, int(round(h / kernel))))
+    # skimage clips bins at clip_limit * tile pixels, OpenCV at clipLimit * tile pixels / 256
+    clahe = cv2.createCLAHE(clipLimit=clip_limit*256, tileGridSize=tiles)
+    return clahe.apply(np.ascontiguousarray(frame))
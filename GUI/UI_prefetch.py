@@ -0,0 +1,279 @@
+import threading
+import time
+from collections import OrderedDict, deque
+
+
+######################### Background z-slice prefetcher ##################################
+
+class SlicePrefetcher:
+    """
+    Loads and contrast-maps the slices ahead of the scroll position in a background thread.
+
+    The prefetcher follows one source at a time (the active channel). Every scroll
+    event is reported with notify(); the direction and speed of the last few events
+    decide how many slices ahead are queued. get() returns a prefetched slice if there
+    is one and computes it on the spot otherwise.
+
+    Parameters
+    ----------
+
+    depth : int
+        Minimum number of slices to prefetch ahead of the current z-level.
+
+    max_depth : int
+        Maximum number of slices to prefetch ahead when scrolling fast.
+
+    horizon : float
+        Seconds of scrolling (at the current speed) to prefetch ahead.
+
+    max_slices : int
+        Number of mapped slices kept in memory.
+
+    """
+
+    def __init__(self, depth=4, max_depth=32, horizon=0.5, max_slices=96):
+        self.depth = depth
+        self.max_depth = max_depth
+        self.horizon = horizon
+        self.max_slices = max_slices
+
+        self.hits = 0
+        self.misses = 0
+
+        self._source = None
+        self._slices = OrderedDict()
+        self._pending = deque()
+        self._history = deque(maxlen=6)
+        self._cond = threading.Condition()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="SlicePrefetcher", daemon=True)
+        self._thread.start()
+
+    def set_source(self, name, volume, mapper, params=()):
+        """
+        Follow `volume` (indexable as [z, y, x]); slices are mapped with mapper(slice, *params).
+        Calling it again with the same arguments is a no-op, anything else drops the prefetched slices.
+        """
+        source = (name, volume, mapper, tuple(params))
+        with self._cond:
+            if self._source is not None and self._source[0] == name and \
+               self._source[1] is volume and self._source[2] == mapper and self._source[3] == source[3]:
+                return
+            self._source = source
+            self._slices.clear()
+            self._pending.clear()
+
+    def get(self, z):
+        """Return the mapped slice at z-level z."""
+        with self._cond:
+            source = self._source
+            key = (source[0], z, source[3])
+            if key in self._slices:
+                self._slices.move_to_end(key)
+                self.hits += 1
+                return self._slices[key]
+            self.misses += 1
+
+        mapped = self._map(source, z)
+        self._store(source, z, mapped)
+        return mapped
+
+    def notify(self, z):
+        """Record the new scroll position and queue the slices it is heading to."""
+        now = time.perf_counter()
+        with self._cond:
+            self._history.append((now, z))
+            if self._source is None or len(self._history) < 2:
+                return
+
+            (t0, z0), (t1, z1) = self._history[0], self._history[-1]
+            direction = 1 if z1 >= z0 else -1
+            if self._history[-2][1] != z1:
+                direction = 1 if z1 > self._history[-2][1] else -1
+            speed = abs(z1 - z0) / max(t1 - t0, 1e-3) # levels per second
+            ahead = int(min(self.max_depth, max(self.depth, speed*self.horizon)))
+
+            nz = len(self._source[1])
+            name, params = self._source[0], self._source[3]
+            self._pending.clear()
+            for step in range(1, ahead + 1):
+                zz = z + direction*step
+                if zz < 0 or zz >= nz:
+                    break
+                if (name, zz, params) not in self._slices:
+                    self._pending.append(zz)
+            self._cond.notify()
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def report(self):
+        return "Prefetch hit rate: %.1f%% (%d hits, %d misses)" % (100*self.hit_rate, self.hits, self.misses)
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        """Stop following the current source, e.g. before its file is closed."""
+        with self._cond:
+            self._source = None
+            self._slices.clear()
+            self._pending.clear()
+        self.reset_stats()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._pending.clear()
+            self._cond.notify()
+        self._thread.join(timeout=1)
+
+    ######## Internals ########
+
+    def _map(self, source, z):
+        name, volume, mapper, params = source
+        return mapper(volume[z, :, :], *params)
+
+    def _store(self, source, z, mapped):
+        with self._cond:
+            if self._source is not source:
+                return
+            self._slices[(source[0], z, source[3])] = mapped
+            self._slices.move_to_end((source[0], z, source[3]))
+            while len(self._slices) > self.max_slices:
+                self._slices.popitem(last=False)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and not self._pending:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                z = self._pending.popleft()
+                source = self._source
+                if source is None or (source[0], z, source[3]) in self._slices:
+                    continue
+            try:
+                mapped = self._map(source, z)
+            except Exception as e:
+                print("Prefetch failed at z =", z, ":", e)
+                continue
+            self._store(source, z, mapped)
+
+
+######################### Background block cache ########################################
+
+class BlockCache:
+    """
+    Results of an expensive computation on a block of the volume (e.g. CLAHE of the ROI
+    z-column), computed in a background thread and kept for as long as they fit.
+
+    get(key, compute) returns the cached result for key, or None after queuing compute()
+    for it; on_ready(key) is then called from the background thread once the result is
+    stored. Only the latest request is queued: a newer key replaces one that has not
+    started yet, so dragging a clip limit does not pile up computations.
+
+    Parameters
+    ----------
+
+    max_bytes : int
+        Total size of the cached results, the least recently used go first.
+
+    on_ready : callable
+        Called with the key of every result computed in the background.
+
+    """
+
+    def __init__(self, max_bytes=512 * 1024**2, on_ready=None):
+        self.max_bytes = max_bytes
+        self.on_ready = on_ready
+
+        self.hits = 0
+        self.misses = 0
+
+        self._results = OrderedDict()
+        self._nbytes = 0
+        self._pending = None
+        self._running_key = None
+        self._cond = threading.Condition()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="BlockCache", daemon=True)
+        self._thread.start()
+
+    def get(self, key, compute):
+        """Cached result for key, or None (compute() is queued unless it is already running)."""
+        with self._cond:
+            if key in self._results:
+                self._results.move_to_end(key)
+                self.hits += 1
+                return self._results[key]
+            self.misses += 1
+            if self._running_key != key:
+                self._pending = (key, compute)
+                self._cond.notify()
+            return None
+
+    def __contains__(self, key):
+        with self._cond:
+            return key in self._results
+
+    def report(self):
+        total = self.hits + self.misses
+        return "Block cache hit rate: %.1f%% (%d hits, %d misses)" % (100*self.hits/total if total else 0.0,
+                                                                       self.hits, self.misses)
+
+    def clear(self):
+        """Drop every result and the queued computation, e.g. before the file is closed."""
+        with self._cond:
+            self._results.clear()
+            self._nbytes = 0
+            self._pending = None
+        self.hits = 0
+        self.misses = 0
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._pending = None
+            self._cond.notify()
+        self._thread.join(timeout=1)
+
+    ######## Internals ########
+
+    def _store(self, key, result):
+        with self._cond:
+            if key in self._results:
+                self._nbytes -= getattr(self._results.pop(key), 'nbytes', 0)
+            self._results[key] = result
+            self._nbytes += getattr(result, 'nbytes', 0)
+            while self._nbytes > self.max_bytes and len(self._results) > 1:
+                _, old = self._results.popitem(last=False)
+                self._nbytes -= getattr(old, 'nbytes', 0)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and self._pending is None:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                key, compute = self._pending
+                self._pending = None
+                if key in self._results:
+                    continue
+                self._running_key = key
+            try:
+                result = compute()
+            except Exception as e:
+                print("Background computation failed:", e)
+                result = None
+            if result is not None:
+                self._store(key, result)
+            with self._cond:
+                self._running_key = None
+            if result is not None and self.on_ready is not None:
+                self.on_ready(key)
@@ -0,0 +1,163 @@
+import numpy as np
+
+
+######################### Persistent-artist slice renderer ###############################
+
+class SliceRenderer:
+    """
+    Keeps one Axes and one AxesImage per channel alive across redraws.
+
+    show() swaps the data and color limits of the existing image instead of clearing
+    the figure. The image only ever holds the visible window of the slice, decimated
+    to roughly one data pixel per screen pixel, so matplotlib never resamples a full
+    level. When the view (channel, limits, axis style) is unchanged, only the image is
+    redrawn and blitted onto the canvas; anything else triggers a full draw.
+
+    Parameters
+    ----------
+
+    figure : matplotlib Figure
+
+    canvas : FigureCanvas
+        Qt canvas the figure is drawn on.
+
+    """
+
+    def __init__(self, figure, canvas):
+        self.figure = figure
+        self.canvas = canvas
+        self.ax = None
+        self.images = {}
+        self.sources = {}
+        self.active = None
+        self._axis_on = None
+        self._drawn = False
+        self._in_show = False
+        self.canvas.mpl_connect('draw_event', self._on_draw)
+
+    def show(self, key, data, clim=None, cmap='gray', extent=None,
+             xlim=None, ylim=None, axis_on=True, title='Vol Preview'):
+        """
+        Display `data` as the image of channel `key`.
+
+        clim : (vmin, vmax) color limits, ignored for RGB data.
+        extent : (left, right, bottom, top) in data coordinates, defaults to the pixel grid.
+        xlim, ylim : view limits, the current limits are kept when None.
+        """
+        self._in_show = True
+        full_draw = not self._drawn
+        ax = self._axes()
+
+        if extent is None:
+            extent = (-0.5, data.shape[1] - 0.5, data.shape[0] - 0.5, -0.5)
+        extent = tuple(float(e) for e in extent)
+        old_extent = self.sources[key][1] if key in self.sources else None
+        self.sources[key] = (data, extent)
+
+        image = self.images.get(key)
+        if image is None:
+            image = ax.imshow(data[:1, :1], cmap=cmap, extent=extent, interpolation='nearest')
+            self.images[key] = image
+            if xlim is None:
+                xlim = extent[:2]
+            if ylim is None:
+                ylim = extent[2:]
+            full_draw = True
+        elif old_extent != extent:
+            full_draw = True
+        if clim is not None and data.ndim == 2:
+            image.set_clim(*clim)
+
+        if self.active is not key:
+            for k, im in self.images.items():
+                im.set_visible(k == key)
+            self.active = key
+            full_draw = True
+
+        if axis_on != self._axis_on:
+            if axis_on:
+                ax.axis('on')
+                ax.set_xlabel('X')
+                ax.set_ylabel('Y')
+                ax.set_title(title)
+            else:
+                ax.axis('off')
+                ax.set_title('')
+            self._axis_on = axis_on
+            full_draw = True
+
+        if xlim is not None and tuple(ax.get_xlim()) != tuple(xlim):
+            ax.set_xlim(xlim)
+            full_draw = True
+        if ylim is not None and tuple(ax.get_ylim()) != tuple(ylim):
+            ax.set_ylim(ylim)
+            full_draw = True
+
+        self._fit(key)
+        self._in_show = False
+
+        if full_draw:
+            self.canvas.draw()
+        else:
+            self._blit(image)
+        return image
+
+    def reset(self):
+        """Forget all artists, e.g. when a new sample with different shapes is loaded."""
+        self.figure.clear()
+        self.ax = None
+        self.images = {}
+        self.sources = {}
+        self.active = None
+        self._axis_on = None
+        self._drawn = False
+
+    ######## Internals ########
+
+    def _axes(self):
+        if self.ax is None:
+            self.ax = self.figure.add_subplot(111)
+            self.ax.set_autoscale_on(False)
+            self.ax.callbacks.connect('xlim_changed', self._on_lim_changed)
+            self.ax.callbacks.connect('ylim_changed', self._on_lim_changed)
+        return self.ax
+
+    def _fit(self, key):
+        """Put the visible window of the source data, decimated to the screen resolution, into the image."""
+        data, (left, right, bottom, top) = self.sources[key]
+        h, w = data.shape[:2]
+        sx = (right - left) / w
+        sy = (bottom - top) / h
+
+        x0, x1 = sorted(self.ax.get_xlim())
+        y0, y1 = sorted(self.ax.get_ylim())
+        c0, c1 = sorted(((x0 - left) / sx, (x1 - left) / sx))
+        r0, r1 = sorted(((y0 - top) / sy, (y1 - top) / sy))
+        c0 = int(np.clip(np.floor(c0), 0, w - 1))
+        c1 = int(np.clip(np.ceil(c1), c0 + 1, w))
+        r0 = int(np.clip(np.floor(r0), 0, h - 1))
+        r1 = int(np.clip(np.ceil(r1), r0 + 1, h))
+
+        bbox = self.ax.bbox
+        step = int(max(1, np.ceil(min((c1 - c0) / max(bbox.width, 1), (r1 - r0) / max(bbox.height, 1)))))
+        window = data[r0:r1:step, c0:c1:step]
+
+        image = self.images[key]
+        image.set_data(window)
+        image.set_extent((left + c0*sx, left + (c0 + window.shape[1]*step)*sx,
+                          top + (r0 + window.shape[0]*step)*sy, top + r0*sy))
+
+    def _blit(self, image):
+        # Only the image changed: redraw it (and the frame on top of it) and blit the axes box
+        self.ax.draw_artist(image)
+        for spine in self.ax.spines.values():
+            self.ax.draw_artist(spine)
+        self.canvas.blit(self.ax.bbox)
+
+    def _on_lim_changed(self, ax):
+        # Zoom/pan from the toolbar: refit the active image before the canvas redraws
+        if not self._in_show and self.active in self.sources:
+            self._fit(self.active)
+
+    def _on_draw(self, event):
+        self._drawn = True
@@ -0,0 +1,156 @@
+import os
+import json
+import time
+import atexit
+import functools
+import threading
+
+
+######################### Chrome / Perfetto trace events #################################
+#
+# Opt-in: set ROI_TRACE=<file.json> before starting the GUI or a script (or call start()).
+# Every span becomes a complete ("X") event of the Chrome trace-event format, appended
+# to the file as soon as it ends, so the trace survives a frozen or killed session.
+# Open the file in https://ui.perfetto.dev or chrome://tracing.
+#
+# Disabled, traced() returns the function itself and span() a shared no-op context
+# manager: nothing is recorded, timed or allocated.
+
+TRACE_ENV = 'ROI_TRACE'
+OWNER_ENV = 'ROI_TRACE_OWNER' # pid of the process that started the file
+
+_fd = None
+_named_threads = set()
+
+
+def enabled():
+    return _fd is not None
+
+
+def start(path):
+    """
+    Start a new trace file at `path` (truncated), for this process and the processes
+    it starts: they inherit the environment and append their events to the same file.
+    """
+    global _fd
+    stop()
+    _fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND, 0o644)
+    # JSON array format, the closing ] is optional for trace viewers
+    os.write(_fd, b'[\n')
+    os.environ[TRACE_ENV] = path
+    os.environ[OWNER_ENV] = str(os.getpid())
+    _named_threads.clear()
+
+
+def stop():
+    """Stop recording, the file stays readable as it is."""
+    global _fd
+    if _fd is not None:
+        os.close(_fd)
+        _fd = None
+
+
+def span(name, cat='roi', **args):
+    """
+    Context manager recording the time spent in its block as a span called `name`,
+    with `args` shown in the viewer: `with trace.span('read', channel='s00'): ...`
+    """
+    if _fd is None:
+        return _NULL_SPAN
+    return _Span(name, cat, args)
+
+
+def traced(name=None, cat='roi'):
+    """Decorator recording every call of the function as a span (the function name by default)."""
+    def decorate(func):
+        if _fd is None:
+            return func
+        label = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(label, cat):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+######## Internals ########
+
+class _Span:
+    __slots__ = ('name', 'cat', 'args', 'start')
+
+    def __init__(self, name, cat, args):
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter_ns()
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        _emit({'name': self.name, 'cat': self.cat, 'ph': 'X',
+               'ts': self.start / 1e3, 'dur': (end - self.start) / 1e3,
+               'args': self.args})
+        return False
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def _emit(event):
+    fd = _fd
+    if fd is None:
+        return
+    pid, tid = os.getpid(), threading.get_ident()
+    if (pid, 0) not in _named_threads:
+        # first event of a forked worker
+        _named_threads.add((pid, 0))
+        _metadata('process_name', pid, 0, os.path.basename(_main_name()))
+    if (pid, tid) not in _named_threads:
+        _named_threads.add((pid, tid))
+        _metadata('thread_name', pid, tid, threading.current_thread().name)
+    event['pid'], event['tid'] = pid, tid
+    # one write per event, O_APPEND keeps the events of concurrent processes whole
+    os.write(fd, (json.dumps(event, default=str) + ',\n').encode())
+
+
+def _metadata(kind, pid, tid, value):
+    os.write(_fd, (json.dumps({'name': kind, 'ph': 'M', 'pid': pid, 'tid': tid,
+                               'args': {'name': value}}) + ',\n').encode())
+
+
+def _main_name():
+    import __main__
+    return getattr(__main__, '__file__', None) or 'python'
+
+
+def _init_from_env():
+    # Already started by a parent process (e.g. the BatchROI.py workers): append.
+    # Otherwise start a new file.
+    global _fd
+    path = os.environ.get(TRACE_ENV)
+    if not path:
+        return
+    if os.environ.get(OWNER_ENV) is not None and os.path.exists(path):
+        _fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+    else:
+        start(path)
+
+
+_init_from_env()
+atexit.register(stop)
@@ -0,0 +1,571 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import itertools
+import threading
+from collections import OrderedDict
+
+import h5py as h5
+import numpy as np
+
+
+######################### Lazy HDF5 volume ###############################################
+
+class LazyVolume:
+    """
+    Read-only, ndarray-like view onto a fused HDF5 dataset.
+
+    Indexing only reads the HDF5 chunks that cover the requested z-plane or block.
+    Decompressed chunks are kept in a bounded LRU cache, so scrolling back and forth
+    or re-reading the same ROI does not go back to disk.
+
+    Parameters
+    ----------
+
+    dset : h5py Dataset
+        e.g. f['t00000']['s00']['3/cells']. The file must stay open while the
+        volume is in use.
+
+    orient : int
+        0 if the data is stored as [z, y, x], 1 if it is stored as [y, z, x]
+        (same convention as readHDF5). The volume is always indexed as [z, y, x].
+
+    cache_bytes : int
+        Upper bound for the decompressed chunk cache.
+
+    """
+
+    def __init__(self, dset, orient=0, cache_bytes=512 * 1024**2, dtype=np.uint16):
+        self.dset = dset
+        self.orient = int(orient)
+        self.dtype = np.dtype(dtype)
+        self.cache_bytes = int(cache_bytes)
+
+        # display axis i is stored axis self._axes[i]
+        self._axes = (1, 0, 2) if self.orient == 1 else (0, 1, 2)
+        self.shape = tuple(dset.shape[a] for a in self._axes)
+        self.ndim = 3
+        self.size = int(np.prod(self.shape))
+
+        # Contiguous (unchunked) datasets are treated as one z-plane per chunk
+        chunks = dset.chunks
+        if chunks is None:
+            chunks = list(dset.shape)
+            chunks[self._axes[0]] = 1
+        self.chunks = tuple(chunks)
+
+        self._cache = OrderedDict()
+        self._cached_bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[:, :, :]
+        if dtype is not None:
+            data = data.astype(dtype)
+        return data
+
+    def astype(self, dtype):
+        return self[:, :, :].astype(dtype)
+
+    def __getitem__(self, key):
+        slices, squeeze = self._normalize_key(key)
+
+        # Translate the display-order request into stored order and read it
+        stored = [None, None, None]
+        for i, a in enumerate(self._axes):
+            stored[a] = slices[i]
+        block = self._read_block(stored)
+        block = block.transpose(self._axes)
+
+        index = tuple(0 if s else slice(None) for s in squeeze)
+        return block[index]
+
+    def clear_cache(self):
+        with self._lock:
+            self._cache.clear()
+            self._cached_bytes = 0
+
+    ######## Internals ########
+
+    def _normalize_key(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            i = key.index(Ellipsis)
+            key = key[:i] + (slice(None),) * (3 - len(key) + 1) + key[i + 1:]
+        if len(key) > 3:
+            raise IndexError("too many indices for a 3D volume")
+        key = key + (slice(None),) * (3 - len(key))
+
+        slices = []
+        squeeze = []
+        for k, n in zip(key, self.shape):
+            if isinstance(k, (int, np.integer)):
+                k = int(k)
+                if k < 0:
+                    k += n
+                if k < 0 or k >= n:
+                    raise IndexError("index %d is out of bounds for axis with size %d" % (k, n))
+                slices.append((k, k + 1))
+                squeeze.append(True)
+            elif isinstance(k, slice):
+                start, stop, step = k.indices(n)
+                if step != 1:
+                    raise IndexError("LazyVolume only supports unit-step slices")
+                slices.append((start, max(start, stop)))
+                squeeze.append(False)
+            else:
+                raise IndexError("LazyVolume only supports integer and slice indexing")
+        return slices, squeeze
+
+    def _read_block(self, stored):
+        """Assemble the stored-order box `stored` ([(start, stop)] * 3) from cached chunks."""
+        out = np.zeros([b - a for a, b in stored], dtype=self.dtype)
+        if out.size == 0:
+            return out
+
+        ranges = [range(a // c, (b - 1) // c + 1) for (a, b), c in zip(stored, self.chunks)]
+        needed = [(i, j, k) for i in ranges[0] for j in ranges[1] for k in ranges[2]]
+
+        with self._lock:
+            missing = [idx for idx in needed if idx not in self._cache]
+            if missing:
+                self._load_chunks(missing)
+
+            for idx in needed:
+                chunk = self._cache[idx]
+                self._cache.move_to_end(idx)
+                origin = [i * c for i, c in zip(idx, self.chunks)]
+                src = []
+                dst = []
+                for (a, b), o, n in zip(stored, origin, chunk.shape):
+                    lo = max(a, o)
+                    hi = min(b, o + n)
+                    src.append(slice(lo - o, hi - o))
+                    dst.append(slice(lo - a, hi - a))
+                out[tuple(dst)] = chunk[tuple(src)]
+
+            self._evict()
+        return out
+
+    def _load_chunks(self, missing):
+        """Read the chunk-aligned bounding box of `missing` in one hyperslab and split it."""
+        lo = [min(idx[d] for idx in missing) for d in range(3)]
+        hi = [max(idx[d] for idx in missing) + 1 for d in range(3)]
+        box = tuple(slice(l * c, min(h * c, n))
+                    for l, h, c, n in zip(lo, hi, self.chunks, self.dset.shape))
+        data = self.dset[box].astype(self.dtype, copy=False)
+
+        for i in range(lo[0], hi[0]):
+            for j in range(lo[1], hi[1]):
+                for k in range(lo[2], hi[2]):
+                    if (i, j, k) in self._cache:
+                        continue
+                    rel = tuple(slice((x - l) * c, (x - l + 1) * c)
+                                for x, l, c in zip((i, j, k), lo, self.chunks))
+                    chunk = np.ascontiguousarray(data[rel])
+                    self._cache[(i, j, k)] = chunk
+                    self._cached_bytes += chunk.nbytes
+
+    def _evict(self):
+        while self._cached_bytes > self.cache_bytes and len(self._cache) > 1:
+            _, chunk = self._cache.popitem(last=False)
+            self._cached_bytes -= chunk.nbytes
+
+
+class WindowView:
+    """
+    Fixed [r0:r1, c0:c1] window of a finer pyramid level, indexed by preview (level 3)
+    z-levels like the preview volumes, so that a SlicePrefetcher can follow it while
+    zoomed in: view[z, :, :] is volume[min(int(z*zratio), nz - 1), r0:r1, c0:c1].
+
+    Parameters
+    ----------
+
+    volume : LazyVolume
+        The finer level, indexed as [z, y, x].
+
+    zratio : float
+        Level z-planes per preview z-plane.
+
+    nz : int
+        Number of preview z-levels.
+
+    box : (r0, r1, c0, c1)
+        The window, in pixels of `volume`.
+
+    """
+
+    def __init__(self, volume, zratio, nz, box):
+        self.volume = volume
+        self.zratio = zratio
+        self.nz = int(nz)
+        self.box = tuple(int(b) for b in box)
+
+    def __len__(self):
+        return self.nz
+
+    def __getitem__(self, key):
+        z = key[0] if isinstance(key, tuple) else key
+        r0, r1, c0, c1 = self.box
+        return self.volume[min(int(z*self.zratio), self.volume.shape[0] - 1), r0:r1, c0:c1]
+
+
+######################### Pooled HDF5 handles ############################################
+
+def _next_prime(n):
+    n = max(int(n), 2)
+    while any(n % d == 0 for d in range(2, int(n**0.5) + 1)):
+        n += 1
+    return n
+
+
+class H5HandlePool:
+    """
+    Long-lived, read-only h5py handles per sample, with cached dataset lookups.
+
+    Each (file, access profile) pair is opened once and kept open until close() is
+    called, so the HDF5 raw-data chunk cache survives between reads. The chunk cache
+    is sized from the chunk layout of the level-1 data:
+
+    - 'preview' : holds the chunks crossing one z-plane of a preview window
+                  (up to `preview_window` px on each side), for FC previews.
+    - 'export'  : holds the chunks crossing a full z-plane, so that consecutive
+                  z-planes of a slab export decompress every chunk only once.
+
+    """
+
+    PROFILES = ('preview', 'export')
+
+    def __init__(self, preview_window=2048, max_cache_bytes=1024**3):
+        self.preview_window = preview_window
+        self.max_cache_bytes = max_cache_bytes
+        self._files = {}
+        self._dsets = {}
+
+    def file(self, path, profile='preview'):
+        """Open (or reuse) the h5py File for `path` with the chunk cache of `profile`."""
+        if profile not in self.PROFILES:
+            raise ValueError("Unknown profile %r, expected one of %s" % (profile, self.PROFILES))
+        key = (path, profile)
+        if key not in self._files:
+            self._files[key] = h5.File(path, 'r', **self.cache_settings(path, profile))
+        return self._files[key]
+
+    def dataset(self, path, ch, level, profile='preview'):
+        """Dataset t00000/<ch>/<level>/cells of `path`, e.g. pool.dataset(h5path, 's00', 1)."""
+        key = (path, profile, ch, int(level))
+        if key not in self._dsets:
+            f = self.file(path, profile)
+            self._dsets[key] = f['t00000'][ch]['%d/cells' % int(level)]
+        return self._dsets[key]
+
+    def cache_settings(self, path, profile):
+        """rdcc_* keyword arguments for h5py.File, based on the chunk layout of level 1."""
+        with h5.File(path, 'r') as f:
+            setup = f['t00000']['s00']
+            level = '1/cells' if '1' in setup else sorted(setup.keys())[0] + '/cells'
+            dset = setup[level]
+            shape, chunks, itemsize = dset.shape, dset.chunks, dset.dtype.itemsize
+            ref_shape = setup['3/cells'].shape if '3' in setup else shape
+        if chunks is None:
+            return {}
+
+        # z-planes run along axis 1 for orient == 1 data (see readHDF5)
+        zaxis = 0 if ref_shape[0] < ref_shape[1] else 1
+        plane = [n for i, n in enumerate(shape) if i != zaxis]
+        plane_chunks = [c for i, c in enumerate(chunks) if i != zaxis]
+        if profile == 'preview':
+            plane = [min(n, self.preview_window) for n in plane]
+            nchunks = np.prod([-(-n // c) + 1 for n, c in zip(plane, plane_chunks)])
+            w0 = 0.75
+        else:
+            nchunks = np.prod([-(-n // c) for n, c in zip(plane, plane_chunks)])
+            w0 = 1.0 # chunks are read once per export, evict them as soon as they are used up
+
+        nbytes = int(min(self.max_cache_bytes, nchunks * np.prod(chunks) * itemsize))
+        return {'rdcc_nbytes': max(nbytes, 1024**2),
+                'rdcc_nslots': _next_prime(min(10 * nchunks, 1000003)),
+                'rdcc_w0': w0}
+
+    def close(self, path=None):
+        """Close all handles of `path`, or every handle when path is None."""
+        for key in [k for k in self._dsets if path is None or k[0] == path]:
+            del self._dsets[key]
+        for key in [k for k in self._files if path is None or k[0] == path]:
+            try:
+                self._files.pop(key).close()
+            except Exception as e:
+                print("Failed to close", key[0], ":", e)
+
+
+######################### Pyramid metadata ###############################################
+
+def pyramid_scales(f, setup='s00', orient=0):
+    """
+    Downsampling factor of every pyramid level relative to full resolution, per [z, y, x] axis
+    (same axis order as LazyVolume), e.g. {0: [1, 1, 1], 1: [2, 2, 2], ...}.
+
+    Factors come from the BigStitcher/BDV '<setup>/resolutions' table (one x, y, z row per level).
+    Levels without a row fall back to 2**level.
+    """
+    levels = sorted(int(k) for k in f['t00000'][setup].keys() if k.isdigit())
+    res = None
+    if setup in f and 'resolutions' in f[setup]:
+        res = np.asarray(f[setup]['resolutions'][()], dtype=float)
+
+    scales = {}
+    for level in levels:
+        if res is not None and level < len(res):
+            scale = res[level][::-1] # stored [z, y, x] order
+        else:
+            scale = np.full(3, 2.0**level)
+        if orient == 1:
+            scale = scale[[1, 0, 2]]
+        scales[level] = scale
+    return scales
+
+
+######################### Chunk-aligned export reads #####################################
+
+def chunk_aligned_slabs(nz, chunk_depth, planes):
+    """
+    (z0, z1) slabs covering nz z-planes, that never straddle a chunk boundary along z.
+
+    `planes` is the number of planes that fit the memory budget: slabs are whole chunks deep
+    (a multiple of chunk_depth) when it allows, otherwise the largest divisor of chunk_depth
+    that fits, so that each chunk is split over as few slabs as possible.
+    """
+    chunk_depth = max(1, int(chunk_depth))
+    planes = max(1, int(planes))
+    if planes >= chunk_depth:
+        depth = chunk_depth * (planes // chunk_depth)
+    else:
+        depth = max(d for d in range(1, planes + 1) if chunk_depth % d == 0)
+    return [(z0, min(z0 + depth, nz)) for z0 in range(0, nz, depth)]
+
+
+class ReadStats:
+    """
+    Chunk accounting for the hyperslab reads of an export.
+
+    record() counts the chunks a read has to decompress, i.e. every chunk the box
+    touches when the chunk cache does not help. report() compares that with the
+    minimum, every touched chunk decompressed exactly once.
+    """
+
+    def __init__(self):
+        self.reads = 0
+        self.chunk_reads = 0
+        self.bytes_read = 0
+        self.min_bytes = 0
+        self._seen = {}
+
+    def record(self, dset, box):
+        """Account for dset[box], box being a tuple of unit-step slices in stored order."""
+        self.reads += 1
+        chunks = dset.chunks or dset.shape
+        chunk_bytes = int(np.prod(chunks)) * dset.dtype.itemsize
+        ranges = []
+        for s, c, n in zip(box, chunks, dset.shape):
+            start, stop, _ = s.indices(n)
+            if stop <= start:
+                return
+            ranges.append(range(start // c, (stop - 1) // c + 1))
+
+        seen = self._seen.setdefault((dset.file.filename, dset.name), set())
+        for idx in itertools.product(*ranges):
+            self.chunk_reads += 1
+            self.bytes_read += chunk_bytes
+            if idx not in seen:
+                seen.add(idx)
+                self.min_bytes += chunk_bytes
+
+    @property
+    def ratio(self):
+        return self.bytes_read / self.min_bytes if self.min_bytes else 1.0
+
+    def report(self):
+        return "Read %.1f MB of chunks in %d reads, minimum %.1f MB (every chunk once): %.2fx" % \
+               (self.bytes_read / 1024**2, self.reads, self.min_bytes / 1024**2, self.ratio)
+
+
+######################### On-disk preview cache ##########################################
+
+class PreviewCache:
+    """
+    Sidecar copies of the preview (level 3) volumes of recently opened samples.
+
+    Every entry is a folder of the cache directory holding one uncompressed .npy file
+    per channel, already in [z, y, x] order, and a meta.json with the orientation,
+    shape and pyramid scales of the sample. Reopening the sample memory-maps the .npy
+    files: nothing is decompressed and the first frame only reads one plane.
+
+    Entries are keyed by the absolute path, size and mtime of the HDF5 file, so a
+    rewritten file gets a new entry. The least recently opened entries are deleted
+    once the cache holds more than max_bytes.
+
+    Parameters
+    ----------
+
+    root : str
+        Cache directory, defaults to $ROI_PREVIEW_CACHE or ~/.roi_preview_cache.
+
+    max_bytes : int
+        Upper bound for the size of the cache on disk.
+
+    """
+
+    SETUPS = ('s00', 's01', 's02')
+    LEVEL = 3
+
+    def __init__(self, root=None, max_bytes=16 * 1024**3):
+        self.root = root or os.environ.get('ROI_PREVIEW_CACHE') or \
+                    os.path.join(os.path.expanduser('~'), '.roi_preview_cache')
+        self.max_bytes = int(max_bytes)
+
+    def key(self, h5path):
+        st = os.stat(h5path)
+        ident = '%s|%d|%d' % (os.path.abspath(h5path), st.st_size, st.st_mtime_ns)
+        return hashlib.sha1(ident.encode()).hexdigest()[:20]
+
+    def load(self, h5path):
+        """
+        (meta, volumes) of h5path, volumes being read-only np.memmap [z, y, x] arrays
+        per setup ('s00', 's01', 's02'). None if the sample is not cached.
+        """
+        try:
+            entry = os.path.join(self.root, self.key(h5path))
+            with open(os.path.join(entry, 'meta.json')) as fp:
+                meta = json.load(fp)
+            volumes = {s: np.load(os.path.join(entry, s + '.npy'), mmap_mode='r') for s in self.SETUPS}
+        except (OSError, ValueError):
+            return None
+        if any(list(v.shape) != meta['shape'] for v in volumes.values()):
+            return None
+        meta['scales'] = {int(level): np.asarray(scale) for level, scale in meta['scales'].items()}
+        # Last use, for the LRU eviction
+        os.utime(os.path.join(entry, 'meta.json'))
+        return meta, volumes
+
+    def store(self, h5path, slab_bytes=64 * 1024**2, progress=None, cancel=None):
+        """
+        Write the entry of h5path (from its own file handle, so it can run in a background
+        thread). Returns the entry folder, or None if it would not fit the cache or the disk,
+        or if it was cancelled.
+
+        progress(setup, z_done, nz) is called after every slab of chunks written, and the
+        write stops (leaving nothing behind) as soon as cancel() returns True.
+        """
+        key = self.key(h5path)
+        entry = os.path.join(self.root, key)
+        if os.path.exists(entry):
+            return entry
+
+        with h5.File(h5path, 'r') as f:
+            dsets = [f['t00000'][s]['%d/cells' % self.LEVEL] for s in self.SETUPS]
+            shape = dsets[0].shape
+            orient = 0 if shape[0] < shape[1] else 1 # as in readHDF5
+            volumes = [LazyVolume(d, orient, cache_bytes=slab_bytes) for d in dsets]
+            nbytes = sum(v.size * v.dtype.itemsize for v in volumes)
+            os.makedirs(self.root, exist_ok=True)
+            if nbytes > self.max_bytes or nbytes > shutil.disk_usage(self.root).free - 1024**3:
+                return None
+            self.evict(self.max_bytes - nbytes)
+
+            tmp = tempfile.mkdtemp(prefix=key + '.', suffix='.tmp', dir=self.root)
+            try:
+                for s, volume in zip(self.SETUPS, volumes):
+                    out = np.lib.format.open_memmap(os.path.join(tmp, s + '.npy'), mode='w+',
+                                                    dtype=volume.dtype, shape=volume.shape)
+                    plane = volume.size // volume.shape[0] * volume.dtype.itemsize
+                    chunk_depth = volume.chunks[volume._axes[0]]
+                    for z0, z1 in chunk_aligned_slabs(volume.shape[0], chunk_depth, slab_bytes // plane):
+                        if cancel is not None and cancel():
+                            del out
+                            shutil.rmtree(tmp, ignore_errors=True)
+                            return None
+                        out[z0:z1] = volume[z0:z1]
+                        if progress is not None:
+                            progress(s, z1, volume.shape[0])
+                    out.flush()
+                    del out
+                scales = pyramid_scales(f, 's00', orient)
+                meta = {'h5path': os.path.abspath(h5path),
+                        'level': self.LEVEL,
+                        'orient': orient,
+                        'shape': list(volumes[0].shape),
+                        'dtype': volumes[0].dtype.str,
+                        'scales': {str(level): list(map(float, scale)) for level, scale in scales.items()}}
+                with open(os.path.join(tmp, 'meta.json'), 'w') as fp:
+                    json.dump(meta, fp, indent=1)
+                # Complete entries only: another process may have written it meanwhile
+                os.rename(tmp, entry)
+            except Exception:
+                shutil.rmtree(tmp, ignore_errors=True)
+                if not os.path.exists(entry):
+                    raise
+        return entry
+
+    def evict(self, max_bytes=None):
+        """Delete the least recently opened entries until the cache holds at most max_bytes."""
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = []
+        for name in os.listdir(self.root) if os.path.isdir(self.root) else []:
+            path = os.path.join(self.root, name)
+            if name.endswith('.tmp'):
+                # left over by a session closed while writing
+                if time.time() - os.path.getmtime(path) > 24 * 3600:
+                    shutil.rmtree(path, ignore_errors=True)
+                continue
+            try:
+                used = os.path.getmtime(os.path.join(path, 'meta.json'))
+            except OSError:
+                continue
+            size = sum(e.stat().st_size for e in os.scandir(path) if e.is_file())
+            entries.append((used, size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= max_bytes:
+                break
+            # An entry still memory-mapped (e.g. on Windows) cannot go, try the next one
+            shutil.rmtree(path, ignore_errors=True)
+            if not os.path.exists(path):
+                total -= size
+        return total
+
+
+def open_preview(pool, h5path, cache=None):
+    """
+    The preview (level 3) volumes of a sample, as the GUI shows them.
+
+    From the PreviewCache when the sample is in it (memory-mapped arrays), otherwise
+    LazyVolumes over the datasets of `pool`, which only read the chunks they are asked for.
+
+    Returns
+    -------
+
+    sample : dict
+        'orient', 'scales' (see pyramid_scales), 'volumes' ({'s00': cyto, 's01': nuclei,
+        's02': target}, indexed [z, y, x]) and 'cached' (True if read from the cache).
+
+    """
+    if cache is not None:
+        hit = cache.load(h5path)
+        if hit is not None:
+            meta, volumes = hit
+            return {'orient': meta['orient'], 'scales': meta['scales'], 'volumes': volumes, 'cached': True}
+
+    # z-planes run along axis 1 for orient == 1 data
+    shape = pool.dataset(h5path, 's00', 3).shape
+    orient = 0 if shape[0] < shape[1] else 1
+    volumes = {s: LazyVolume(pool.dataset(h5path, s, 3), orient) for s in PreviewCache.SETUPS}
+    scales = pyramid_scales(pool.file(h5path), 's00', orient)
+    return {'orient': orient, 'scales': scales, 'volumes': volumes, 'cached': False}
@@ -16,6 +16,8 @@ import csv
 import datetime
 import os
 
+import UI_function as fun
+
 """
 Usage: for cropping ROIs
 
@@ -215,6 +217,7 @@ You are viewing the 8x downsampled of fused.h5 file. ")
         self.dropdown3 = QComboBox()
         self.dropdown3.addItem("Rescale")
         self.dropdown3.addItem("CLAHE")
+        self.dropdown3.addItem("CLAHE (fast 2D)")
         dropdown_layout3.addWidget(self.dropdown3)
         clip_high_layout3 = QHBoxLayout()
         clip_high_layout3.addWidget(QLabel("Clip High:"))
@@ -647,17 +650,23 @@ You are viewing the 8x downsampled of fused.h5 file. ")
 
         if selected_method == "Rescale":
             current_slice = self.Rescale(current_slice)
-        elif selected_method == "CLAHE":
+        elif selected_method in ("CLAHE", "CLAHE (fast 2D)"):
             xstart = int(self.x_limits[0])
             xend = xstart + int(self.ROI_dim/4)
             ystart = int(self.y_limits[1])
             yend = ystart + int(self.ROI_dim/4)
             self.x_limits = [xstart, xend]
             self.y_limits = [yend, ystart]
-            block = self.img[:,ystart:yend,xstart:xend]
-            block = self.CLAHE(block)
+            if selected_method == "CLAHE (fast 2D)":
+                # 2D CLAHE of the shown plane only, for tuning the clip limits
+                plane = fun.CLAHE2D(current_slice[ystart:yend,xstart:xend],
+                                    self.ClipLowLim, self.ClipHighLim, int(self.ROI_dim)//16)
+            else:
+                block = self.img[:,ystart:yend,xstart:xend]
+                block = self.CLAHE(block)
+                plane = block[self.current_z_level, :, :]
             current_slice = np.zeros_like(current_slice)
-            current_slice[ystart:yend,xstart:xend] = block[self.current_z_level, :, :]
+            current_slice[ystart:yend,xstart:xend] = plane
 
         # Plot current slice
         self.figure.clear()
@@ -770,6 +779,8 @@ You are viewing the 8x downsampled of fused.h5 file. ")
         pgp_clipLow   = self.ClipLowLim_pgp.value()
         pgp_clipHigh  = self.ClipHighLim_pgp.value()
         pgp_ctehmt_method = self.dropdown3.currentText()
+        if pgp_ctehmt_method == "CLAHE (fast 2D)":
+            pgp_ctehmt_method = "CLAHE" # preview only, the training ROIs get the 3D CLAHE
         note = self.note_textbox.text()
         h5path = self.h5path
         Abhome = self.Ab_home
@@ -0,0 +1,73 @@
+"""
+Benchmark of UI_function.getBackgroundLevels against the previous full-sort version.
+
+Checks that both give identical levels (uint8, uint16 and float32 images) and prints
+the time per call for square images from 512^2 to 8k^2.
+
+usage: python benchmarks/bench_background_levels.py [--sizes 512 2048 8192] [--repeat 3]
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'GUI'))
+import UI_function as fun
+
+
+def getBackgroundLevels_sort(image, threshold=50):
+    # Reference: the original implementation
+    image_DS = np.sort(image, axis=None)
+    foreground_vals = image_DS[np.where(image_DS > threshold)]
+    hi_val = foreground_vals[int(np.round(len(foreground_vals)*0.95))]
+    background = hi_val / 5
+
+    return hi_val, background
+
+
+def synthetic_image(size, dtype, rng):
+    # Dim background with a brighter, skewed foreground, roughly like a fused channel
+    img = rng.gamma(2.0, 400.0, size=(size, size))
+    img[:, :size // 3] *= 0.05
+    if np.dtype(dtype) == np.uint8:
+        img = img / 16
+    return np.clip(img, 0, np.iinfo(dtype).max if np.dtype(dtype).kind == 'u' else None).astype(dtype)
+
+
+def timeit(func, *args, repeat=3):
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[512, 1024, 2048, 4096, 8192])
+    parser.add_argument('--dtypes', nargs='+', default=['uint16', 'uint8', 'float32'])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print("%-8s %6s %12s %12s %8s" % ("dtype", "size", "sort (ms)", "new (ms)", "speedup"))
+    for dtype in args.dtypes:
+        for size in args.sizes:
+            img = synthetic_image(size, dtype, rng)
+            t_ref, ref = timeit(getBackgroundLevels_sort, img, repeat=args.repeat)
+            t_new, new = timeit(fun.getBackgroundLevels, img, repeat=args.repeat)
+            assert ref == new and type(ref[0]) == type(new[0]), (dtype, size, ref, new)
+            print("%-8s %6d %12.1f %12.1f %7.1fx" % (dtype, size, 1e3*t_ref, 1e3*t_new, t_ref/t_new))
+
+    # Batched per-slice levels on a small stack
+    stack = np.stack([synthetic_image(512, 'uint16', rng) for _ in range(16)])
+    t_ref, _ = timeit(lambda s: [getBackgroundLevels_sort(f) for f in s], stack, repeat=args.repeat)
+    t_new, (hi_vals, _) = timeit(lambda s: fun.getBackgroundLevels(s, per_slice=True), stack, repeat=args.repeat)
+    assert all(h == getBackgroundLevels_sort(f)[0] for h, f in zip(hi_vals, stack))
+    print("per-slice 16x512^2 uint16: sort %.1f ms, new %.1f ms" % (1e3*t_ref, 1e3*t_new))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+Benchmark of the 3D CLAHE of collectImgStackFused (Target channel, CLAHE method).
+
+Times skimage's equalize_adapthist on the whole ROI column against chunkedCLAHE (same
+output, computed slab by slab on a thread pool), with their peak memory as traced by
+tracemalloc, and checks that both give the same 8-bit volume.
+
+usage: python benchmarks/bench_chunked_clahe.py [--sizes 256 512] [--depth 100] [--workers N] [--no-reference]
+"""
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+import numpy as np
+from scipy import ndimage
+from skimage.exposure import equalize_adapthist
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+from CollectImgStackFused import chunkedCLAHE
+
+
+def synthetic_column(size, depth, rng):
+    col = ndimage.gaussian_filter(rng.gamma(2.0, 300.0, size=(depth, size, size)).astype(np.float32), (1, 3, 3))
+    return np.clip(col * 3, 0, 3000).astype(np.uint16)
+
+
+def traced(func, *args, **kwargs):
+    tracemalloc.start()
+    start = time.perf_counter()
+    out = func(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak, out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[256, 512],
+                        help="ROI width in pixels")
+    parser.add_argument('--depth', type=int, default=100)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--no-reference', action='store_true',
+                        help="skip equalize_adapthist (too slow or too large)")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print("%6s %6s %12s %12s %12s %12s %8s" % ("size", "depth", "skimage (s)", "peak (MB)",
+                                               "chunked (s)", "peak (MB)", "maxdiff"))
+    for size in args.sizes:
+        col = synthetic_column(size, args.depth, rng)
+        kernel = [s // 4 for s in col.shape]
+        tc, pc, out = traced(chunkedCLAHE, col, kernel, clip_limit=0.01, workers=args.workers)
+        if args.no_reference:
+            ts = ps = np.nan
+            diff = -1
+        else:
+            ts, ps, ref = traced(lambda: (equalize_adapthist(col, kernel_size=kernel, clip_limit=0.01)*255).astype(np.uint8))
+            diff = np.abs(ref.astype(int) - out).max()
+        print("%6d %6d %12.2f %12.0f %12.2f %12.0f %8d" % (size, args.depth, ts, ps / 2**20, tc, pc / 2**20, diff))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+Benchmark of the CLAHE preview modes of the Target channel.
+
+Times the exact 3D CLAHE of the ROI column (what "CLAHE" computes once per ROI box and
+clip limits) against the per-plane "CLAHE (fast 2D)" preview (UI_function.CLAHE2D, OpenCV
+if installed, skimage otherwise), and prints how far the 2D planes are from the 3D ones
+(mean absolute difference in 8-bit gray levels).
+
+usage: python benchmarks/bench_clahe.py [--sizes 128 256 512] [--depth 50] [--repeat 3]
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+from scipy import ndimage
+from skimage.exposure import equalize_adapthist
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'GUI'))
+import UI_function as fun
+
+
+def synthetic_column(size, depth, rng):
+    # Smooth blobs over a dim background, roughly like a stained target channel
+    col = ndimage.gaussian_filter(rng.gamma(2.0, 300.0, size=(depth, size, size)), (1, 3, 3))
+    col[:, :, :size // 3] *= 0.2
+    return np.clip(col * 3, 0, 65535).astype(np.uint16)
+
+
+def clahe3D(block, clip_low, clip_high, kernel):
+    # ROI_v2.MainWindow.CLAHE
+    block = np.clip(block, int(clip_low), int(clip_high))
+    return (equalize_adapthist(block, kernel_size=np.asarray([kernel]*3), clip_limit=0.01)*255).astype(np.uint8)
+
+
+def timeit(func, *args, repeat=3):
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[128, 256, 512],
+                        help="ROI width in preview (level 3) pixels, ROI_dim/4")
+    parser.add_argument('--depth', type=int, default=50)
+    parser.add_argument('--clip', type=int, nargs=2, default=[100, 3000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print("2D backend:", "OpenCV %s" % fun.cv2.__version__ if fun.cv2 is not None else "skimage")
+    print("%6s %6s %14s %14s %16s %10s" % ("size", "depth", "3D column (ms)", "2D plane (ms)",
+                                           "2D column (ms)", "diff 2D/3D"))
+    for size in args.sizes:
+        col = synthetic_column(size, args.depth, rng)
+        kernel = size // 4 # ROI_dim//16
+        t3, ref = timeit(clahe3D, col, *args.clip, kernel, repeat=1)
+        z = args.depth // 2
+        tp, plane = timeit(fun.CLAHE2D, col[z], *args.clip, kernel, repeat=args.repeat)
+        tc, stack = timeit(fun.CLAHE2D, col, *args.clip, kernel, repeat=args.repeat)
+        assert (stack[z] == plane).all()
+        diff = np.abs(stack.astype(int) - ref).mean()
+        print("%6d %6d %14.1f %14.2f %16.1f %10.1f" % (size, args.depth, 1e3*t3, 1e3*tp, 1e3*tc, diff))
+
+
+if __name__ == '__main__':
+    main()
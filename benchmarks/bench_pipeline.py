@@ -0,0 +1,241 @@
+"""
+End-to-end throughput benchmark of the ROI and false-color pipelines.
+
+Builds synthetic fused HDF5 files in the BigStitcher layout (t00000/sNN/<level>/cells,
+plus sNN/resolutions), one per orientation, and times at several ROI sizes:
+
+- readHDF5             : opening a sample (ROI_v2.MainWindow.readHDF5, without the preview
+                         cache) and reading the first preview slice of the three channels
+- readHDF5_FC          : reading and rescaling the level-1 FC preview planes (ROI_v2)
+- rapidFalseColor      : H&E false coloring of that preview (UI_function)
+- collectImgStackFused : writing the 8-bit training stacks of one ROI, CLAHE and Rescale
+- collectTrainingROI   : false coloring those stacks (GenerateFCStack)
+
+Every case is run --repeat times; the best and median wall times go to a JSON file,
+with the machine and library versions, so that runs can be compared between releases.
+
+usage: python benchmarks/bench_pipeline.py [--sizes 128 256 512] [--layers 24] [--shape 64 1024 1024]
+                                           [--orient 0 1] [--repeat 3] [--out bench_pipeline.json]
+"""
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import datetime
+import tempfile
+import contextlib
+from types import SimpleNamespace
+
+import numpy as np
+import h5py as h5
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'GUI'))
+sys.path.insert(0, os.path.join(here, '..', 'scripts'))
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+import UI_function as fun
+import UI_volume as vol
+from ROI_v2 import MainWindow
+from CollectImgStackFused import collectImgStackFused
+from GenerateFCStack import collectTrainingROI
+
+HE_settings = {'nuclei': [0.17, 0.27, 0.105], 'cyto': [0.05, 1.0, 0.54]}
+
+
+######################### Synthetic fused data ##########################################
+
+def make_fused(path, orient, shape, levels=4, chunks=(32, 64, 64), seed=0):
+    """
+    Fused file with setups s00 (cyto), s01 (nuclei), s02 (target) and `levels` pyramid
+    levels of a [z, y, x] `shape` volume, stored [y, z, x] for orient 1 like BigStitcher
+    exports of that orientation.
+    """
+    rng = np.random.default_rng(seed)
+    with h5.File(path, 'w') as f:
+        for s, gain in (('s00', 600.0), ('s01', 900.0), ('s02', 300.0)):
+            f.create_dataset(s + '/resolutions', data=np.array([[2.0**l]*3 for l in range(levels)]))
+            f.create_dataset(s + '/subdivisions', data=np.array([chunks[::-1]]*levels, dtype=np.int32))
+            for l in range(levels):
+                shp = [n // 2**l for n in shape]
+                stored = (shp[1], shp[0], shp[2]) if orient == 1 else tuple(shp)
+                ch = tuple(min(c, n) for c, n in zip(chunks, stored))
+                dset = f.create_dataset('t00000/%s/%d/cells' % (s, l), shape=stored, dtype=np.int16,
+                                        chunks=ch, compression='gzip')
+                # Dim background with a brighter, skewed foreground in half of the plane
+                for z0 in range(0, shp[0], ch[1] if orient == 1 else ch[0]):
+                    z1 = min(z0 + (ch[1] if orient == 1 else ch[0]), shp[0])
+                    slab = rng.gamma(2.0, gain, size=(z1 - z0, shp[1], shp[2]))
+                    slab[:, :, :shp[2] // 2] *= 0.1
+                    slab = np.clip(slab, 0, 32767).astype(np.int16)
+                    if orient == 1:
+                        dset[:, z0:z1, :] = np.moveaxis(slab, 0, 1)
+                    else:
+                        dset[z0:z1] = slab
+
+
+######################### Cases ##########################################################
+
+def gui_stub(h5path):
+    # The attributes ROI_v2.MainWindow.readHDF5 / readHDF5_FC use, without the Qt window
+    clip = lambda value: SimpleNamespace(value=lambda: value)
+    gui = SimpleNamespace(h5path=h5path, pool=vol.H5HandlePool(), preview_cache=None,
+                          ClipLowLim_cyto=clip(100), ClipHighLim_cyto=clip(3000),
+                          ClipLowLim_nuc=clip(100), ClipHighLim_nuc=clip(5000),
+                          ClipLowLim_pgp=clip(100), ClipHighLim_pgp=clip(1500))
+    gui.set_sample = lambda sample: MainWindow.set_sample(gui, sample)
+    return gui
+
+
+def case_readHDF5(h5path, size, layers):
+    gui = gui_stub(h5path)
+    MainWindow.readHDF5(gui)
+    for volume in (gui.cyto, gui.nuc, gui.pgp):
+        volume[0]
+    gui.pool.close()
+
+
+def fc_stub(h5path, size):
+    gui = gui_stub(h5path)
+    with contextlib.redirect_stdout(io.StringIO()):
+        MainWindow.readHDF5(gui)
+    # ROI at the origin of the preview, in level-3 coordinates
+    gui.ROI_dim = str(size)
+    gui.current_z_level = 1
+    gui.x_limits = [0.0, size / gui.fc_scale[2]]
+    gui.y_limits = [size / gui.fc_scale[1], 0.0]
+    return gui
+
+
+def case_readHDF5_FC(gui, size, layers):
+    return MainWindow.readHDF5_FC(gui)
+
+
+def case_rapidFalseColor(fc, size, layers):
+    cyto_fc, nuc_fc, _ = fc
+    return fun.rapidFalseColor(nuc_fc[0][0], cyto_fc[0][0], HE_settings['nuclei'], HE_settings['cyto'],
+                               nuc_normfactor=8000, cyto_normfactor=5000,
+                               nuc_levels=nuc_fc[1], cyto_levels=cyto_fc[1])
+
+
+def case_collectImgStackFused(h5path, orient, size, layers, saveroot, CLAHE):
+    with h5.File(h5path, 'r') as f:
+        collectImgStackFused(f, saveroot, 'bench', [0, layers], [0, size], [0, size], orient,
+                             CLAHE=CLAHE, res=1)
+
+
+def case_collectTrainingROI(saveroot, size, layers, FC_dir):
+    collectTrainingROI(FC_dir, os.path.join(saveroot, 'ch1'), os.path.join(saveroot, 'ch2'),
+                       'bench', [0, size], [0, size], [0, layers])
+
+
+######################### Runner #########################################################
+
+def timeit(func, repeat, setup=None):
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        # the pipelines print progress, keep it out of the report
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+    return times
+
+
+def record(results, name, orient, size, layers, times, pixels):
+    best = min(times)
+    results.append({'case': name,
+                    'orient': orient,
+                    'roi_size': size,
+                    'layers': layers,
+                    'repeat': len(times),
+                    'best_s': best,
+                    'median_s': float(np.median(times)),
+                    'mpix_per_s': pixels / best / 1e6 if best > 0 else None})
+    print("%-32s orient %d  size %5s  best %9.4f s  median %9.4f s" %
+          (name, orient, size, best, np.median(times)))
+
+
+def fresh(*folders):
+    def setup():
+        for folder in folders:
+            shutil.rmtree(folder, ignore_errors=True)
+            os.makedirs(folder)
+    return setup
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[128, 256, 512],
+                        help="ROI width in level-1 (ROI dim) pixels")
+    parser.add_argument('--layers', type=int, default=24, help="z-planes per training ROI")
+    parser.add_argument('--shape', type=int, nargs=3, default=[64, 1024, 1024],
+                        help="full resolution [z, y, x] shape of the synthetic volume")
+    parser.add_argument('--orient', type=int, nargs='+', default=[0, 1], choices=[0, 1])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--workdir', default=None, help="where the synthetic data goes (default: temporary)")
+    parser.add_argument('--out', default='bench_pipeline.json')
+    args = parser.parse_args()
+
+    level1 = [n // 2 for n in args.shape]
+    if max(args.sizes) > min(level1[1:]) or args.layers > level1[0]:
+        parser.error("ROI sizes / layers do not fit in the level-1 volume %s" % level1)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='bench_pipeline_')
+    os.makedirs(workdir, exist_ok=True)
+    results = []
+    try:
+        for orient in args.orient:
+            h5path = os.path.join(workdir, 'fused_orient%d.h5' % orient)
+            start = time.perf_counter()
+            make_fused(h5path, orient, args.shape)
+            print("built %s in %.1f s" % (h5path, time.perf_counter() - start))
+
+            level3 = [n // 8 for n in args.shape]
+            times = timeit(lambda: case_readHDF5(h5path, None, None), args.repeat)
+            record(results, 'readHDF5', orient, None, None, times, 3 * level3[1] * level3[2])
+
+            for size in args.sizes:
+                gui = fc_stub(h5path, size)
+                fc = []
+                times = timeit(lambda: fc.append(case_readHDF5_FC(gui, size, 1)), args.repeat)
+                record(results, 'readHDF5_FC', orient, size, 1, times, 3 * size * size)
+                times = timeit(lambda: case_rapidFalseColor(fc[-1], size, 1), args.repeat)
+                record(results, 'rapidFalseColor', orient, size, 1, times, size * size)
+                gui.pool.close()
+
+                saveroot = os.path.join(workdir, 'roi')
+                FC_dir = os.path.join(workdir, 'fc')
+                for CLAHE in (True, False):
+                    times = timeit(lambda: case_collectImgStackFused(h5path, orient, size, args.layers, saveroot, CLAHE),
+                                   args.repeat, setup=fresh(saveroot))
+                    record(results, 'collectImgStackFused[%s]' % ('CLAHE' if CLAHE else 'Rescale'),
+                           orient, size, args.layers, times, 3 * size * size * args.layers)
+
+                times = timeit(lambda: case_collectTrainingROI(saveroot, size, args.layers, FC_dir),
+                               args.repeat, setup=fresh(FC_dir))
+                record(results, 'collectTrainingROI', orient, size, args.layers, times, size * size * args.layers)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {'date': datetime.datetime.now().isoformat(timespec='seconds'),
+              'machine': {'platform': platform.platform(),
+                          'python': platform.python_version(),
+                          'cpu_count': os.cpu_count()},
+              'versions': {'numpy': np.__version__, 'h5py': h5.__version__},
+              'settings': vars(args),
+              'results': results}
+    with open(args.out, 'w') as fp:
+        json.dump(report, fp, indent=1)
+    print("results written to", args.out)
+
+
+if __name__ == '__main__':
+    main()
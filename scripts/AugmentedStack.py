@@ -0,0 +1,125 @@
+import os
+import json
+import numpy as np
+from skimage.io import imread
+
+
+################ Virtual transpose / mirror / flip augmentations #################
+
+MANIFEST_NAME = 'augmentations.json'
+
+# Augmented copies of a [z, y, x] stack, as collectImgStackFused used to write them
+# (transpose: img[i].T, mirror: img[i][::-1], flip: np.flip(img, axis=2)).
+# Every one of them is a view of the canonical stack, no pixel is copied.
+AUGMENTATIONS = {'original':  lambda stack: stack,
+                 'transpose': lambda stack: stack.swapaxes(1, 2),
+                 'mirror':    lambda stack: stack[:, ::-1, :],
+                 'flip':      lambda stack: stack[:, :, ::-1]}
+
+
+def writeManifest(blockdir, flist, augmentations=('transpose', 'mirror', 'flip')):
+    """
+    Record the augmentations of the stack saved in blockdir, instead of writing them.
+
+    The manifest lists the canonical files (in z order) and, for every augmentation,
+    the folder and file names it would have had on disk.
+
+    Parameters
+    ----------
+
+    blockdir : str or pathlike
+        Folder holding the canonical stack.
+
+    flist : list of str
+        Canonical image files, in z order.
+
+    augmentations : tuple of str
+        Keys of AUGMENTATIONS.
+
+    Returns
+    -------
+
+    path : str
+        Path of the manifest.
+
+    """
+    names = [os.path.basename(f) for f in flist]
+    block = os.path.basename(os.path.normpath(blockdir))
+    manifest = {'version': 1,
+                'axes': 'zyx',
+                'files': names,
+                'augmentations': {}}
+
+    for aug in augmentations:
+        if aug not in AUGMENTATIONS:
+            raise ValueError("Unknown augmentation %r, expected one of %s" % (aug, list(AUGMENTATIONS)))
+        # <prefix>_<z>.jpeg -> <prefix>_<aug>_<z>.jpeg, the names of the materialized files
+        manifest['augmentations'][aug] = {'dirname': block + '_' + aug,
+                                          'files': ['%s_%s_%s' % (n.rsplit('_', 1)[0], aug, n.rsplit('_', 1)[1])
+                                                    for n in names]}
+
+    path = os.path.join(blockdir, MANIFEST_NAME)
+    with open(path, 'w') as fp:
+        json.dump(manifest, fp, indent=1)
+    return path
+
+
+def readManifest(blockdir):
+    """Manifest of blockdir as a dict, None if the stack was written without one."""
+    path = os.path.join(blockdir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path) as fp:
+        return json.load(fp)
+
+
+def loadStack(blockdir, manifest=None):
+    """Read the canonical [z, y, x] stack of blockdir, in the order of its manifest."""
+    if manifest is None:
+        manifest = readManifest(blockdir)
+    if manifest is None:
+        raise FileNotFoundError("No %s in %s" % (MANIFEST_NAME, blockdir))
+    return np.stack([imread(os.path.join(blockdir, f)) for f in manifest['files']])
+
+
+def augmentedViews(stack, augmentations=('original', 'transpose', 'mirror', 'flip')):
+    """
+    Augmented versions of a [z, y, x] (or [z, y, x, rgb]) stack, as zero-copy views.
+
+    Returns
+    -------
+
+    views : dict
+        augmentation name -> view of stack.
+
+    """
+    return {aug: AUGMENTATIONS[aug](stack) for aug in augmentations}
+
+
+def loadAugmentedStack(blockdir, augmentations=None):
+    """
+    Canonical stack of blockdir plus the augmentations listed in its manifest.
+
+    The images are read once; the augmented stacks are views of the canonical one.
+
+    Parameters
+    ----------
+
+    blockdir : str or pathlike
+        Folder written by collectImgStackFused(..., augment='manifest').
+
+    augmentations : tuple of str
+        Subset to return, defaults to 'original' and every augmentation of the manifest.
+
+    Returns
+    -------
+
+    views : dict
+        augmentation name -> [z, y, x] array.
+
+    """
+    manifest = readManifest(blockdir)
+    stack = loadStack(blockdir, manifest)
+    if augmentations is None:
+        augmentations = ('original',) + tuple(manifest['augmentations'])
+    return augmentedViews(stack, augmentations)
@@ -0,0 +1,667 @@
+"""
+Batch generation of training ROIs (and their false-colored version) from a coords CSV.
+
+usage: python BatchROI.py ../coords/ROI_coords_2024-01-17.csv [--stage roi|fc|both] [--workers 8] [--res 0]
+                          [--trace batch_trace.json]
+"""
+import os
+import sys
+import json
+import time
+import atexit
+import shutil
+import hashlib
+import argparse
+from collections import OrderedDict, Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+import h5py as h5
+from CollectImgStackFused import collectImgStackFused
+from GenerateFCStack import collectTrainingROI
+
+# The tracer lives in GUI/, shared with the viewers
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'GUI'))
+import UI_trace as trace
+
+
+################ Batch ROI generation, grouped by sample #############################
+
+def readCoords(fname):
+    """ROI_coords_yyyy-mm-dd.csv saved by ROI_v2.py, without its empty rows."""
+    df = pd.read_csv(fname)
+    return df.dropna(how="all").reset_index(drop=True)
+
+
+def blockName(h5path):
+    """Sample name used in the block folder names: the folder holding the h5 file."""
+    split = h5path.count("/") - 1
+    return h5path.split("/")[split]
+
+
+def roiJob(row, res=0):
+    """
+    Parameters of collectImgStackFused for one row of the coords CSV.
+
+    Parameters
+    ----------
+
+    row : dict or pandas Series
+        One ROI of the coords CSV.
+
+    res : int
+        The resolution to read, 0 for full resolution, 1 for 2X downsampled.
+
+    Returns
+    -------
+
+    job : dict
+        h5path, train_home, blockname, zcoords/xcoords/ycoords, orient and the clip settings.
+
+    """
+    xstart, ystart, zstart = int(row["xcoord"]), int(row["ycoord"]), int(row["zcoord"])
+    ROI_dim, no_of_layer = int(row["ROIdim"]), int(row["No_ofLayers"])
+
+    return {'h5path'        : row["h5path"],
+            'train_home'    : row["Abhome"],
+            'blockname'     : blockName(row["h5path"]),
+            'xcoords'       : (xstart, xstart + ROI_dim),
+            'ycoords'       : (ystart, ystart + ROI_dim),
+            'zcoords'       : (zstart, zstart + no_of_layer),
+            'orient'        : int(row["orient"]),
+            'CLAHE'         : row["pgp_ctehmt_method"] != "Rescale",
+            'hiclip_val'    : row["pgp_clipHigh"],
+            'lowclip_val'   : row["pgp_clipLow"],
+            'nuc_clip_low'  : row["nuc_clipLow"],
+            'nuc_clip_high' : row["nuc_clipHigh"],
+            'cyto_clip_low' : row["cyto_clipLow"],
+            'cyto_clip_high': row["cyto_clipHigh"],
+            'res'           : res}
+
+
+def roiBox(job):
+    """The (start, stop) of every dataset axis read by collectImgStackFused for this ROI."""
+    if job['orient'] == 1:
+        return (job['xcoords'], job['zcoords'], job['ycoords'])
+    return (job['zcoords'], job['xcoords'], job['ycoords'])
+
+
+def groupBySample(jobs):
+    """Jobs grouped by h5path, in the order the samples first appear."""
+    groups = OrderedDict()
+    for job in jobs:
+        groups.setdefault(job['h5path'], []).append(job)
+    return groups
+
+
+def spatialOrder(jobs, chunks):
+    """
+    Jobs sorted along a Z-order (Morton) curve over the chunk grid, by the chunk
+    holding the first voxel of each ROI: ROIs sharing chunks are generated one
+    after the other, while those chunks are still in the chunk cache.
+    """
+    def key(job):
+        idx = [int(lo) // c for (lo, _), c in zip(roiBox(job), chunks)]
+        code = 0
+        for bit in range(max(i.bit_length() for i in idx) if any(idx) else 0):
+            for axis, i in enumerate(idx):
+                code |= ((i >> bit) & 1) << (bit*len(idx) + axis)
+        return code
+
+    return sorted(jobs, key=key)
+
+
+class SampleIOReport:
+    """
+    What generating the ROIs of one sample read from its h5 file.
+
+    voxel_bytes is the size of the ROIs themselves. chunk_reads counts the chunks
+    every ROI touches; unique_chunks counts each of them once, which is all the
+    file has to decompress when neighbouring ROIs hit the chunk cache, and
+    unique_chunk_bytes is their size, with the chunk shape and dtype of each dataset.
+    """
+
+    def __init__(self, h5path):
+        self.h5path = h5path
+        self.rois = 0
+        self.skipped = 0
+        self.seconds = 0.0
+        self.voxel_bytes = 0
+        self.unique_chunk_bytes = 0
+        self.chunk_reads = 0
+        self._chunks = set()
+
+    def record(self, dset, box):
+        """Record the read of box ((start, stop) per axis) from dataset dset."""
+        chunks = dset.chunks or dset.shape
+        ranges = [range(lo // c, (hi - 1) // c + 1) for (lo, hi), c in zip(box, chunks)]
+        nchunks = int(np.prod([len(r) for r in ranges]))
+        self.voxel_bytes += int(np.prod([hi - lo for lo, hi in box])) * dset.dtype.itemsize
+        self.chunk_reads += nchunks
+        chunk_bytes = int(np.prod(chunks)) * dset.dtype.itemsize
+        for idx in np.ndindex(*[len(r) for r in ranges]):
+            key = (dset.name,) + tuple(r[i] for r, i in zip(ranges, idx))
+            if key not in self._chunks:
+                self._chunks.add(key)
+                self.unique_chunk_bytes += chunk_bytes
+
+    @property
+    def unique_chunks(self):
+        return len(self._chunks)
+
+    def report(self):
+        mb = self.voxel_bytes / 2**20
+        return ("%s: %d ROIs (%d already done) in %.1f s (%.1f ROIs/min), %.1f MB read (%.1f MB/s), "
+                "%d chunk reads over %d distinct chunks (%.1f MB, %.2fx reuse)" %
+                (self.h5path, self.rois, self.skipped, self.seconds, 60*self.rois/max(self.seconds, 1e-9),
+                 mb, mb/max(self.seconds, 1e-9), self.chunk_reads, self.unique_chunks,
+                 self.unique_chunk_bytes / 2**20,
+                 self.chunk_reads/max(self.unique_chunks, 1)))
+
+
+def _next_prime(n):
+    n = max(2, int(n))
+    while any(n % d == 0 for d in range(2, int(n**0.5) + 1)):
+        n += 1
+    return n
+
+
+def openSample(h5path, cache_mb=1024):
+    """
+    Open a sample read-only with a chunk cache large enough to hold the chunks shared by nearby ROIs.
+    The cache is allocated per open dataset, and lives as long as the dataset stays open.
+    """
+    nbytes = int(cache_mb) << 20
+    return h5.File(h5path, 'r', rdcc_nbytes=nbytes, rdcc_nslots=_next_prime(nbytes // 2**16 * 10))
+
+
+def runSample(f, jobs, FC=False, resume=True, verify=False, **kwargs):
+    """
+    Generate every ROI of one sample from the open h5 File f, in spatial order.
+
+    Parameters
+    ----------
+
+    f : h5 File
+        The sample all jobs read from.
+
+    jobs : list of dict
+        From roiJob().
+
+    FC : bool
+        Also save the false-colored ROIs in <Abhome>/train/FC.
+
+    resume : bool
+        Skip the ROIs a CompletionManifest records as done with the same parameters.
+
+    verify : bool
+        Check the SHA-1 of the outputs of done ROIs, not just their size.
+
+    **kwargs :
+        Passed on to collectImgStackFused (writer, workers, chunksize, augment).
+
+    Returns
+    -------
+
+    report : SampleIOReport
+
+    """
+    report = SampleIOReport(f.filename)
+    if not jobs:
+        return report
+    start = time.time()
+
+    stage = 'both' if FC else 'roi'
+    augment = kwargs.get('augment', 'files')
+    manifests = {}
+    res = str(jobs[0]['res'])
+    dsets = [f['t00000'][s][res]['cells'] for s in ('s00', 's01', 's02')]
+    for job in spatialOrder(jobs, dsets[0].chunks or dsets[0].shape):
+        manifest = manifestFor(job, manifests)
+        if resume and manifest.isDone(job, stage, augment, verify):
+            report.skipped += 1
+            continue
+        clearOutputs(job, stage)
+        generateROI(f, job, FC=FC, **kwargs)
+        manifest.record(job, stage, augment, hashOutputs(job, stage))
+        report.rois += 1
+        for dset in dsets:
+            report.record(dset, roiBox(job))
+
+    report.seconds = time.time() - start
+    return report
+
+
+def generateROI(f, job, FC=False, **kwargs):
+    """One ROI, as main() of generate_training_ROI.ipynb does it."""
+    savedir = os.path.join(job['train_home'], 'train')
+    # exist_ok: the other ROIs of the sample may be running in other workers
+    os.makedirs(savedir, exist_ok=True)
+
+    print(job['blockname'], "[ xyz:", job['xcoords'][0], job['ycoords'][0], job['zcoords'][0], "]")
+    params = dict((k, job[k]) for k in ('CLAHE', 'hiclip_val', 'lowclip_val', 'nuc_clip_low', 'nuc_clip_high',
+                                        'cyto_clip_low', 'cyto_clip_high', 'res'))
+    params.update(kwargs)
+    with trace.span('generateROI', block=job['blockname'], h5path=job['h5path']):
+        collectImgStackFused(f,
+                             savedir,
+                             job['blockname'],
+                             job['zcoords'],
+                             job['xcoords'],
+                             job['ycoords'],
+                             job['orient'],
+                             FC_dir=os.path.join(savedir, 'FC') if FC else None,
+                             **params)
+
+
+def runBatch(coords, res=0, FC=False, cache_mb=1024, resume=True, verify=False, **kwargs):
+    """
+    Generate the training ROIs of a coords CSV, one sample at a time.
+
+    Rows are grouped by h5path: every file is opened once, its ROIs are generated in
+    spatial order (see spatialOrder) and the I/O of the sample is reported.
+    With resume=True, ROIs already generated with the same parameters are skipped
+    (see CompletionManifest), so an interrupted batch can simply be run again.
+
+    Parameters
+    ----------
+
+    coords : str, pathlike or pandas DataFrame
+        ROI_coords_yyyy-mm-dd.csv saved by ROI_v2.py, or its rows.
+
+    res : int
+        The resolution to read, 0 for full resolution, 1 for 2X downsampled.
+
+    FC : bool
+        Also save the false-colored ROIs in <Abhome>/train/FC.
+
+    cache_mb : int
+        HDF5 chunk cache per dataset (s00, s01 and s02 each), in MB.
+
+    resume, verify : bool
+        See runSample.
+
+    **kwargs :
+        Passed on to collectImgStackFused (writer, workers, chunksize, augment). The JPEGs
+        are written by a thread pool (writer='thread') unless another writer is given.
+
+    Returns
+    -------
+
+    reports : list of SampleIOReport
+        One per sample.
+
+    """
+    kwargs.setdefault('writer', 'thread')
+    df = coords if isinstance(coords, pd.DataFrame) else readCoords(coords)
+    jobs = [roiJob(row, res) for _, row in df.iterrows()]
+
+    reports = []
+    for h5path, sample_jobs in groupBySample(jobs).items():
+        with openSample(h5path, cache_mb) as f:
+            report = runSample(f, sample_jobs, FC=FC, resume=resume, verify=verify, **kwargs)
+        print(report.report())
+        reports.append(report)
+
+    return reports
+
+
+def generateFC(job, augment='files'):
+    """False color one ROI from its ch1/ch2 JPEG stacks, as main() of generate_FC_ROI.ipynb does it."""
+    savedir = os.path.join(job['train_home'], 'train')
+    FC_dir = os.path.join(savedir, 'FC')
+    os.makedirs(FC_dir, exist_ok=True)
+
+    print(job['blockname'], "[ xyz:", job['xcoords'][0], job['ycoords'][0], job['zcoords'][0], "]")
+    with trace.span('generateFC', block=job['blockname'], h5path=job['h5path']):
+        collectTrainingROI(FC_dir,
+                           os.path.join(savedir, 'ch1'),
+                           os.path.join(savedir, 'ch2'),
+                           job['blockname'],
+                           job['xcoords'],
+                           job['ycoords'],
+                           job['zcoords'],
+                           augment=augment)
+
+
+################ Completion manifest, for resumable batches #############################
+
+MANIFEST_NAME = 'roi_manifest.json'
+
+
+def blockDirName(job):
+    """Name of the block folders of a ROI, as collectImgStackFused makes it."""
+    return '%s_Xpos_%s_%s_Ypos_%s_%s_stack_%s_%s' % (job['blockname'],
+                                                    '{:0>6d}'.format(job['xcoords'][0]),
+                                                    '{:0>6d}'.format(job['xcoords'][1]),
+                                                    '{:0>6d}'.format(job['ycoords'][0]),
+                                                    '{:0>6d}'.format(job['ycoords'][1]),
+                                                    '{:0>6d}'.format(job['zcoords'][0]),
+                                                    '{:0>6d}'.format(job['zcoords'][1]))
+
+
+def outputDirs(job, stage):
+    """Block folders (with their augmentations) a ROI writes in <Abhome>/train."""
+    savedir = os.path.join(job['train_home'], 'train')
+    chans = []
+    if stage in ('roi', 'both'):
+        chans += ['ch0', 'ch1', 'ch2']
+    if stage in ('fc', 'both'):
+        chans += ['FC']
+    return [os.path.join(savedir, ch, blockDirName(job) + suffix)
+            for ch in chans for suffix in ('', '_transpose', '_mirror', '_flip')]
+
+
+def hashFile(path):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def hashOutputs(job, stage):
+    """{path relative to <Abhome>/train: [size, sha1]} of every output file of a ROI."""
+    savedir = os.path.join(job['train_home'], 'train')
+    outputs = {}
+    for d in outputDirs(job, stage):
+        if not os.path.isdir(d):
+            continue
+        for name in sorted(os.listdir(d)):
+            path = os.path.join(d, name)
+            outputs[os.path.relpath(path, savedir).replace(os.sep, '/')] = [os.path.getsize(path), hashFile(path)]
+    return outputs
+
+
+def clearOutputs(job, stage):
+    """Remove what a previous, interrupted or outdated, run left of a ROI."""
+    for d in outputDirs(job, stage):
+        if os.path.isdir(d):
+            shutil.rmtree(d)
+
+
+class CompletionManifest:
+    """
+    Completed ROIs of a train folder, saved in <Abhome>/train/roi_manifest.json.
+
+    Entries are keyed by ROI (h5path, coordinates and stage) and hold the parameters the
+    ROI was generated with (coordinates, layers, orientation, clip values, CLAHE, res,
+    augment) and the size and SHA-1 of each of its output files. A ROI is done when its
+    parameters are unchanged and all its outputs are still there with the same size
+    (and the same hash, with verify=True). Anything else is generated again.
+
+    Only one process should update a manifest: the batch runners record the ROIs
+    as their workers complete them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.rois = {}
+        if os.path.exists(path):
+            with open(path) as fp:
+                self.rois = json.load(fp).get('rois', {})
+
+    @staticmethod
+    def roiId(job, stage):
+        return '%s|x%d-%d|y%d-%d|z%d-%d|%s' % ((job['h5path'],) + tuple(job['xcoords']) + tuple(job['ycoords']) +
+                                              tuple(job['zcoords']) + (stage,))
+
+    @staticmethod
+    def params(job, stage, augment='files'):
+        params = dict((k, v) for k, v in job.items() if k not in ('train_home', 'blockname'))
+        params.update(stage=stage, augment=augment)
+        # plain json types, numpy scalars and tuples included
+        return json.loads(json.dumps(params, default=lambda v: v.item() if hasattr(v, 'item') else str(v)))
+
+    def isDone(self, job, stage, augment='files', verify=False):
+        entry = self.rois.get(self.roiId(job, stage))
+        if entry is None or entry['params'] != self.params(job, stage, augment) or not entry['outputs']:
+            return False
+        savedir = os.path.dirname(self.path)
+        for rel, (size, sha) in entry['outputs'].items():
+            path = os.path.join(savedir, rel)
+            if not os.path.isfile(path) or os.path.getsize(path) != size:
+                return False
+            if verify and hashFile(path) != sha:
+                return False
+        return True
+
+    def record(self, job, stage, augment, outputs):
+        self.rois[self.roiId(job, stage)] = {'params': self.params(job, stage, augment),
+                                             'outputs': outputs,
+                                             'completed': time.strftime('%Y-%m-%d %H:%M:%S')}
+        self.save()
+
+    def save(self):
+        # Written aside and renamed, a crash never leaves a truncated manifest
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as fp:
+            json.dump({'version': 1, 'rois': self.rois}, fp, indent=1)
+        os.replace(tmp, self.path)
+
+
+def manifestFor(job, manifests):
+    """CompletionManifest of the train folder of job, from (and added to) the dict manifests."""
+    path = os.path.join(job['train_home'], 'train', MANIFEST_NAME)
+    if path not in manifests:
+        manifests[path] = CompletionManifest(path)
+    return manifests[path]
+
+
+################ Multiprocessing batch runner #############################
+
+# Open sample of a worker process, h5py handles can't be shared between processes
+_samples = {}
+_cache_mb = 1024
+
+
+def _initWorker(cache_mb):
+    global _cache_mb
+    _cache_mb = cache_mb
+    atexit.register(_closeSamples)
+
+
+def _sample(h5path, res):
+    """Open File of h5path, the previous sample of the worker (and its chunk caches) is closed."""
+    key = (h5path, str(res))
+    if key not in _samples:
+        _closeSamples()
+        f = openSample(h5path, _cache_mb)
+        # HDF5 drops the chunk cache of a dataset with its last open handle, and collectImgStackFused
+        # looks the datasets up again for every ROI: keep them open while the worker is on this sample
+        _samples[key] = (f, [f['t00000'][s][str(res)]['cells'] for s in ('s00', 's01', 's02')])
+    return _samples[key][0]
+
+
+def _closeSamples():
+    for f, _ in _samples.values():
+        f.close()
+    _samples.clear()
+
+
+def _runJob(job, stage, kwargs):
+    """Worker: one ROI, returns (h5path, bytes of input data, seconds, hashOutputs())."""
+    start = time.time()
+    nvox = int(np.prod([hi - lo for lo, hi in roiBox(job)]))
+    clearOutputs(job, stage)
+    if stage == 'fc':
+        generateFC(job, augment=kwargs.get('augment', 'files'))
+        nbytes = 2 * nvox # 8-bit nuclear and cyto stacks
+    else:
+        f = _sample(job['h5path'], job['res'])
+        generateROI(f, job, FC=(stage == 'both'), **kwargs)
+        res = str(job['res'])
+        nbytes = sum(nvox * f['t00000'][s][res]['cells'].dtype.itemsize for s in ('s00', 's01', 's02'))
+    return job['h5path'], nbytes, time.time() - start, hashOutputs(job, stage)
+
+
+class BatchSummary:
+    """Throughput of a runBatchParallel() call."""
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.rois = Counter()
+        self.nbytes = 0
+        self.roi_seconds = 0.0
+        self.seconds = 0.0
+        self.skipped = 0
+        self.failed = []
+
+    def add(self, h5path, nbytes, seconds):
+        self.rois[h5path] += 1
+        self.nbytes += nbytes
+        self.roi_seconds += seconds
+
+    def report(self):
+        n = sum(self.rois.values())
+        t = max(self.seconds, 1e-9)
+        lines = ["%d ROIs from %d samples in %.1f s with %d workers: %.1f ROIs/min, %.1f MB/s "
+                 "(%.1f s per ROI and worker)" %
+                 (n, len(self.rois), self.seconds, self.workers, 60*n/t, self.nbytes/2**20/t,
+                  self.roi_seconds/max(n, 1))]
+        lines += ["  %s: %d ROIs" % (h5path, count) for h5path, count in self.rois.items()]
+        if self.skipped:
+            lines.append("%d ROIs already done, skipped" % self.skipped)
+        if self.failed:
+            lines.append("%d ROIs failed" % len(self.failed))
+        return "\n".join(lines)
+
+
+def runBatchParallel(coords, res=0, stage='roi', workers=None, cache_mb=1024, resume=True, verify=False, **kwargs):
+    """
+    Generate the ROIs of a coords CSV over a pool of processes, one task per ROI.
+
+    Every worker keeps the sample it works on open, with its s00/s01/s02 datasets and
+    their chunk caches, until it gets a ROI of another sample. ROIs are submitted
+    sample by sample, in spatial order (see spatialOrder). Completed ROIs are recorded
+    in the CompletionManifest of their train folder as they come in. ROIs that fail,
+    unreadable samples included, are reported in summary.failed.
+
+    Parameters
+    ----------
+
+    coords : str, pathlike or pandas DataFrame
+        ROI_coords_yyyy-mm-dd.csv saved by ROI_v2.py, or its rows.
+
+    res : int
+        The resolution to read, 0 for full resolution, 1 for 2X downsampled.
+
+    stage : str
+        'roi' for the ch0/ch1/ch2 stacks (generate_training_ROI.ipynb), 'fc' for the
+        false-colored ROIs from existing stacks (generate_FC_ROI.ipynb), 'both' for the
+        stacks and the false-colored ROIs from the HDF5 data in one pass.
+
+    workers : int
+        Number of processes, defaults to os.cpu_count(); 0 runs in this process.
+
+    cache_mb : int
+        HDF5 chunk cache per dataset (s00, s01 and s02 each) and worker, in MB.
+
+    resume : bool
+        Skip the ROIs done with the same parameters, redo partial or outdated ones.
+
+    verify : bool
+        Check the SHA-1 of the outputs of done ROIs, not just their size.
+
+    **kwargs :
+        Passed on to collectImgStackFused (augment, ...). The JPEGs of a ROI are written
+        by its worker (writer='serial') unless another writer is given.
+
+    Returns
+    -------
+
+    summary : BatchSummary
+
+    """
+    if stage not in ('roi', 'fc', 'both'):
+        raise ValueError("stage must be 'roi', 'fc' or 'both', got %r" % (stage,))
+    workers = (os.cpu_count() or 1) if workers is None else int(workers)
+    kwargs.setdefault('writer', 'serial' if workers > 0 else 'thread')
+
+    summary = BatchSummary(workers)
+    df = coords if isinstance(coords, pd.DataFrame) else readCoords(coords)
+    jobs = []
+    for h5path, sample_jobs in groupBySample([roiJob(row, res) for _, row in df.iterrows()]).items():
+        if stage == 'fc':
+            jobs += sample_jobs
+            continue
+        try:
+            with h5.File(h5path, 'r') as f:
+                dset = f['t00000']['s00'][str(res)]['cells']
+                jobs += spatialOrder(sample_jobs, dset.chunks or dset.shape)
+        except Exception as e:
+            print("Sample failed:", h5path, ":", e)
+            summary.failed += sample_jobs
+
+    augment = kwargs.get('augment', 'files')
+    manifests = {}
+    if resume:
+        todo = [job for job in jobs if not manifestFor(job, manifests).isDone(job, stage, augment, verify)]
+        summary.skipped = len(jobs) - len(todo)
+        jobs = todo
+
+    def done(job, result):
+        manifestFor(job, manifests).record(job, stage, augment, result[3])
+        summary.add(*result[:3])
+
+    def failed(job, e):
+        print("ROI failed:", job['h5path'], job['xcoords'], job['ycoords'], job['zcoords'], ":", e)
+        summary.failed.append(job)
+
+    start = time.time()
+    if workers == 0:
+        _initWorker(cache_mb)
+        try:
+            for job in jobs:
+                try:
+                    done(job, _runJob(job, stage, kwargs))
+                except Exception as e:
+                    failed(job, e)
+        finally:
+            _closeSamples()
+    else:
+        with ProcessPoolExecutor(workers, initializer=_initWorker, initargs=(cache_mb,)) as pool:
+            futures = {pool.submit(_runJob, job, stage, kwargs): job for job in jobs}
+            for future in as_completed(futures):
+                try:
+                    done(futures[future], future.result())
+                except Exception as e:
+                    failed(futures[future], e)
+    summary.seconds = time.time() - start
+
+    print(summary.report())
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('coords', help="ROI_coords_yyyy-mm-dd.csv saved by ROI_v2.py")
+    parser.add_argument('--stage', choices=['roi', 'fc', 'both'], default='roi',
+                        help="roi: ch0/ch1/ch2 stacks, fc: false color existing stacks, both: stacks and FC from the h5 data")
+    parser.add_argument('--res', type=int, default=0, help="0: full resolution, 1: 2X ds")
+    parser.add_argument('--workers', type=int, default=None, help="processes, defaults to the number of cores")
+    parser.add_argument('--cache-mb', type=int, default=1024,
+                        help="HDF5 chunk cache per dataset (s00, s01 and s02 each) and worker")
+    parser.add_argument('--augment', choices=['files', 'manifest'], default='files',
+                        help="write the transpose/mirror/flip stacks, or a manifest (see AugmentedStack)")
+    parser.add_argument('--no-resume', dest='resume', action='store_false',
+                        help="regenerate every ROI, even those recorded as done in roi_manifest.json")
+    parser.add_argument('--verify', action='store_true',
+                        help="check the hash of the outputs of done ROIs, not just their size")
+    parser.add_argument('--trace', default=None, metavar='TRACE.json',
+                        help="record the read/process/write steps of every ROI as a Chrome/Perfetto trace")
+    args = parser.parse_args()
+
+    if args.trace:
+        trace.start(args.trace)
+
+    summary = runBatchParallel(args.coords, res=args.res, stage=args.stage, workers=args.workers,
+                               cache_mb=args.cache_mb, resume=args.resume, verify=args.verify,
+                               augment=args.augment)
+    if summary.failed:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,14 @@
 import os
+import sys
 import numpy as np
 import skimage as sk
-from pathos.multiprocessing import ProcessingPool
+from AugmentedStack import writeManifest
+from GenerateFCStack import FC_rescale_lut, saveTrainingFC
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+# The tracer lives in GUI/, shared with the viewers
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'GUI'))
+import UI_trace as trace
 
 
 def writeImages(imagePair):
@@ -30,11 +37,278 @@ def writeImages(imagePair):
     return
 
 
-def __preProcess(image):
+def writeImageChunk(imagePairs):
+    """
+    Write a batch of (fname, img) pairs, one task of the parallel writers.
+
+    Parameters
+    ----------
+
+    imagePairs : list of tuples
+        See writeImages().
+
+    Returns
+    -------
+
+    n : int
+        Number of images written.
+
+    """
+    for imagePair in imagePairs:
+        writeImages(imagePair)
+    return len(imagePairs)
+
+
+def imageWriter(writer='serial', workers=None):
+    """
+    Executor for writeImageStack().
+
+    Parameters
+    ----------
+
+    writer : str
+        'serial' (returns None, the default), 'thread' or 'process'. Threads are usually
+        enough, the JPEG encoder and the file I/O release the GIL.
+
+    workers : int
+        Pool size, defaults to os.cpu_count().
+
+    Returns
+    -------
+
+    executor : concurrent.futures Executor or None
+
+    """
+    workers = workers or os.cpu_count() or 1
+    if writer == 'serial':
+        return None
+    if writer == 'thread':
+        return ThreadPoolExecutor(max_workers=workers)
+    if writer == 'process':
+        return ProcessPoolExecutor(max_workers=workers)
+    raise ValueError("writer must be 'serial', 'thread' or 'process', got %r" % (writer,))
+
+
+def writeImageStack(imagePairs, executor=None, chunksize=8):
+    """
+    Write (fname, img) pairs, in batches of `chunksize` images per task.
+
+    Parameters
+    ----------
+
+    imagePairs : list of tuples
+        See writeImages().
+
+    executor : Executor or None
+        From imageWriter(), None writes sequentially in this process.
+
+    chunksize : int
+        Images per task, to keep the scheduling (and pickling) overhead low.
+
+    Returns
+    -------
+
+    """
+    if executor is None:
+        writeImageChunk(imagePairs)
+        return
+
+    batches = [imagePairs[i:i + chunksize] for i in range(0, len(imagePairs), chunksize)]
+    for _ in executor.map(writeImageChunk, batches):
+        pass # re-raises the errors of the workers
+    return
+
+
+# Histogram clipping and mapping of skimage.exposure._adapthist (private there, so not
+# imported): same code as skimage 0.19 to 0.26, which equalize_adapthist builds on.
+NR_OF_GRAY = 2**14
+
+
+def _clipHistogram(hist, clip_limit):
+    """Clip the histogram at clip_limit and redistribute the excess over the other bins."""
+    excess_mask = hist > clip_limit
+    excess = hist[excess_mask]
+    n_excess = excess.sum() - excess.size * clip_limit
+    hist[excess_mask] = clip_limit
+
+    # average increment of every bin, bins above upper are set to clip_limit
+    bin_incr = n_excess // hist.size
+    upper = clip_limit - bin_incr
+
+    low_mask = hist < upper
+    n_excess -= hist[low_mask].size * bin_incr
+    hist[low_mask] += bin_incr
+
+    mid_mask = np.logical_and(hist >= upper, hist < clip_limit)
+    mid = hist[mid_mask]
+    n_excess += mid.sum() - mid.size * clip_limit
+    hist[mid_mask] = clip_limit
+
+    while n_excess > 0: # redistribute the remaining excess
+        prev_n_excess = n_excess
+        for index in range(hist.size):
+            under_mask = hist < clip_limit
+            step_size = max(1, np.count_nonzero(under_mask) // n_excess)
+            under_mask = under_mask[index::step_size]
+            hist[index::step_size][under_mask] += 1
+            n_excess -= np.count_nonzero(under_mask)
+            if n_excess <= 0:
+                break
+        if prev_n_excess == n_excess:
+            break
+
+    return hist
+
+
+def _mapHistogram(hist, min_val, max_val, n_pixels):
+    """Equalized lookup table of a clipped histogram, its cumulative sum scaled to [min_val, max_val]."""
+    out = np.cumsum(hist, axis=-1).astype(float)
+    out *= (max_val - min_val) / n_pixels
+    out += min_val
+    np.clip(out, a_min=None, a_max=max_val, out=out)
+    return out.astype(int)
+
+
+def chunkedCLAHE(image, kernel_size, clip_limit=0.01, nbins=256, workers=None, max_voxels=1 << 20):
+    """
+    (equalize_adapthist(image, kernel_size, clip_limit, nbins)*255).astype(np.uint8),
+    computed out-of-core and in parallel.
+
+    Same algorithm as skimage (Zuiderveld's CLAHE: one clipped histogram mapping per
+    contextual region of kernel_size, multilinear interpolation between the mappings of
+    the neighbouring regions), on bounded pieces of the volume:
+
+    1) the mapping of every contextual region is computed from that region alone
+       (reflected at the far edges, like skimage pads the image),
+    2) the output is interpolated slab by slab along axis 0, each slab only needs
+       the mappings, not its neighbours.
+
+    Both steps run on a pool of `workers` threads. Memory is the uint16 result plus
+    ~50 bytes per voxel of each slab in flight (max_voxels voxels per slab and thread),
+    instead of several float64 copies of the whole volume. The result matches skimage to
+    within one gray level (the last float32 rounding may differ).
+
+    Parameters
+    ----------
+
+    image : 3D numpy array, unsigned integer dtype
+        Volume to equalize.
+
+    kernel_size : sequence of int
+        Shape of the contextual regions.
+
+    clip_limit, nbins :
+        As for skimage.exposure.equalize_adapthist.
+
+    workers : int
+        Number of threads, defaults to os.cpu_count().
+
+    max_voxels : int
+        Voxels per interpolated slab.
+
+    Returns
+    -------
+
+    equalized_image : 3D numpy array, dtype = uint8
+
+    """
+    from skimage.exposure import equalize_adapthist, rescale_intensity
+
+    kernel_size = [int(k) for k in kernel_size]
+    imin, imax = int(image.min()), int(image.max())
+    if imin == imax or min(kernel_size) < 1 or image.dtype.kind != 'u':
+        # Degenerate cases, left to skimage
+        return (equalize_adapthist(image, kernel_size=kernel_size, clip_limit=clip_limit, nbins=nbins)*255).astype(np.uint8)
+
+    # Gray level -> histogram bin, as skimage rescales the image to NR_OF_GRAY levels
+    values = np.arange(imin, imax + 1)
+    codes = np.round(rescale_intensity(values, in_range=(imin, imax), out_range=(0, NR_OF_GRAY - 1)))
+    bin_lut = np.zeros(imax + 1, dtype=np.intp)
+    bin_lut[imin:] = codes.astype(np.intp) // (1 + NR_OF_GRAY // nbins)
+
+    # Contextual regions of the padded image, see skimage.exposure._adapthist._clahe
+    shape = image.shape
+    ns_hist = [int((s + k//2 + (k - s % k) % k + int(np.ceil(k / 2.0))) / k) - 1
+               for s, k in zip(shape, kernel_size)]
+    kernel_elements = int(np.prod(kernel_size))
+    clim = int(np.clip(clip_limit * kernel_elements, 1, None)) if clip_limit > 0.0 else kernel_elements
+
+    def reflect(idx, s):
+        # np.pad(mode='reflect') beyond the far edge
+        return np.where(idx < s, idx, 2*(s - 1) - idx)
+
+    def region_map(region):
+        zidx, yidx, xidx = [reflect(np.arange(i*k, (i + 1)*k), s) for i, k, s in zip(region, kernel_size, shape)]
+        hist = np.zeros(nbins, dtype=np.int64)
+        step = max(1, max_voxels // (len(yidx)*len(xidx)))
+        for z0 in range(0, len(zidx), step):
+            block = image[np.ix_(zidx[z0:z0 + step], yidx, xidx)]
+            hist += np.bincount(bin_lut[block].ravel(), minlength=nbins)
+        hist = _clipHistogram(hist, clim)
+        return _mapHistogram(hist, 0, NR_OF_GRAY - 1, kernel_elements)
+
+    regions = list(np.ndindex(*ns_hist))
+    pool = ThreadPoolExecutor(workers or os.cpu_count() or 1)
+    try:
+        maps = np.stack(list(pool.map(region_map, regions))).reshape(tuple(ns_hist) + (nbins,))
+        # Mappings of the processing blocks, the outer ones repeated (skimage pads them with mode='edge')
+        maps = np.pad(maps, [[1, 1]]*len(shape) + [[0, 0]], mode='edge')
+        strides = np.array(maps.strides[:-1]) // maps.itemsize
+        maps = maps.ravel()
+
+        # Per axis: processing block (index into maps) and interpolation weight of every voxel
+        blocks, weights = [], []
+        for s, k in zip(shape, kernel_size):
+            pos = np.arange(s) + k//2
+            coeff = (np.arange(k) / k)[pos % k]
+            blocks.append(pos // k)
+            weights.append((1 - coeff, coeff))
+
+        result = np.empty(shape, dtype=np.uint16)
+        plane = int(np.prod(shape[1:]))
+        depth = max(1, max_voxels // plane)
+
+        def interpolate(z0):
+            z1 = min(z0 + depth, shape[0])
+            bins = bin_lut[image[z0:z1]]
+            acc = np.zeros(bins.shape, dtype=np.float32)
+            for edge in np.ndindex(*([2] * len(shape))):
+                # flat index of the mapping of this corner, for every voxel
+                base = ((blocks[0][z0:z1] + edge[0])*strides[0])[:, None, None] + \
+                       ((blocks[1] + edge[1])*strides[1])[None, :, None] + \
+                       ((blocks[2] + edge[2])*strides[2])[None, None, :]
+                mapped = maps[base + bins]
+                # same product order as skimage: x, then y, then z weight
+                coeff = (weights[2][edge[2]][None, :] * weights[1][edge[1]][:, None])[None] * \
+                        weights[0][edge[0]][z0:z1, None, None]
+                acc += (mapped * coeff).astype(np.float32)
+            result[z0:z1] = acc.astype(np.uint16)
+
+        list(pool.map(interpolate, range(0, shape[0], depth)))
+    finally:
+        pool.shutdown()
+
+    # rescale_intensity(result)*255 as uint8, through a lookup table over the uint16 levels
+    rmin, rmax = int(result.min()), int(result.max())
+    levels = np.arange(rmax + 1, dtype=np.float64)
+    if rmin != rmax:
+        levels = (levels - rmin) / (rmax - rmin)
+    else:
+        levels = np.clip(levels, 0, 1)
+    to_uint8 = (levels*255).astype(np.uint8)
+
+    equalized_image = np.empty(shape, dtype=np.uint8)
+    for z0 in range(0, shape[0], depth):
+        equalized_image[z0:z0 + depth] = to_uint8[result[z0:z0 + depth]]
+    return equalized_image
+
+
+def __preProcess(image, workers=None):
     """
 
     Step 1) CLAHE via skimage equalize_adapthist: enhances contrast to make
     full use of the 16 bit dynamic range remaps histogram to 8 bit.
+    Computed by chunkedCLAHE, slab by slab on `workers` threads.
 
     Parameters
     ----------
@@ -49,7 +323,6 @@ def __preProcess(image):
         3D image with equalized histogram mapped to 8-bit range.
 
     """
-    from skimage.exposure import equalize_adapthist
     import numpy as np
     
     image = np.clip(image,0,3000)
@@ -60,12 +333,10 @@ def __preProcess(image):
                               image.shape[2]//4])
 
     # equalize histogram and convert to 8 bit
-    equalized_image = equalize_adapthist(image,
-                                         kernel_size=kernel_size,
-                                         clip_limit=0.01)*255
-
-    # return equalized image as np.uint8 dtype
-    return equalized_image.astype(np.uint8)
+    return chunkedCLAHE(image,
+                        kernel_size,
+                        clip_limit=0.01,
+                        workers=workers)
 
 
 def collectImgStackFused(f,
@@ -82,7 +353,12 @@ def collectImgStackFused(f,
                     nuc_clip_high  = 5000,  # nuc channel
                     cyto_clip_low  = 100,   # cyto channel
                     cyto_clip_high = 3000,
-                    res = 1): # cyto channel
+                    res = 1, # cyto channel
+                    writer = 'serial',
+                    workers = None,
+                    chunksize = 8,
+                    augment = 'files',
+                    FC_dir = None):
     """
     Method for reading in chunks of h5 data with specified coordinates,
     preprocessing the data as necessary, and saving it as 8-bit zstacks,
@@ -116,6 +392,27 @@ def collectImgStackFused(f,
     res : int
         The resolution to read.
 
+    writer : str
+        How the JPEGs are written: 'serial' (default), 'thread' or 'process' (see
+        imageWriter). All give the same files, the pools are opt-in.
+
+    workers : int
+        Pool size of the thread/process writers, defaults to os.cpu_count().
+
+    chunksize : int
+        Images per writer task.
+
+    augment : str
+        'files' writes the transpose/mirror/flip stacks next to the canonical one.
+        'manifest' only writes the canonical stack plus an augmentations.json
+        manifest; AugmentedStack.loadAugmentedStack() then gives the augmented
+        stacks as views of the canonical one (4x fewer JPEGs to encode and store).
+
+    FC_dir : str or pathlike
+        If given, the false-colored training ROI (what collectTrainingROI makes from
+        the ch1/ch2 JPEGs) is saved there too, computed from the uint16 nuclear and
+        cyto data with the nuc/cyto clip values: no second read and no JPEG loss.
+
 
     Returns
     -------
@@ -137,159 +434,182 @@ def collectImgStackFused(f,
 
     tile_str = sch0+sch1+sch2
 
-    # loop through channels
-    for ch in chans:
-
-        # create directory structure
-        chan_dir = os.path.join(saveroot, ch[1])
-        if not os.path.exists(chan_dir):
-            os.mkdir(chan_dir)
-
-        blockdir = os.path.join(chan_dir,
-                                '%s_Xpos_%s_%s_Ypos_%s_%s_stack_%s_%s' %
-                                (block_name,
-                                 '{:0>6d}'.format(x1),
-                                 '{:0>6d}'.format(x2),
-                                 '{:0>6d}'.format(y1),
-                                 '{:0>6d}'.format(y2),
-                                 '{:0>6d}'.format(zcoords[0]),
-                                 '{:0>6d}'.format(zcoords[1]))
-                                )
+    if augment not in ('files', 'manifest'):
+        raise ValueError("augment must be 'files' or 'manifest', got %r" % (augment,))
+
+    # thread/process pool shared by all channels, None when writing sequentially
+    executor = imageWriter(writer, workers)
+
+    try:
+        # uint16 nuclear and cyto slabs kept for the false coloring
+        raw = {}
+
+        # loop through channels
+        for ch in chans:
+
+            # create directory structure
+            chan_dir = os.path.join(saveroot, ch[1])
+            # exist_ok: ROIs of the same sample may be generated by concurrent processes
+            os.makedirs(chan_dir, exist_ok=True)
+
+            blockdir = os.path.join(chan_dir,
+                                    '%s_Xpos_%s_%s_Ypos_%s_%s_stack_%s_%s' %
+                                    (block_name,
+                                     '{:0>6d}'.format(x1),
+                                     '{:0>6d}'.format(x2),
+                                     '{:0>6d}'.format(y1),
+                                     '{:0>6d}'.format(y2),
+                                     '{:0>6d}'.format(zcoords[0]),
+                                     '{:0>6d}'.format(zcoords[1]))
+                                    )
         
-        blockdir_T = os.path.join(chan_dir,
-                                '%s_Xpos_%s_%s_Ypos_%s_%s_stack_%s_%s_transpose' %
-                                (block_name,
-                                 '{:0>6d}'.format(x1),
-                                 '{:0>6d}'.format(x2),
-                                 '{:0>6d}'.format(y1),
-                                 '{:0>6d}'.format(y2),
-                                 '{:0>6d}'.format(zcoords[0]),
-                                 '{:0>6d}'.format(zcoords[1]))
-                                )
-
-        blockdir_M = os.path.join(chan_dir,
-                                  '%s_Xpos_%s_%s_Ypos_%s_%s_stack_%s_%s_mirror' %
-                                  (block_name,
-                                   '{:0>6d}'.format(x1),
-                                   '{:0>6d}'.format(x2),
-                                   '{:0>6d}'.format(y1),
-                                   '{:0>6d}'.format(y2),
-                                   '{:0>6d}'.format(zcoords[0]),
-                                   '{:0>6d}'.format(zcoords[1]))
-                                   )
-
-        blockdir_F = os.path.join(chan_dir,
-                                  '%s_Xpos_%s_%s_Ypos_%s_%s_stack_%s_%s_flip' %
-                                  (block_name,
-                                   '{:0>6d}'.format(x1),
-                                   '{:0>6d}'.format(x2),
-                                   '{:0>6d}'.format(y1),
-                                   '{:0>6d}'.format(y2),
-                                   '{:0>6d}'.format(zcoords[0]),
-                                   '{:0>6d}'.format(zcoords[1]))
-                                  )
-
-        if not os.path.exists(blockdir):
-            print(blockdir)
-            os.mkdir(blockdir)
-            os.mkdir(blockdir_T)
-            os.mkdir(blockdir_M)
-            os.mkdir(blockdir_F)
-
-        # generate filenames
-        flist = [blockdir + os.sep + '%s_%s_pos%s%s_pos%s%s_' %
-                                     (block_name,
-                                      ch[0],
-                                      x1,
-                                      x2,
-                                      y1,
-                                      y2) +
-                 '{:0>6d}.jpeg'.format(z) for z in zlevels]
+            blockdir_T = os.path.join(chan_dir,
+                                    '%s_Xpos_%s_%s_Ypos_%s_%s_stack_%s_%s_transpose' %
+                                    (block_name,
+                                     '{:0>6d}'.format(x1),
+                                     '{:0>6d}'.format(x2),
+                                     '{:0>6d}'.format(y1),
+                                     '{:0>6d}'.format(y2),
+                                     '{:0>6d}'.format(zcoords[0]),
+                                     '{:0>6d}'.format(zcoords[1]))
+                                    )
+
+            blockdir_M = os.path.join(chan_dir,
+                                      '%s_Xpos_%s_%s_Ypos_%s_%s_stack_%s_%s_mirror' %
+                                      (block_name,
+                                       '{:0>6d}'.format(x1),
+                                       '{:0>6d}'.format(x2),
+                                       '{:0>6d}'.format(y1),
+                                       '{:0>6d}'.format(y2),
+                                       '{:0>6d}'.format(zcoords[0]),
+                                       '{:0>6d}'.format(zcoords[1]))
+                                       )
+
+            blockdir_F = os.path.join(chan_dir,
+                                      '%s_Xpos_%s_%s_Ypos_%s_%s_stack_%s_%s_flip' %
+                                      (block_name,
+                                       '{:0>6d}'.format(x1),
+                                       '{:0>6d}'.format(x2),
+                                       '{:0>6d}'.format(y1),
+                                       '{:0>6d}'.format(y2),
+                                       '{:0>6d}'.format(zcoords[0]),
+                                       '{:0>6d}'.format(zcoords[1]))
+                                      )
+
+            if not os.path.exists(blockdir):
+                print(blockdir)
+                os.mkdir(blockdir)
+                if augment == 'files':
+                    os.mkdir(blockdir_T)
+                    os.mkdir(blockdir_M)
+                    os.mkdir(blockdir_F)
+
+            # generate filenames
+            flist = [blockdir + os.sep + '%s_%s_pos%s%s_pos%s%s_' %
+                                         (block_name,
+                                          ch[0],
+                                          x1,
+                                          x2,
+                                          y1,
+                                          y2) +
+                     '{:0>6d}.jpeg'.format(z) for z in zlevels]
         
-        Tlist = [blockdir_T + os.sep + '%s_%s_pos%s%s_pos%s%s_transpose_' %
-                                     (block_name,
-                                      ch[0],
-                                      x1,
-                                      x2,
-                                      y1,
-                                      y2,) +
-                 '{:0>6d}.jpeg'.format(z) for z in zlevels]
+            Tlist = [blockdir_T + os.sep + '%s_%s_pos%s%s_pos%s%s_transpose_' %
+                                         (block_name,
+                                          ch[0],
+                                          x1,
+                                          x2,
+                                          y1,
+                                          y2,) +
+                     '{:0>6d}.jpeg'.format(z) for z in zlevels]
         
-        Mlist = [blockdir_M + os.sep + '%s_%s_pos%s%s_pos%s%s_mirror_' %
-                                     (block_name,
-                                      ch[0],
-                                      x1,
-                                      x2,
-                                      y1,
-                                      y2,) +
-                 '{:0>6d}.jpeg'.format(z) for z in zlevels]
-
-        fliplist = [blockdir_F + os.sep + '%s_%s_pos%s%s_pos%s%s_flip_' %
-                                     (block_name,
-                                      ch[0],
-                                      x1,
-                                      x2,
-                                      y1,
-                                      y2,) +
-                 '{:0>6d}.jpeg'.format(z) for z in zlevels]
-
-        # read in image chunk for channel
-        print('reading img', ch[0])
-        r = str(res)
-        if orient == 1:
-            img = f['t00000'][ch[0]][r]['cells'][x1:x2,
-                                                zcoords[0]:zcoords[1],
-                                                y1:y2].astype(np.uint16)
-            img = np.moveaxis(img, 0, 1)
-        else:
-            img = f['t00000'][ch[0]][r]['cells'][zcoords[0]:zcoords[1],
-                                                x1:x2,
-                                                y1:y2].astype(np.uint16)
-        # do preprocessing on target channel
-        if (CLAHE == True) and (ch[0] == target_chan):
-            img = __preProcess(img)
-            
-        elif (CLAHE==False) and (ch[0] == target_chan):
-            img = np.clip(img, lowclip_val, hiclip_val)
-            img = sk.exposure.rescale_intensity(img, out_range='uint8')
-
-        # remap nulcear or eosin 16 bit images to 8 bit range
-        else:
-            if ch[1] == 'ch2':
-                img = sk.exposure.rescale_intensity(
-                                np.clip(img,cyto_clip_low, cyto_clip_high), 
-                                out_range='uint8')
-            
-            else:
-                img = sk.exposure.rescale_intensity(
-                                np.clip(img,nuc_clip_low,nuc_clip_high), 
-                                out_range='uint8')
-
-        # generate list of two entry tuples: filename & corresponding image
-        pairedList = [(flist[i], img[i]) for i in range(len(flist))]
-        pairedList_T = [(Tlist[i], img[i].T) for i in range(len(flist))]
-        pairedList_mirror = [(Mlist[i], img[i][::-1]) for i in range(len(flist))]
+            Mlist = [blockdir_M + os.sep + '%s_%s_pos%s%s_pos%s%s_mirror_' %
+                                         (block_name,
+                                          ch[0],
+                                          x1,
+                                          x2,
+                                          y1,
+                                          y2,) +
+                     '{:0>6d}.jpeg'.format(z) for z in zlevels]
+
+            fliplist = [blockdir_F + os.sep + '%s_%s_pos%s%s_pos%s%s_flip_' %
+                                         (block_name,
+                                          ch[0],
+                                          x1,
+                                          x2,
+                                          y1,
+                                          y2,) +
+                     '{:0>6d}.jpeg'.format(z) for z in zlevels]
+
+            # read in image chunk for channel
+            print('reading img', ch[0])
+            r = str(res)
+            with trace.span('read', channel=ch[0], block=block_name):
+                if orient == 1:
+                    img = f['t00000'][ch[0]][r]['cells'][x1:x2,
+                                                        zcoords[0]:zcoords[1],
+                                                        y1:y2].astype(np.uint16)
+                    img = np.moveaxis(img, 0, 1)
+                else:
+                    img = f['t00000'][ch[0]][r]['cells'][zcoords[0]:zcoords[1],
+                                                        x1:x2,
+                                                        y1:y2].astype(np.uint16)
+            if FC_dir is not None and ch[0] != target_chan:
+                raw[ch[1]] = img
+            # do preprocessing on target channel
+            with trace.span('CLAHE' if (CLAHE == True) and (ch[0] == target_chan) else 'rescale',
+                            channel=ch[0], block=block_name):
+                if (CLAHE == True) and (ch[0] == target_chan):
+                    img = __preProcess(img, workers)
+                
+                elif (CLAHE==False) and (ch[0] == target_chan):
+                    img = np.clip(img, lowclip_val, hiclip_val)
+                    img = sk.exposure.rescale_intensity(img, out_range='uint8')
+
+                # remap nulcear or eosin 16 bit images to 8 bit range
+                else:
+                    if ch[1] == 'ch2':
+                        img = sk.exposure.rescale_intensity(
+                                        np.clip(img,cyto_clip_low, cyto_clip_high), 
+                                        out_range='uint8')
+                
+                    else:
+                        img = sk.exposure.rescale_intensity(
+                                        np.clip(img,nuc_clip_low,nuc_clip_high), 
+                                        out_range='uint8')
+
+            # generate list of two entry tuples: filename & corresponding image
+            pairedList = [(flist[i], img[i]) for i in range(len(flist))]
+
+            if augment == 'manifest':
+                # canonical stack only, the augmentations are views of it when loaded
+                with trace.span('write', channel=ch[0], block=block_name, files=len(pairedList)):
+                    writeImageStack(pairedList, executor, chunksize)
+                    writeManifest(blockdir, flist)
+                continue
+
+            pairedList_T = [(Tlist[i], img[i].T) for i in range(len(flist))]
+            pairedList_mirror = [(Mlist[i], img[i][::-1]) for i in range(len(flist))]
         
-        flip = np.flip(img, axis=2)
-        pairedList_flip = [(fliplist[i], flip[i]) for i in range(len(flist))]
-        # print('paired mlist', len(pairedList_mirror))
-
-        # save images in a multiprocessed way
-        # with ProcessingPool(ncpus=os.cpu_count()) as p:
-        #     p.map(writeImages, pairedList)
-        #     p.map(writeImages, pairedList_T)
-        #     p.map(writeImages, pairedList_mirror)
-        #     p.map(writeImages, pairedList_flip)
-
-        # save images in a sequential way
-        for i in range(len(pairedList)):
-            paired = pairedList[i]
-            paired_T = pairedList_T[i]
-            paired_flip = pairedList_flip[i]
-            paired_mirror = pairedList_mirror[i]
-            writeImages(paired)
-            writeImages(paired_T)
-            writeImages(paired_flip)
-            writeImages(paired_mirror)
+            flip = np.flip(img, axis=2)
+            pairedList_flip = [(fliplist[i], flip[i]) for i in range(len(flist))]
+            # print('paired mlist', len(pairedList_mirror))
+
+            # save images, sequentially or through the thread/process pool
+            with trace.span('write', channel=ch[0], block=block_name, files=4*len(pairedList)):
+                writeImageStack(pairedList + pairedList_T + pairedList_mirror + pairedList_flip,
+                                executor, chunksize)
+
+        if FC_dir is not None:
+            os.makedirs(FC_dir, exist_ok=True)
+            with trace.span('rescale', channel='FC', block=block_name):
+                nuc, nuc_levels = FC_rescale_lut(raw['ch1'], nuc_clip_low, nuc_clip_high, per_slice=True)
+                cyto, cyto_levels = FC_rescale_lut(raw['ch2'], cyto_clip_low, cyto_clip_high, per_slice=True)
+            saveTrainingFC(FC_dir, block_name, xcoords, ycoords, zcoords,
+                           nuc, cyto, nuc_levels, cyto_levels, augment=augment,
+                           write=lambda pairs: writeImageStack(pairs, executor, chunksize))
+    finally:
+        if executor is not None:
+            executor.shutdown()
 
     return
\ No newline at end of file
@@ -1,7 +1,13 @@
 import os
+import sys
 import numpy as np
 from skimage.io import imread, imsave
-from skimage.exposure import equalize_adapthist, rescale_intensity
+from AugmentedStack import writeManifest, augmentedViews
+
+# The false coloring engine and the tracer live in GUI/, shared with the viewers
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'GUI'))
+from UI_function import FC_rescale_lut, rapidFalseColor3D
+import UI_trace as trace
 
 
 ################ Helper functions for false-coloring #############################
@@ -9,94 +15,59 @@ from skimage.exposure import equalize_adapthist, rescale_intensity
 HE_settings = {'nuclei': [0.17, 0.27, 0.105], 'cyto': [0.05, 1.0, 0.54]}
 
 
-def getBackgroundLevels(image, threshold=50):
-    image_DS = np.sort(image, axis=None)
-    foreground_vals = image_DS[np.where(image_DS > threshold)]
-    hi_val = foreground_vals[int(np.round(len(foreground_vals)*0.95))]
-    background = hi_val / 5
-
-    return hi_val, background
-
-
-def FC_rescale(image, ClipLow, ClipHigh):
-    
-    Img_rescale = rescale_intensity(np.clip(image, ClipLow, ClipHigh)
-                                    ,out_range=(0,10000)
-                                    )
-
-    return Img_rescale
-
-
-def rapidFieldDivision(image, flat_field):
-    """Used for rapidFalseColoring() when flat field has been calculated."""
-    output = np.divide(image, flat_field, where=(flat_field != 0))
-    return output
-
-
-def rapidPreProcess(image, background, norm_factor):
-    """Background subtraction optimized for CPU."""
-    tmp = image - background
-    tmp[tmp < 0] = 0
-    tmp = (tmp ** 0.85) * (255 / norm_factor)
-    return tmp
-
-
-def rapidGetRGBframe(nuclei, cyto, nuc_settings, cyto_settings, k_nuclei, k_cyto):
-    """CPU-based exponential false coloring operation."""
-    tmp = nuclei * nuc_settings * k_nuclei + cyto * cyto_settings * k_cyto
-    return 255 * np.exp(-1 * tmp)
-
+################ Making "FC" folder, and blocks sub-folder #############################
 
-def rapidFalseColor(nuclei, cyto, nuc_settings, cyto_settings,
-                    nuc_normfactor=3000, cyto_normfactor=8000,
-                    run_FlatField_nuc=False, 
-                    run_FlatField_cyto=False,
-                    nuc_bg_threshold=50, 
-                    cyto_bg_threshold=50):
 
-    nuclei = np.ascontiguousarray(nuclei, dtype=float)
-    cyto = np.ascontiguousarray(cyto, dtype=float)
+def saveTrainingFC(FC_dir,
+                   blockname,
+                   xcoords,
+                   ycoords,
+                   zcoords,
+                   nuc,
+                   cyto,
+                   nuc_levels,
+                   cyto_levels,
+                   augment='files',
+                   write=None):
+    """
+    False color one training ROI and save it with its transpose/mirror/flip augmentations.
 
-    # Set multiplicative constants
-    k_nuclei = 1.0
-    k_cyto = 1.0
+    The stack is false colored once; the augmentations are the transposed and flipped
+    RGB result (false coloring works pixel by pixel, so this is the same as false
+    coloring the transposed or flipped inputs).
 
-    # Run background subtraction or normalization for nuc and cyto
-    if not run_FlatField_nuc:
-        k_nuclei = 0.08
-        nuc_background = getBackgroundLevels(nuclei, threshold=nuc_bg_threshold)[1]
-        nuclei = rapidPreProcess(nuclei, nuc_background, nuc_normfactor)
+    Parameters
+    ----------
 
-    if not run_FlatField_cyto:
-        k_cyto = 0.012
-        cyto_background = getBackgroundLevels(cyto, threshold=cyto_bg_threshold)[1]
-        cyto = rapidPreProcess(cyto, cyto_background, cyto_normfactor)
+    FC_dir : str or pathlike
+        Root folder of the false-colored training ROIs.
 
-    output_global = np.zeros((3, nuclei.shape[0], nuclei.shape[1]), dtype=np.uint8)
-    for i in range(3):
-        output_global[i] = rapidGetRGBframe(nuclei, cyto, nuc_settings[i], cyto_settings[i], k_nuclei, k_cyto)
+    blockname : str
+        Sample name for the block folder names.
 
-    RGB_image = np.moveaxis(output_global, 0, -1).astype(np.uint8)
-    return RGB_image
+    xcoords, ycoords, zcoords : tuple
+        Coordinates of the ROI, for the folder and file names.
 
+    nuc, cyto : [z, y, x] uint16 arrays
+        Codes of the nuclear and cyto channels from FC_rescale_lut(..., per_slice=True).
 
+    nuc_levels, cyto_levels : 2D arrays
+        Per-slice levels from FC_rescale_lut(..., per_slice=True).
 
+    augment : str
+        'files' writes the four stacks, 'manifest' the canonical stack plus an
+        augmentations.json manifest (see AugmentedStack).
 
-################ Making "FC" folder, and blocks sub-folder #############################
-
-
-def collectTrainingROI(FC_dir,
-                       ch1_dir,
-                       ch2_dir,
-                       blockname,
-                       xcoords, 
-                       ycoords,
-                       zcoords):
+    write : callable
+        write(pairs) saves a list of (fname, image) pairs, defaults to imsave one by one.
 
+    Returns
+    -------
 
+    """
     x1, x2  = xcoords[0], xcoords[1]
-    y1, y2  = ycoords[0], ycoords[1]       
-    zlevels = np.arange(zcoords[0], zcoords[1], 1)   
+    y1, y2  = ycoords[0], ycoords[1]
+    zlevels = np.arange(zcoords[0], zcoords[1], 1)
 
     # Create the block subfolder names and the jpeg file names for the false-colored training ROIs
 
@@ -118,9 +89,10 @@ def collectTrainingROI(FC_dir,
     if not os.path.exists(blockdirFC):
         print(blockdirFC)
         os.mkdir(blockdirFC)
-        os.mkdir(blockdirFC_T)
-        os.mkdir(blockdirFC_M)
-        os.mkdir(blockdirFC_F)
+        if augment == 'files':
+            os.mkdir(blockdirFC_T)
+            os.mkdir(blockdirFC_M)
+            os.mkdir(blockdirFC_F)
 
     FCflists = [blockdirFC + os.sep + '%s_FC_pos%s%s_pos%s%s_' %
                                       (blockname,
@@ -154,13 +126,51 @@ def collectTrainingROI(FC_dir,
                                       y2) +
                         '{:0>6d}.jpeg'.format(z) for z in zlevels]
 
+    # False color the whole stack once, every slice keeps its own rescaling and background
+    with trace.span('rapidFalseColor', channel='FC', block=blockname):
+        pseudoHE = rapidFalseColor3D(nuc, cyto, HE_settings['nuclei'], HE_settings['cyto'],
+                                     nuc_levels=nuc_levels, cyto_levels=cyto_levels)
+
+    if write is None:
+        def write(pairs):
+            for FC_file, frame in pairs:
+                imsave(FC_file, frame)
+
+    with trace.span('write', channel='FC', block=blockname):
+        if augment == 'manifest':
+            write(list(zip(FCflists, pseudoHE)))
+            writeManifest(blockdirFC, FCflists)
+            return
+
+        views = augmentedViews(pseudoHE)
+        FC_blocks = [(FCflists, 'original'), (FCTlists, 'transpose'), (FCMlists, 'mirror'), (FCFflists, 'flip')]
+        write([pair for FC_block, aug in FC_blocks for pair in zip(FC_block, views[aug])])
+
+
+def collectTrainingROI(FC_dir,
+                       ch1_dir,
+                       ch2_dir,
+                       blockname,
+                       xcoords, 
+                       ycoords,
+                       zcoords,
+                       augment='files'):
+    """
+    False color a training ROI from the 8-bit stacks written by collectImgStackFused.
+
+    Only the canonical JPEG stacks are read; see saveTrainingFC for the augmentations.
+    collectImgStackFused(..., FC_dir=...) does the same from the uint16 HDF5 data,
+    without the JPEG round trip.
+    """
+
+    x1, x2  = xcoords[0], xcoords[1]
+    y1, y2  = ycoords[0], ycoords[1]       
+    zlevels = np.arange(zcoords[0], zcoords[1], 1)   
+
     chans = [(ch1_dir, 's01'),
              (ch2_dir, 's00')]
     
     flists  = []
-    Tflists = []
-    Mflists = []
-    Fflists = []
     
     # Iterate through channels
 
@@ -177,10 +187,6 @@ def collectTrainingROI(FC_dir,
                                 '{:0>6d}'.format(zcoords[1]))
                                 )
 
-        blockdir_T = blockdir + "_transpose"
-        blockdir_M = blockdir + "_mirror"
-        blockdir_F = blockdir + "_flip"
-
         flist = [blockdir + os.sep + '%s_%s_pos%s%s_pos%s%s_' %
                                 (blockname,
                                 ch[1],
@@ -192,57 +198,14 @@ def collectTrainingROI(FC_dir,
 
         flists.append(flist)
 
-        Tflist = [blockdir_T + os.sep + '%s_%s_pos%s%s_pos%s%s_transpose_' %
-                                (blockname,
-                                ch[1],
-                                x1,
-                                x2,
-                                y1,
-                                y2) +
-                '{:0>6d}.jpeg'.format(z) for z in zlevels]
-
-        Tflists.append(Tflist)
-
-        Mflist = [blockdir_M + os.sep + '%s_%s_pos%s%s_pos%s%s_mirror_' %
-                                (blockname,
-                                ch[1],
-                                x1,
-                                x2,
-                                y1,
-                                y2) +
-                '{:0>6d}.jpeg'.format(z) for z in zlevels]
-
-        Mflists.append(Mflist)
-
-        Fflist = [blockdir_F + os.sep + '%s_%s_pos%s%s_pos%s%s_flip_' %
-                                (blockname,
-                                ch[1],
-                                x1,
-                                x2,
-                                y1,
-                                y2) +
-                '{:0>6d}.jpeg'.format(z) for z in zlevels]
-
-        Fflists.append(Fflist)
-
 
     # Read in JPEG images and do false-color
-    ROI_blocks = [flists,   Tflists,  Mflists,  Fflists]
-    FC_blocks  = [FCflists, FCTlists, FCMlists, FCFflists]
-
-    for ROI_block, FC_block in zip(ROI_blocks, FC_blocks):
-        for i in range(len(ROI_block[0])):
-            nuc  = imread(ROI_block[0][i])
-            cyto = imread(ROI_block[1][i])
-            nuc =  FC_rescale(nuc,  1, 10000)
-            cyto = FC_rescale(cyto, 1, 10000)
-
-            pseudoHE = rapidFalseColor(nuc, cyto, HE_settings['nuclei'], HE_settings['cyto'])
-            imsave(FC_block[i], pseudoHE)
-
-
-
-
-
-
-    
\ No newline at end of file
+    with trace.span('read', channel='FC', block=blockname):
+        nuc  = np.stack([imread(f) for f in flists[0]])
+        cyto = np.stack([imread(f) for f in flists[1]])
+    with trace.span('rescale', channel='FC', block=blockname):
+        nuc, nuc_levels =  FC_rescale_lut(nuc,  1, 10000, per_slice=True)
+        cyto, cyto_levels = FC_rescale_lut(cyto, 1, 10000, per_slice=True)
+
+    saveTrainingFC(FC_dir, blockname, xcoords, ycoords, zcoords,
+                   nuc, cyto, nuc_levels, cyto_levels, augment=augment)